@@ -9,38 +9,150 @@ mini-claw 版本改动：
   - run() 返回字符串结果，而不是直接 print
   - 去掉交互式 input() 确认（因为用户不在终端旁边）
   - 保留流式调用和重试逻辑
+
+执行核心是 asyncio 的 AsyncAgent（基于 AsyncAnthropic 流式调用），
+Agent 只是一个同步适配器，把协程丢到后台事件循环里跑完再返回。
 """
 
 import os
 import json
 import time
+import asyncio
 import anthropic as anthropic_lib
-from anthropic import Anthropic
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from anthropic import AsyncAnthropic
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
-from tools import get_all_tools, execute_tool
+from tools import get_all_tools
+import blob_store
+from blob_store import resolve_blobs
+from session_store import get_store, clean_content_blocks
+import tool_cache
+import tracing
+from tool_pool import pool as tool_pool
+from runtime import run_sync
+from llm_client import get_async_client
+from llm_scheduler import scheduler as llm_scheduler
+import model_router
+from planning import policy as planning_policy
+from tokens import TokenCounter, estimate_text, truncate_old_tool_results, fit_to_budget
 
 load_dotenv()
-ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 
 logger = __import__("logging").getLogger(__name__)
 
 
-MAX_HISTORY = 30   # 超过这个消息数触发压缩
+# 历史估算 token 数超过这个阈值，在回复发出后后台压缩
+COMPACT_TOKEN_THRESHOLD = int(os.environ.get("COMPACT_TOKEN_THRESHOLD", "40000"))
 KEEP_RECENT = 10   # 压缩时保留最近几条不动
 
+# 上下文预算（tokens.py）：
+#   MAX_INPUT_TOKENS        单次请求输入的硬上限（system + tools + messages）
+#   TOOL_RESULT_MAX_TOKENS  较早的 tool_result 超过这个大小就截断
+#   TOOL_RESULT_KEEP_RECENT 最近几条带 tool_result 的消息不截断
+#   TOKEN_COUNT_EXACT       估算接近上限时调用 count_tokens 接口确认
+MAX_INPUT_TOKENS = int(os.environ.get("MAX_INPUT_TOKENS", "150000"))
+TOOL_RESULT_MAX_TOKENS = int(os.environ.get("TOOL_RESULT_MAX_TOKENS", "2000"))
+TOOL_RESULT_KEEP_RECENT = int(os.environ.get("TOOL_RESULT_KEEP_RECENT", "2"))
+TOKEN_COUNT_EXACT = os.environ.get("TOKEN_COUNT_EXACT", "0") == "1"
+
+SUMMARY_PREFIX = "【以下是之前对话的摘要，请基于此继续】\n\n"
+SUMMARY_ACK = "明白，我已了解之前的对话背景，请继续。"
+
+# Prompt Caching：给 system prompt、工具定义和历史末尾打 cache_control 断点，
+# 多轮对话里不变的前缀只在第一次写缓存，之后按缓存读取计费，首 token 也更快
+PROMPT_CACHING = os.environ.get("PROMPT_CACHING", "1") == "1"
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+# ============================================================
+# System prompt 构建
+#
+# 时间戳只精确到 PROMPT_TIME_GRANULARITY（minute / hour / day），
+# 粒度越粗，prompt 保持字节不变的时间越长，缓存命中越高。
+# MEMORY.md 最多每 MEMORY_CHECK_INTERVAL 秒 stat 一次，mtime/size 变了才重读；
+# 外部改完记忆文件也可以调用 invalidate_memory() 让下次调用立即检查。
+# ============================================================
+
+PROMPT_TIME_GRANULARITY = os.environ.get("PROMPT_TIME_GRANULARITY", "day")
+MEMORY_CHECK_INTERVAL = float(os.environ.get("MEMORY_CHECK_INTERVAL", "2"))
+MEMORY_FILE = Path("MEMORY.md")
+
+_TIME_FORMATS = {
+    "minute": "%Y-%m-%d %H:%M %A",
+    "hour": "%Y-%m-%d %H:00 %A",
+    "day": "%Y-%m-%d %A",
+}
+
+if PROMPT_TIME_GRANULARITY not in _TIME_FORMATS:
+    logger.warning(f"未知 PROMPT_TIME_GRANULARITY={PROMPT_TIME_GRANULARITY!r}，改用 day")
+    PROMPT_TIME_GRANULARITY = "day"
+
+_memory = {"checked_at": None, "stamp": None, "text": ""}
+
+
+def _memory_stamp():
+    """返回 MEMORY.md 当前版本（mtime, size），不存在为 None；版本变化时重读内容"""
+    now = time.monotonic()
+    checked_at = _memory["checked_at"]
+    if checked_at is not None and now - checked_at < MEMORY_CHECK_INTERVAL:
+        return _memory["stamp"]
+    _memory["checked_at"] = now
+    try:
+        st = MEMORY_FILE.stat()
+        stamp = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        stamp = None
+    if stamp != _memory["stamp"]:
+        _memory["text"] = MEMORY_FILE.read_text(encoding="utf-8").strip() if stamp else ""
+        _memory["stamp"] = stamp
+        logger.info(f"MEMORY.md 已重新加载（{len(_memory['text'])} 字符）")
+    return stamp
+
+
+def invalidate_memory() -> None:
+    """通知 MEMORY.md 可能已变化，下次构建 prompt 时立即检查"""
+    _memory["checked_at"] = None
+
+
+@lru_cache(maxsize=64)
+def _render_system_prompt(mode: str, workspace: str, now: str, memory_stamp) -> str:
+    """按缓存 key 拼出 system prompt；memory_stamp 决定用哪个版本的记忆内容"""
+    if mode == "chat":
+        base = f"""你是用户的私人助手，当前时间：{now}。
+正在进行轻松的对话，可以讨论任何话题：项目想法、头脑风暴、日常聊天。
+不需要刻意使用工具，直接对话即可。"""
+    else:
+        base = f"""你是一个只读的编程助手，当前时间：{now}。你可以帮助用户：
+- 阅读和分析代码文件
+- 查看项目目录结构
+- 回答编程问题
+
+【重要限制】
+- 你只能读取文件，不能修改、删除或创建任何文件
+- 你只能访问工作目录内的文件：{workspace}
+- 如果用户要求超出以上范围的操作，礼貌拒绝并说明原因
+
+使用 read_file 读取文件，list_files 查看目录，search_code 搜索代码，find_symbol 查找定义。"""
+
+    # 记忆文件（如果存在且非空）
+    memory = _memory["text"] if memory_stamp is not None else ""
+    if memory:
+        base += f"\n\n## 记忆\n{memory}"
 
-class Agent:
+    return base
+
+
+class AsyncAgent:
     def __init__(self, session_id: str, max_turns: int = 10):
-        self.client = Anthropic(api_key=ANTHROPIC_API_KEY)
-        self.model = "claude-sonnet-4-20250514"
+        # 用哪个模型、max_tokens 多少按调用类型和模式由 model_router.py 决定
         self.max_turns = max_turns
 
-        # 持久化：每个会话对应一个 .jsonl 文件
+        # 持久化：默认每个会话对应一个 .jsonl 文件，也可以换成 SQLite（session_store.py）
         # 对应 OpenClaw：.jsonl 会话存储
-        self.session_file = Path("sessions") / f"{session_id}.jsonl"
+        self.session_id = session_id
+        self.store = get_store()
 
         self.workspace = os.environ.get("WORKSPACE_PATH", "未配置")
 
@@ -48,21 +160,106 @@ class Agent:
         # 对应 OpenClaw：动态 system prompt 构建
         self.mode = "code"
 
+        # 历史消息序列化后的近似字节数，供会话池做内存预算
+        self.history_bytes = 0
+
+        # 本会话累计的 token 用量（含缓存读/写），来自每次响应的 usage
+        self.usage = {
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+        }
+
+        # 处理消息时的 LLM 调用次数（规划 + 执行轮次，不含后台压缩），gateway 用来估算合并消息省下的调用
+        self.llm_calls = 0
+
+        # 每条消息的 token 估算缓存，并用真实 usage 校准
+        self.tokens = TokenCounter()
+
         # 启动时从文件加载历史，恢复上次的对话上下文
         self.conversation_history = self._load_history()
 
-    def run(self, user_message: str) -> str:
+        # 后台压缩：_compaction_task 在回复发出后运行，
+        # 结果 (cut, summary) 暂存在 _pending_compaction，下一轮开始时原子替换
+        self._compaction_task: asyncio.Task | None = None
+        self._pending_compaction: tuple[int, str] | None = None
+        self._history_epoch = 0   # reset / 替换历史时 +1，让过期的压缩结果作废
+
+        # 流式事件回调，只在 run() 期间有效
+        self._on_event = None
+
+        # 工具结果去重：结果摘要 → (第几轮工具调用, tool_use_id)
+        self._tool_round = 0
+        self._seen_results: dict[str, tuple[int, str]] = {}
+
+    @property
+    def client(self) -> AsyncAnthropic:
+        """进程共享的客户端（llm_client.py），所有会话共用一个连接池"""
+        return get_async_client()
+
+    async def run(self, user_message: str, on_event=None) -> str:
         """
         运行 Agent，返回最终回复字符串。
 
         和 coding-agent 版本的关键区别：
           - 不直接 print，而是收集结果返回
           - 因为调用方（gateway）需要拿到结果再发给用户
+          - 协程实现：等待 LLM / 工具时不占用线程，上千个会话共用一个事件循环
+
+        on_event：可选回调，处理过程中实时收到事件（在事件循环线程上调用，不要阻塞）：
+            {"type": "plan", "text": 执行计划}
+            {"type": "text_delta", "text": 增量文字}
+            {"type": "text_reset", "chars": n}      之前推送的文字里最后 n 个字作废
+                                                     （限流 / 断连重试、升级模型时这次请求从头重新生成）
+            {"type": "tool_start", "name": 工具名, "input": 参数}
+            {"type": "tool_end", "name": 工具名}
+
+        压缩不在这里同步等待：先换上上次后台压缩好的摘要，
+        本轮结束后如果历史超过阈值，再启动新的后台压缩。
         """
-        # 超过阈值则先压缩历史，对应 OpenClaw：compaction.ts
-        if len(self.conversation_history) > MAX_HISTORY:
-            self._compact_history()
+        with tracing.span("agent.run", session=self.session_id, mode=self.mode) as span:
+            self._apply_pending_compaction()
+            self._on_event = on_event
+            try:
+                reply = await self._run(user_message)
+                span.set(reply_chars=len(reply))
+                return reply
+            finally:
+                self._on_event = None
+                with tracing.span("persist"):
+                    await self.store.flush_async(self.session_id)   # 本轮的消息一次写出，fsync 在写线程上
+                self._maybe_start_compaction()
+
+    async def stream(self, user_message: str):
+        """
+        迭代器版本的 run()：逐个 yield 事件，最后 yield {"type": "done", "reply": 最终回复}。
+
+        用法：
+            async for event in agent.stream("看看 main.py"):
+                ...
+        """
+        events: asyncio.Queue = asyncio.Queue()
+        task = asyncio.get_running_loop().create_task(self.run(user_message, on_event=events.put_nowait))
+        task.add_done_callback(lambda t: events.put_nowait(None))
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+            yield {"type": "done", "reply": task.result()}
+        finally:
+            if not task.done():
+                task.cancel()
+
+    def _emit(self, event_type: str, **data) -> None:
+        """向当前 run() 的调用方推送一个流式事件"""
+        if self._on_event is None:
+            return
+        try:
+            self._on_event({"type": event_type, **data})
+        except Exception as e:
+            logger.error(f"流式事件回调失败 [{event_type}]: {e}")
 
+    async def _run(self, user_message: str) -> str:
         logger.info(f"mode={self.mode}  开始处理")
         # chat 模式跳过规划阶段，直接对话
         if self.mode == "chat":
@@ -70,19 +267,10 @@ class Agent:
             self.conversation_history.append(msg_user)
             self._save_message(msg_user)
         else:
-            # --- Phase 1: 规划 ---
-            logger.info("Phase 1: 规划中...")
-            plan = self._create_plan(user_message)
-
-            msg_user = {"role": "user", "content": user_message}
-            msg_plan = {"role": "assistant", "content": f"我的执行计划：\n\n{plan}"}
-            msg_go = {"role": "user", "content": "好，请严格按照计划执行，完成后汇报最终结果。"}
-            self.conversation_history.append(msg_user)
-            self._save_message(msg_user)
-            self.conversation_history.append(msg_plan)
-            self._save_message(msg_plan)
-            self.conversation_history.append(msg_go)
-            self._save_message(msg_go)
+            # --- Phase 1: 规划（是否规划、怎么规划由 planning.py 的策略决定）---
+            direct_reply = await self._plan_phase(user_message)
+            if direct_reply is not None:
+                return direct_reply
 
         # --- Phase 2: 执行 ---
         turn = 0
@@ -91,7 +279,7 @@ class Agent:
             logger.info(f"Turn {turn}: 调用 LLM...")
 
             try:
-                response, response_text = self._call_llm(self.conversation_history)
+                response, response_text = await self._call_llm(self.conversation_history)
             except Exception as e:
                 logger.error(f"LLM 调用失败: {e}")
                 return f"[错误] LLM 调用失败：{str(e)}"
@@ -106,7 +294,7 @@ class Agent:
             elif response.stop_reason == "tool_use":
                 tool_names = [b.name for b in response.content if b.type == "tool_use"]
                 logger.info(f"Turn {turn}: tool_use → {tool_names}")
-                self._process_tool_calls(self.conversation_history, response)
+                await self._process_tool_calls(self.conversation_history, response)
 
             else:
                 return f"[错误] 意外的 stop_reason: {response.stop_reason}"
@@ -117,141 +305,192 @@ class Agent:
         """
         动态构建 system prompt。
 
-        每次调用 LLM 前现拼，注入当前时间、模式、记忆文件。
+        每次调用 LLM 前获取，注入当前时间、模式、记忆文件。
         对应 OpenClaw：每条消息处理前动态构建 system prompt。
-        """
-        now = datetime.now().strftime("%Y-%m-%d %H:%M %A")
-
-        if self.mode == "chat":
-            base = f"""你是用户的私人助手，当前时间：{now}。
-正在进行轻松的对话，可以讨论任何话题：项目想法、头脑风暴、日常聊天。
-不需要刻意使用工具，直接对话即可。"""
-        else:
-            base = f"""你是一个只读的编程助手，当前时间：{now}。你可以帮助用户：
-- 阅读和分析代码文件
-- 查看项目目录结构
-- 回答编程问题
-
-【重要限制】
-- 你只能读取文件，不能修改、删除或创建任何文件
-- 你只能访问工作目录内的文件：{self.workspace}
-- 如果用户要求超出以上范围的操作，礼貌拒绝并说明原因
-
-使用 read_file 读取文件，list_files 查看目录。"""
 
-        # 加载记忆文件（如果存在）
-        memory_file = Path("MEMORY.md")
-        if memory_file.exists():
-            memory = memory_file.read_text(encoding="utf-8").strip()
-            if memory:
-                base += f"\n\n## 记忆\n{memory}"
-
-        return base
+        结果按 (模式, 工作目录, 时间桶, MEMORY.md 版本) 缓存，
+        同一个时间桶内多轮调用拿到的是同一段字节，不读磁盘，也不破坏 Prompt Caching。
+        """
+        memory_stamp = _memory_stamp()
+        now = datetime.now().strftime(_TIME_FORMATS[PROMPT_TIME_GRANULARITY])
+        return _render_system_prompt(self.mode, self.workspace, now, memory_stamp)
 
     def reset(self):
         """清空对话历史，同时删除持久化文件"""
         self.conversation_history = []
-        if self.session_file.exists():
-            self.session_file.unlink()
+        self.history_bytes = 0
+        self.tokens.prune(self.conversation_history)
+        self._seen_results.clear()
+        self._pending_compaction = None
+        self._history_epoch += 1
+        self.store.delete(self.session_id)
+        blob_store.schedule_gc()   # 这个会话独占的大结果正文没人引用了
+
+    def close(self):
+        """写出缓存、释放会话存储资源（会话被逐出会话池时调用）"""
+        self.store.close(self.session_id)
+
+    # ------------------------------------------------------------
+    # 压缩（对应 OpenClaw：compaction.ts）
+    #
+    # 1. 回复发出后，历史估算 token 超过 COMPACT_TOKEN_THRESHOLD → 启动后台任务
+    # 2. 后台任务只概括「上次摘要 + 之后新增的旧消息」，增量更新摘要
+    # 3. 下一轮 run() 开始时把 history[:cut] 原子替换成摘要，重写 session 文件
+    # 压缩期间新追加的消息都在 cut 之后，不受影响。
+    # ------------------------------------------------------------
+
+    def _estimate_history_tokens(self) -> int:
+        return self.tokens.total(self.conversation_history)
+
+    def _maybe_start_compaction(self) -> None:
+        """历史超过阈值且没有压缩在跑时，启动后台压缩任务"""
+        if self._compaction_task is not None and not self._compaction_task.done():
+            return
+        if self._pending_compaction is not None:
+            return
+        if self._estimate_history_tokens() <= COMPACT_TOKEN_THRESHOLD:
+            return
+        self._compaction_task = asyncio.get_running_loop().create_task(self._compact_history())
 
-    def _compact_history(self):
+    def _compaction_cut(self) -> int:
         """
-        压缩对话历史：把旧消息概括成摘要，只保留最近 KEEP_RECENT 条。
+        计算压缩切分点：history[:cut] 被摘要替换，history[cut:] 保留。
 
-        对应 OpenClaw：compaction.ts
-        压缩后重写整个 session 文件（不再是 append）。
+        保留部分不能以孤立的 tool_result 开头（对应的 tool_use 被压缩掉了，API 会报错），
+        所以切分点往后挪，挪过去的消息一起进摘要。
         """
-        old_messages = self.conversation_history[:-KEEP_RECENT]
-        recent_messages = self.conversation_history[-KEEP_RECENT:]
-
-        # 确保 recent_messages 不以孤立的 tool_result 开头
-        # （对应的 tool_use 已被压缩删除，API 会报错）
-        while recent_messages:
-            first_content = recent_messages[0].get("content", "")
-            if isinstance(first_content, list) and any(
+        history = self.conversation_history
+        cut = max(0, len(history) - KEEP_RECENT)
+        while cut < len(history):
+            content = history[cut].get("content", "")
+            if isinstance(content, list) and any(
                 isinstance(b, dict) and b.get("type") == "tool_result"
-                for b in first_content
+                for b in content
             ):
-                recent_messages = recent_messages[1:]
+                cut += 1
             else:
                 break
+        return cut
+
+    def _previous_summary(self) -> str | None:
+        """history 开头如果是上次压缩留下的摘要，返回摘要正文"""
+        history = self.conversation_history
+        if history and isinstance(history[0].get("content"), str) \
+                and history[0]["content"].startswith(SUMMARY_PREFIX):
+            return history[0]["content"][len(SUMMARY_PREFIX):]
+        return None
+
+    async def _compact_history(self):
+        """
+        后台压缩：增量概括旧消息，结果暂存，等下一轮开始时替换。
+
+        只概括上次摘要之后新增的旧消息，连同上次摘要一起交给 LLM 更新，
+        不会每次把全部历史从头再概括一遍。
+        """
+        with tracing.trace("compaction", session=self.session_id) as span:
+            await self._compact(span)
+
+    async def _compact(self, span):
+        """_compact_history 的主体，span 是这次压缩的 trace 根"""
+        epoch = self._history_epoch
+        cut = self._compaction_cut()
+        previous = self._previous_summary()
+        start = 2 if previous is not None else 0
+        new_messages = self.conversation_history[start:cut]
+        if not new_messages:
+            return
 
-        logger.info(f"压缩历史：{len(old_messages)} 条 → 摘要，保留最近 {len(recent_messages)} 条")
+        logger.info(f"后台压缩：{len(new_messages)} 条新旧消息 → 摘要（{'增量' if previous else '首次'}）")
+        span.set(messages=len(new_messages), incremental=previous is not None)
+
+        # 紧凑 JSON（不缩进），大 tool_result 截断，减少摘要请求本身的 token；
+        # 要读 blob 文件、拼很长的字符串，放到线程里
+        def serialize():
+            serialized = resolve_blobs(truncate_old_tool_results(
+                [self._serialize_message(m) for m in new_messages], 0, TOOL_RESULT_MAX_TOKENS
+            ))
+            return json.dumps(serialized, ensure_ascii=False, separators=(",", ":"))
+        transcript = await asyncio.to_thread(serialize)
+        if previous is not None:
+            prompt = f"已有摘要：\n\n{previous}\n\n请结合以下新增对话，输出更新后的完整摘要：\n\n{transcript}"
+        else:
+            prompt = f"请概括以下对话：\n\n{transcript}"
 
-        # 让 LLM 概括旧消息
         summary_text = ""
-        try:
-            with self.client.messages.stream(
-                model=self.model,
-                max_tokens=1024,
+
+        async def attempt(route):
+            nonlocal summary_text
+            summary_text = ""
+            async with self.client.messages.stream(
+                model=route.model,
+                max_tokens=route.max_tokens,
                 system="你是一个对话摘要助手。请将以下对话历史概括成简洁的摘要，保留关键信息和结论。",
-                messages=[{
-                    "role": "user",
-                    "content": f"请概括以下对话：\n\n{json.dumps([self._serialize_message(m) for m in old_messages], ensure_ascii=False, indent=2)}"
-                }]
+                messages=[{"role": "user", "content": prompt}]
             ) as stream:
-                for text in stream.text_stream:
+                async for text in stream.text_stream:
                     summary_text += text
+                return await stream.get_final_message()
+
+        try:
+            final = await self._routed_call("compact", estimate_text(prompt), attempt)
+            self._record_usage("compact", final)
         except Exception as e:
             logger.error(f"压缩失败，保持原历史：{e}")
+            span.error = f"{type(e).__name__}: {e}"
             return
 
-        # 用摘要替换旧消息，保留近期消息
-        summary_msg = {
-            "role": "user",
-            "content": f"【以下是之前对话的摘要，请基于此继续】\n\n{summary_text}"
-        }
-        ack_msg = {
-            "role": "assistant",
-            "content": "明白，我已了解之前的对话背景，请继续。"
-        }
-        self.conversation_history = [summary_msg, ack_msg] + recent_messages
-
-        # 重写整个 session 文件
-        self.session_file.parent.mkdir(exist_ok=True)
-        with open(self.session_file, "w", encoding="utf-8") as f:
-            for msg in self.conversation_history:
-                f.write(json.dumps(self._serialize_message(msg), ensure_ascii=False) + "\n")
+        if epoch != self._history_epoch:
+            logger.info("压缩期间历史被重置，丢弃本次摘要")
+            return
+        self._pending_compaction = (cut, summary_text)
+        logger.info(f"后台压缩完成，下一轮开始时替换前 {cut} 条消息")
 
-        logger.info(f"压缩完成，history 从 {len(old_messages) + len(recent_messages)} 条压缩至 {len(self.conversation_history)} 条")
+    def _apply_pending_compaction(self) -> None:
+        """把后台算好的摘要原子替换进 history，并重写 session 文件"""
+        if self._pending_compaction is None:
+            return
+        cut, summary_text = self._pending_compaction
+        self._pending_compaction = None
+        self._history_epoch += 1
+
+        with tracing.span("compaction.apply", cut=cut):
+            self._replace_history(cut, summary_text)
+
+    def _replace_history(self, cut: int, summary_text: str) -> None:
+        """history[:cut] 换成摘要 + 确认两条消息"""
+        before = len(self.conversation_history)
+        summary_msg = {"role": "user", "content": SUMMARY_PREFIX + summary_text}
+        ack_msg = {"role": "assistant", "content": SUMMARY_ACK}
+        # 保留部分里指向被压缩掉的结果的去重引用换回原文，否则模型再也看不到那份结果
+        kept = tool_cache.inline_references(self.conversation_history[cut:], self.conversation_history[:cut])
+        self.conversation_history = [summary_msg, ack_msg] + kept
+        self.tokens.prune(self.conversation_history)
+        # 去重表只保留原始结果还在 history 里的条目，被压缩掉的结果不能再被引用
+        live = {b["tool_use_id"] for m in kept if isinstance(m.get("content"), list)
+                for b in m["content"] if isinstance(b, dict) and b.get("type") == "tool_result"}
+        self._seen_results = {digest: seen for digest, seen in self._seen_results.items() if seen[1] in live}
+
+        # 重写整个 session 文件（压缩后的历史很短，代价很小）；临时文件 + rename，不会写坏
+        lines = [json.dumps(self._serialize_message(msg), ensure_ascii=False) + "\n"
+                 for msg in self.conversation_history]
+        self.history_bytes = sum(len(line) for line in lines)
+        self.store.rewrite(self.session_id, lines)
+        blob_store.schedule_gc()
+
+        logger.info(f"压缩已生效，history 从 {before} 条压缩至 {len(self.conversation_history)} 条")
 
     def _load_history(self) -> list:
-        """从 .jsonl 文件加载历史对话，加载时顺便清理多余字段"""
-        if not self.session_file.exists():
-            return []
+        """从会话存储加载历史对话；旧版 .jsonl 加载时顺便清理多余字段"""
         history = []
-        with open(self.session_file, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    history.append(self._clean_content_blocks(json.loads(line)))
+        clean = self.store.clean_on_load
+        for line in self.store.load(self.session_id):
+            self.history_bytes += len(line)
+            line = line.strip()
+            if line:
+                message = json.loads(line)
+                history.append(clean_content_blocks(message) if clean else message)
         return history
 
-    def _clean_content_blocks(self, message: dict) -> dict:
-        """
-        清理消息 content 中多余的字段，只保留 API 协议字段。
-
-        加载旧版 .jsonl 时修复因 SDK 升级引入的额外字段
-        （如 citations、parsed_output、caller 等）。
-        """
-        content = message.get("content")
-        if not isinstance(content, list):
-            return message
-        cleaned = []
-        for block in content:
-            if not isinstance(block, dict):
-                cleaned.append(block)
-                continue
-            t = block.get("type")
-            if t == "text":
-                cleaned.append({"type": "text", "text": block["text"]})
-            elif t == "tool_use":
-                cleaned.append({"type": "tool_use", "id": block["id"],
-                                 "name": block["name"], "input": block["input"]})
-            else:
-                cleaned.append(block)  # tool_result 等保持原样
-        return {**message, "content": cleaned}
-
     def _serialize_message(self, message: dict) -> dict:
         """
         将消息序列化为 JSON 可存储格式。
@@ -276,13 +515,104 @@ class Agent:
         return {**message, "content": serialized}
 
     def _save_message(self, message: dict):
-        """将单条消息追加写入 .jsonl 文件"""
-        self.session_file.parent.mkdir(exist_ok=True)
+        """将单条消息追加到会话存储（先进缓存，run() 结束时一次写出）"""
         serializable = self._serialize_message(message)
-        with open(self.session_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(serializable, ensure_ascii=False) + "\n")
+        line = json.dumps(serializable, ensure_ascii=False) + "\n"
+        self.history_bytes += len(line)
+        self.store.append(self.session_id, line)
+
+    async def _plan_phase(self, user_message: str) -> str | None:
+        """
+        Phase 1：按规划策略处理用户消息，把它（和计划）写进 history。
 
-    def _create_plan(self, user_message: str) -> str:
+        返回 None 表示继续进入执行阶段；
+        投机模式下第一轮执行直接答完时返回最终回复。
+        """
+        decision = planning_policy.decide(user_message)
+        tracing.current().set(planning=decision)
+        msg_user = {"role": "user", "content": user_message}
+
+        if decision == "skip":
+            logger.info("Phase 1: 简单请求，跳过规划")
+            planning_policy.record_saved("skipped")
+            self.conversation_history.append(msg_user)
+            self._save_message(msg_user)
+            return None
+
+        if decision == "speculative":
+            return await self._speculate(msg_user)
+
+        if decision == "cached":
+            logger.info("Phase 1: 命中计划缓存")
+            plan = planning_policy.lookup(user_message)
+            planning_policy.record_saved("cache_hits")
+        else:
+            logger.info("Phase 1: 规划中...")
+            plan = await self._create_plan(user_message)
+            planning_policy.remember(user_message, plan)
+
+        self._append_plan(msg_user, plan)
+        return None
+
+    def _append_plan(self, msg_user: dict, plan: str) -> None:
+        """用户消息 + 计划 + 开始执行，三条一起写进 history"""
+        self._emit("plan", text=plan)
+        msg_plan = {"role": "assistant", "content": f"我的执行计划：\n\n{plan}"}
+        msg_go = {"role": "user", "content": "好，请严格按照计划执行，完成后汇报最终结果。"}
+        self.conversation_history.append(msg_user)
+        self._save_message(msg_user)
+        self.conversation_history.append(msg_plan)
+        self._save_message(msg_plan)
+        self.conversation_history.append(msg_go)
+        self._save_message(msg_go)
+
+    async def _speculate(self, msg_user: dict) -> str | None:
+        """
+        投机规划：规划调用和不带计划的第一轮执行同时发出。
+
+        第一轮直接 end_turn → 取消规划，直接返回回复（省掉一整次规划往返）；
+        第一轮要调工具 → 丢弃这一轮，等计划出来后按计划正常执行。
+        投机轮的流式事件先缓存，确定采用后再转发，避免用户看到被丢弃的内容。
+        """
+        user_message = msg_user["content"]
+        logger.info("Phase 1: 投机执行（规划与第一轮并行）")
+        plan_task = asyncio.get_running_loop().create_task(self._create_plan(user_message))
+        # 被取消或出错后没人 await 的话，取走异常避免 "exception was never retrieved"
+        plan_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+        buffered = []
+        on_event = self._on_event
+        self._on_event = buffered.append
+        try:
+            response, response_text = await self._call_llm(self.conversation_history + [msg_user])
+        except Exception as e:
+            logger.warning(f"投机执行失败，改为按计划执行：{e}")
+            response = None
+        finally:
+            self._on_event = on_event
+
+        if response is not None and response.stop_reason == "end_turn":
+            plan_task.cancel()
+            planning_policy.record_saved("speculative_direct")
+            for event in buffered:
+                self._emit(event.pop("type"), **event)
+            msg_final = {"role": "assistant", "content": response.content}
+            self.conversation_history.append(msg_user)
+            self._save_message(msg_user)
+            self.conversation_history.append(msg_final)
+            self._save_message(msg_final)
+            return response_text
+
+        wasted = 0
+        if response is not None:
+            wasted = response.usage.input_tokens + response.usage.output_tokens
+        planning_policy.record_speculation_wasted(wasted)
+        plan = await plan_task
+        planning_policy.remember(user_message, plan)
+        self._append_plan(msg_user, plan)
+        return None
+
+    async def _create_plan(self, user_message: str) -> str:
         """规划阶段：不带工具的纯推理"""
         planning_messages = [{
             "role": "user",
@@ -290,75 +620,294 @@ class Agent:
         }]
 
         plan_text = ""
-        with self.client.messages.stream(
-            model=self.model,
-            max_tokens=512,
-            system=self._build_system_prompt() + "\n\n请将任务分解为清晰的执行步骤。只输出步骤列表，简洁明了，不执行任何操作。",
-            messages=planning_messages
-        ) as stream:
-            for text in stream.text_stream:
-                plan_text += text
+        system = self._system_blocks("请将任务分解为清晰的执行步骤。只输出步骤列表，简洁明了，不执行任何操作。")
+
+        async def attempt(route):
+            nonlocal plan_text
+            plan_text = ""
+            async with self.client.messages.stream(
+                model=route.model,
+                max_tokens=route.max_tokens,
+                system=system,
+                messages=planning_messages
+            ) as stream:
+                async for text in stream.text_stream:
+                    plan_text += text
+                return await stream.get_final_message()
+
+        start = time.perf_counter()
+        with tracing.span("plan"):
+            estimated = int(self._raw_estimate(planning_messages, system, []) * self.tokens.ratio)
+            final = await self._routed_call("plan", estimated, attempt)
+            self._record_usage("plan", final)
+        planning_policy.record_plan((time.perf_counter() - start) * 1000,
+                                    final.usage.input_tokens + final.usage.output_tokens)
         return plan_text
 
-    def _call_llm(self, messages: list):
+    async def _call_llm(self, messages: list):
         """调用 LLM（流式），返回 (response, 文字内容)"""
-        max_retries = 3
+        with tracing.span("llm") as span:
+            return await self._stream_llm(messages, span)
 
-        for attempt in range(max_retries):
-            try:
-                response_text = ""
-                with self.client.messages.stream(
-                    model=self.model,
-                    max_tokens=4096,
-                    system=self._build_system_prompt(),
-                    tools=get_all_tools(),
-                    messages=messages
-                ) as stream:
-                    for text in stream.text_stream:
-                        response_text += text
-                    response = stream.get_final_message()
-
-                return response, response_text
-
-            except anthropic_lib.RateLimitError:
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
-                else:
-                    raise
+    async def _stream_llm(self, messages: list, span):
+        """
+        一次执行轮次的请求。排队、限流、重试都交给 llm_scheduler：
+        429 / 连接错误 / 过载时由调度器按 Retry-After 和抖动退避后重新排队。
+        重试或升级时已经流式推出去的文字用 text_reset 事件撤回。
+        """
+        system = self._system_blocks()
+        tools = self._cached_tools()
+        with tracing.span("prepare"):
+            request_messages, estimated = await self._prepare_messages(messages, system, tools)
+        logger.info(f"输入约 {estimated} tokens，预算余量 {MAX_INPUT_TOKENS - estimated}")
+        span.set(estimated_input_tokens=estimated)
+
+        response_text = ""
+        attempts = 0
+
+        async def attempt(route):
+            nonlocal response_text, attempts
+            attempts += 1
+            span.set(attempts=attempts)
+            if response_text:
+                # 上一次尝试已经推出去的文字作废，调用方据此撤回，避免草稿和重做的回复拼在一起
+                self._emit("text_reset", chars=len(response_text))
+            response_text = ""
+            start = time.perf_counter()
+            async with self.client.messages.stream(
+                model=route.model,
+                max_tokens=route.max_tokens,
+                system=system,
+                tools=tools,
+                messages=self._with_cache_breakpoint(request_messages)
+            ) as stream:
+                async for text in stream.text_stream:
+                    if not response_text:
+                        span.event("first_token")
+                        tracing.observe("llm.ttft", (time.perf_counter() - start) * 1000)
+                    response_text += text
+                    self._emit("text_delta", text=text)
+                return await stream.get_final_message()
+
+        response = await self._routed_call("turn", estimated, attempt)
+        self._record_usage("turn", response)
+        span.set(stop_reason=response.stop_reason)
+        usage = response.usage
+        actual = (usage.input_tokens + (getattr(usage, "cache_read_input_tokens", None) or 0)
+                  + (getattr(usage, "cache_creation_input_tokens", None) or 0))
+        self.tokens.calibrate(self._raw_estimate(request_messages, system, tools), actual)
+        return response, response_text
+
+    async def _routed_call(self, kind: str, tokens: int, request):
+        """
+        按 model_router 选模型，经 llm_scheduler 排队发出 request(route)，返回最终的 Message。
 
-            except anthropic_lib.APIConnectionError:
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
-                else:
-                    raise
+        便宜档的调用失败或被 max_tokens 截断时，换 strong 档重做一次（MODEL_ESCALATE）。
+        执行轮次重做前会先发 text_reset 事件，撤回上一次已经推出去的文字（见 _stream_llm）。
+        每次请求的耗时（不含排队）、用量和费用按 (调用类型, 模型) 记在 model_router 里。
+        """
+        route = model_router.route(kind, self.mode)
+        while True:
+            tracing.current().set(model=route.model, max_tokens=route.max_tokens)
+            elapsed = None
+
+            async def timed():
+                nonlocal elapsed
+                start = time.perf_counter()
+                try:
+                    return await request(route)
+                finally:
+                    elapsed = (time.perf_counter() - start) * 1000
 
-            except (anthropic_lib.AuthenticationError, anthropic_lib.BadRequestError):
-                raise
+            try:
+                response = await llm_scheduler.call(self.session_id, kind, tokens, timed)
+            except anthropic_lib.APIError as e:
+                model_router.record(kind, route.model, elapsed, outcome="error")
+                stronger = model_router.escalate(kind, route, e)
+                if stronger is None:
+                    raise
+                logger.warning(f"[{kind}] {route.model} 调用失败（{type(e).__name__}），升级到 {stronger.model}")
+            else:
+                truncated = response.stop_reason == "max_tokens"
+                model_router.record(kind, route.model, elapsed, response.usage,
+                                    outcome="max_tokens" if truncated else "ok")
+                stronger = model_router.escalate(kind, route) if truncated else None
+                if stronger is None:
+                    return response
+                logger.warning(f"[{kind}] {route.model} 输出达到 max_tokens={route.max_tokens}，"
+                               f"升级到 {stronger.model}")
+                self._record_usage(kind, response)   # 被丢弃的这次也花了 token
+            model_router.record(kind, route.model, None, outcome="escalated")
+            tracing.current().event("escalate", model=stronger.model)
+            route = stronger
+
+    # ------------------------------------------------------------
+    # Prompt Caching
+    #
+    # 请求前缀的顺序是 tools → system → messages，最多 4 个断点：
+    #   1. 最后一个工具定义：缓存全部工具 schema
+    #   2. system prompt：缓存 工具 + system
+    #   3. 历史最后一条消息：滚动断点，下一轮请求会命中这一轮写入的前缀
+    # 断点每次请求时按当前 history 现算，_compact_history 替换历史后自动落在新位置。
+    # ------------------------------------------------------------
+
+    def _system_blocks(self, suffix: str = ""):
+        """system prompt 拆成 content block，稳定部分打缓存断点，suffix 放在断点之后"""
+        if not PROMPT_CACHING:
+            return self._build_system_prompt() + (f"\n\n{suffix}" if suffix else "")
+        blocks = [{"type": "text", "text": self._build_system_prompt(), "cache_control": CACHE_CONTROL}]
+        if suffix:
+            blocks.append({"type": "text", "text": suffix})
+        return blocks
+
+    def _cached_tools(self) -> list:
+        """工具列表，最后一个工具带缓存断点（复制一份，不改注册表里的 schema）"""
+        tools = get_all_tools()
+        if not PROMPT_CACHING or not tools:
+            return tools
+        return tools[:-1] + [{**tools[-1], "cache_control": CACHE_CONTROL}]
+
+    def _with_cache_breakpoint(self, messages: list) -> list:
+        """在最后一条消息的最后一个 content block 上打滚动断点（浅拷贝，不改 history）"""
+        if not PROMPT_CACHING or not messages:
+            return messages
+        last = self._serialize_message(messages[-1])
+        content = last.get("content")
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        if not content:
+            return messages
+        content = content[:-1] + [{**content[-1], "cache_control": CACHE_CONTROL}]
+        return messages[:-1] + [{**last, "content": content}]
+
+    # ------------------------------------------------------------
+    # 上下文预算
+    # ------------------------------------------------------------
+
+    def _raw_estimate(self, messages: list, system, tools: list) -> int:
+        """system + tools + messages 的校准前估算"""
+        fixed = estimate_text(json.dumps(system, ensure_ascii=False)) \
+            + estimate_text(json.dumps(tools, ensure_ascii=False))
+        return fixed + self.tokens.raw_total(messages)
+
+    async def _prepare_messages(self, messages: list, system, tools: list) -> tuple[list, int]:
+        """
+        生成本次请求实际发送的消息副本，返回 (messages, 估算输入 token 数)。
 
-    def _process_tool_calls(self, messages: list, response) -> None:
-        """处理工具调用（并行执行）"""
+        1. 较早的大 tool_result 截断（存在 blob_store 里的只读开头）
+        2. 仍超出 MAX_INPUT_TOKENS 时从最早的消息开始丢弃（指向被丢弃结果的去重引用换回原文）
+        3. 没被截断、也没被丢弃的 blob 引用换回完整正文
+        4. 开启 TOKEN_COUNT_EXACT 且估算接近上限时，用 count_tokens 接口取精确值再判断
+        """
+        # 截断旧结果要读 blob 开头、换回正文要读整个 blob，都在线程里做，不在事件循环上读文件
+        prepared = await asyncio.to_thread(
+            truncate_old_tool_results, messages, TOOL_RESULT_KEEP_RECENT, TOOL_RESULT_MAX_TOKENS)
+        fixed = int((self._raw_estimate([], system, tools)) * self.tokens.ratio)
+        prepared = self._fit_to_budget(prepared, MAX_INPUT_TOKENS - fixed)
+        estimated = int(self._raw_estimate(prepared, system, tools) * self.tokens.ratio)
+        prepared = await asyncio.to_thread(resolve_blobs, prepared)   # 剩下的 blob 引用换回正文
+
+        if TOKEN_COUNT_EXACT and estimated > MAX_INPUT_TOKENS * 0.9:
+            try:
+                counted = await self.client.messages.count_tokens(
+                    model=model_router.route("turn", self.mode).model, system=system, tools=tools,
+                    messages=[self._serialize_message(m) for m in prepared],
+                )
+                self.tokens.calibrate(self._raw_estimate(prepared, system, tools), counted.input_tokens)
+                estimated = counted.input_tokens
+                if estimated > MAX_INPUT_TOKENS:
+                    prepared = self._fit_to_budget(prepared, MAX_INPUT_TOKENS - fixed)
+                    estimated = int(self._raw_estimate(prepared, system, tools) * self.tokens.ratio)
+            except Exception as e:
+                logger.warning(f"count_tokens 失败，沿用估算值：{e}")
+
+        # 裁剪时产生的副本不在 history 里，清掉它们的缓存条目
+        self.tokens.prune(self.conversation_history)
+        return prepared, estimated
+
+    def _fit_to_budget(self, messages: list, budget: int) -> list:
+        """按预算丢掉最早的消息；留下的去重引用如果指向被丢掉的结果，换回原文"""
+        fitted = fit_to_budget(messages, self.tokens, budget)
+        return tool_cache.inline_references(fitted, messages[:len(messages) - len(fitted)])
+
+    def _record_usage(self, kind: str, response) -> None:
+        """累计本会话的 token 用量（含缓存读/写）并记日志"""
+        if kind != "compact":
+            self.llm_calls += 1
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        for key in self.usage:
+            self.usage[key] += getattr(usage, key, None) or 0
+        tracing.record_usage(kind, usage)
+        logger.info(
+            f"[{kind}] tokens in={usage.input_tokens} out={usage.output_tokens} "
+            f"cache_read={getattr(usage, 'cache_read_input_tokens', None) or 0} "
+            f"cache_write={getattr(usage, 'cache_creation_input_tokens', None) or 0}  "
+            f"会话累计 cache_read={self.usage['cache_read_input_tokens']} "
+            f"cache_write={self.usage['cache_creation_input_tokens']}"
+        )
+
+    async def _process_tool_calls(self, messages: list, response) -> None:
+        """处理工具调用（并行执行，放进 tool_pool.py 的共享执行池，按会话公平排队）"""
         msg_assistant = {"role": "assistant", "content": response.content}
         messages.append(msg_assistant)
         self._save_message(msg_assistant)
 
         tool_blocks = [b for b in response.content if b.type == "tool_use"]
 
-        results = {}
-
-        def run_tool(block):
-            return block.id, execute_tool(block.name, block.input)
-
-        with ThreadPoolExecutor(max_workers=len(tool_blocks)) as executor:
-            futures = {executor.submit(run_tool, block): block for block in tool_blocks}
-            for future in as_completed(futures):
-                tool_use_id, result = future.result()
-                results[tool_use_id] = result
-
-        tool_results = [
-            {"type": "tool_result", "tool_use_id": block.id, "content": results[block.id]}
-            for block in tool_blocks
-        ]
+        async def run_tool(block):
+            self._emit("tool_start", name=block.name, input=dict(block.input))
+            with tracing.span("tool", tool=block.name) as span:
+                try:
+                    result = await tool_pool.run(self.session_id, block.name, dict(block.input))
+                except asyncio.TimeoutError:
+                    result = f"错误：工具 {block.name} 执行超时，请缩小范围后重试"
+                    span.set(timeout=True)
+                span.set(result_chars=len(result) if isinstance(result, str) else 0)
+            self._emit("tool_end", name=block.name)
+            return result
+
+        results = await asyncio.gather(*(run_tool(block) for block in tool_blocks))
+
+        self._tool_round += 1
+        items = [{"type": "tool_result", "tool_use_id": block.id, "content": self._dedup_result(block, result)}
+                 for block, result in zip(tool_blocks, results)]
+        # 大结果正文进 blob_store，history 和会话文件里只留引用；写 blob 文件放到线程里
+        def externalize():
+            return [blob_store.externalize(item, estimate_text(item["content"])) for item in items]
+        if any(isinstance(item["content"], str) and len(item["content"]) >= blob_store.BLOB_MIN_BYTES
+               for item in items):
+            tool_results = await asyncio.to_thread(externalize)
+        else:
+            tool_results = externalize()
 
         msg_results = {"role": "user", "content": tool_results}
         messages.append(msg_results)
         self._save_message(msg_results)
+
+    def _dedup_result(self, block, result: str) -> str:
+        """本会话里出现过完全相同的结果时，换成一句引用，不再重复写进 history"""
+        if not isinstance(result, str) or len(result) < tool_cache.DEDUP_MIN_CHARS:
+            return result
+        digest = tool_cache.result_digest(block.name, dict(block.input), result)
+        seen = self._seen_results.get(digest)
+        if seen is not None:
+            logger.info(f"工具结果与第 {seen[0]} 轮相同，history 中以引用代替（省 {len(result)} 字符）")
+            tool_cache.dedup_stats["references"] += 1
+            tool_cache.dedup_stats["saved_chars"] += len(result)
+            return tool_cache.reference(*seen)
+        self._seen_results[digest] = (self._tool_round, block.id)
+        return result
+
+
+class Agent(AsyncAgent):
+    """
+    同步适配器：保留旧的阻塞式 run() 接口。
+
+    内部把 AsyncAgent.run() 提交到后台事件循环（runtime.py），
+    调用线程阻塞等待结果，适合脚本或线程模型的调用方。
+    """
+
+    def run(self, user_message: str, on_event=None) -> str:
+        return run_sync(AsyncAgent.run(self, user_message, on_event))
@@ -0,0 +1,1114 @@
+"""
+性能基准
+
+不调用真实 API：LLM 调用被替换成固定延迟的假实现，
+只测 mini-claw 自己的调度、会话和 I/O 开销。
+
+用法：
+    python bench.py sessions --counts 10 100 1000 --latency 0.2
+    python bench.py client --requests 50 --concurrency 10
+    python bench.py read_file --size-mb 128
+    python bench.py index --files 100000
+    python bench.py list_files --entries 100000
+    python bench.py persist --turns 2000
+    python bench.py store --messages 1000 10000 100000
+    python bench.py supervisor --workers 1 2 4 --sessions 64 --cpu-ms 5
+    python bench.py http --concurrency 16 64 256 --max-in-flight 32
+    python bench.py burst --sessions 50 --burst 4
+    python bench.py telegram --chats 20 --reply-chars 9000
+    python bench.py load --workloads code chat compaction many --channels gateway http telegram
+    python bench.py load --rate-limit-rate 0.05 --disconnect-rate 0.02 --replay ~/mini-claw/sessions
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from types import SimpleNamespace
+
+# 导入 gateway 前填好占位配置，避免 Telegram / Anthropic 客户端初始化失败
+os.environ.setdefault("ANTHROPIC_API_KEY", "bench")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+
+from anthropic.types import TextBlock
+
+BENCH_PATH = os.path.abspath(__file__)
+
+
+# ============================================================
+# 工具函数
+# ============================================================
+
+def rss_mb() -> float:
+    """当前进程常驻内存（MB），Linux 读 /proc，其他平台退化为峰值 RSS"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values: list, p: float) -> float:
+    """最近秩百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[k]
+
+
+def report(title: str, rows: list[dict]):
+    """打印对齐的结果表"""
+    if not rows:
+        return
+    print(f"\n== {title} ==")
+    headers = list(rows[0])
+    widths = {h: max(len(h), *(len(_fmt(r[h])) for r in rows)) for h in headers}
+    print("  ".join(h.rjust(widths[h]) for h in headers))
+    for r in rows:
+        print("  ".join(_fmt(r[h]).rjust(widths[h]) for h in headers))
+
+
+def _fmt(v) -> str:
+    return f"{v:.1f}" if isinstance(v, float) else str(v)
+
+
+def _burn(cpu_ms: float):
+    """占住 GIL 空转 cpu_ms 毫秒，模拟解析响应、序列化 history 这类 CPU 开销"""
+    end = time.perf_counter() + cpu_ms / 1000
+    while time.perf_counter() < end:
+        pass
+
+
+def install_fake_llm(latency: float, cpu_ms: float = 0.0, text: str = "ok"):
+    """
+    把 AsyncAgent 的 LLM 调用替换成 asyncio.sleep(latency)（可选再加 cpu_ms 的 CPU 开销）。
+    回复 text 较长时分成最多 8 段 text_delta，在 latency 内均匀推出（模拟流式输出）。
+    """
+    from agent import AsyncAgent
+    step = max(1, -(-len(text) // 8))
+    pieces = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+
+    async def _call_llm(self, messages):
+        for piece in pieces:
+            await asyncio.sleep(latency / len(pieces))
+            if len(pieces) > 1:
+                self._emit("text_delta", text=piece)
+        _burn(cpu_ms)
+        response = SimpleNamespace(stop_reason="end_turn", content=[TextBlock(type="text", text=text)])
+        self._record_usage("turn", response)
+        return response, text
+
+    async def _create_plan(self, user_message):
+        await asyncio.sleep(latency)
+        self._record_usage("plan", None)
+        return "1. 直接回答"
+
+    AsyncAgent._call_llm = _call_llm
+    AsyncAgent._create_plan = _create_plan
+
+
+# ============================================================
+# 场景：会话数增长
+# ============================================================
+
+def bench_sessions(counts: list[int], latency: float):
+    """N 个会话同时各发一条消息，记录内存、线程数和延迟分位数"""
+    install_fake_llm(latency)
+    import gateway
+    from runtime import run_sync
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def one(chat_id: int) -> float:
+        start = time.perf_counter()
+        await gateway.handle_message_async(chat_id, "你好")
+        return (time.perf_counter() - start) * 1000
+
+    async def burst(base: int, n: int) -> list[float]:
+        return await asyncio.gather(*(one(base + i) for i in range(n)))
+
+    rows = []
+    base = 0
+    baseline = rss_mb()
+    for n in counts:
+        start = time.perf_counter()
+        latencies = run_sync(burst(base, n))
+        elapsed = time.perf_counter() - start
+        base += n
+        rows.append({
+            "sessions": n,
+            "resident": len(gateway.sessions),
+            "evictions": gateway.sessions.evictions,
+            "threads": threading.active_count(),
+            "rss_mb": rss_mb(),
+            "rss_delta_mb": rss_mb() - baseline,
+            "msg/s": n / elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+        })
+    report(f"sessions (LLM 延迟 {latency * 1000:.0f}ms)", rows)
+
+
+# ============================================================
+# 场景：共享客户端 vs 每会话一个客户端
+# ============================================================
+
+def bench_client(requests: int, concurrency: int, latency: float):
+    """对本地假 API 发流式请求，对比连接复用和冷/热延迟"""
+    from fake_anthropic import FakeAnthropicServer
+
+    server = FakeAnthropicServer(latency=latency).start()
+    os.environ["ANTHROPIC_BASE_URL"] = server.url
+    from anthropic import AsyncAnthropic
+    import llm_client
+    from runtime import run_sync
+
+    async def call(client) -> float:
+        start = time.perf_counter()
+        async with client.messages.stream(
+            model="fake", max_tokens=16, messages=[{"role": "user", "content": "hi"}]
+        ) as stream:
+            async for _ in stream.text_stream:
+                pass
+        return (time.perf_counter() - start) * 1000
+
+    async def per_session_client() -> float:
+        # 旧行为：每个会话 new 一个客户端（独立连接池）
+        client = AsyncAnthropic(api_key="bench")
+        try:
+            return await call(client)
+        finally:
+            await client.close()
+
+    async def shared_client() -> float:
+        return await call(llm_client.get_async_client())
+
+    async def drive(fn) -> list[float]:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with sem:
+                return await fn()
+        return await asyncio.gather(*(one() for _ in range(requests)))
+
+    rows = []
+    for name, fn in [("per-session", per_session_client), ("shared", shared_client)]:
+        before = server.stats
+        first = run_sync(fn())
+        latencies = run_sync(drive(fn))
+        after = server.stats
+        rows.append({
+            "client": name,
+            "cold_ms": first,
+            "warm_p50_ms": percentile(latencies, 50),
+            "warm_p99_ms": percentile(latencies, 99),
+            "requests": after["requests"] - before["requests"],
+            "connections": after["connections"] - before["connections"],
+        })
+    report(f"client (并发 {concurrency}，服务端延迟 {latency * 1000:.0f}ms)", rows)
+    print(f"pool_stats: {llm_client.pool_stats()}")
+    server.stop()
+
+
+# ============================================================
+# 场景：大文件读取
+# ============================================================
+
+def bench_read_file(size_mb: int):
+    """生成大文本文件，对比整体读取和分块读取的延迟与内存"""
+    import gc
+    workspace = os.path.realpath(".")
+    os.environ["WORKSPACE_PATH"] = workspace
+    import tools
+
+    path = os.path.join(workspace, "big.log")
+    line = b"2024-01-01 12:00:00 INFO request handled in 12ms path=/api/v1/items id=123456\n"
+    with open(path, "wb") as f:
+        block = line * ((1 << 20) // len(line) + 1)
+        while f.tell() < size_mb << 20:
+            f.write(block)
+    total_lines = os.path.getsize(path) // len(line)
+
+    def legacy():
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    cases = [
+        ("legacy f.read()", legacy),
+        ("chunk 开头", lambda: tools.read_file(path)),
+        ("chunk 中间行", lambda: tools.read_file(path, start_line=total_lines // 2)),
+        ("chunk 末尾行", lambda: tools.read_file(path, start_line=total_lines - 10)),
+        ("chunk 字节偏移", lambda: tools.read_file(path, byte_offset=(size_mb << 20) // 2)),
+    ]
+    rows = []
+    for name, fn in cases:
+        gc.collect()
+        before = rss_mb()
+        start = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        rows.append({
+            "case": name,
+            "ms": elapsed,
+            "rss_delta_mb": rss_mb() - before,
+            "result_kb": len(result) / 1024,
+        })
+        del result
+    report(f"read_file ({size_mb}MB, {total_lines} 行)", rows)
+
+
+# ============================================================
+# 场景：工作区索引
+# ============================================================
+
+def bench_index(files: int, queries: int):
+    """生成 N 个小 Python 文件，测建索引、增量刷新和查询延迟，并和全量扫描对比"""
+    workspace = os.path.realpath("workspace")
+    for i in range(files):
+        d = os.path.join(workspace, f"pkg{i % 100}", f"mod{i % 1000 // 100}")
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, f"file_{i}.py"), "w") as f:
+            f.write(f"import os\n\nCONST_{i} = {i}\n\n\nclass Model{i}:\n"
+                    f"    def handle_{i}(self, value):\n        return helper_{i % 500}(value)\n\n\n"
+                    f"def helper_{i}(value):\n    return value * {i}\n")
+
+    from workspace_index import WorkspaceIndex
+    rows = []
+
+    def timed(name: str, fn, repeat: int = 1):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        rows.append({"case": name, "p50_ms": percentile(samples, 50), "p99_ms": percentile(samples, 99),
+                     "result": len(result) if isinstance(result, list) else result})
+
+    index = WorkspaceIndex(workspace, index_dir=os.path.realpath(".index"))
+    timed("冷启动建索引", lambda: index.refresh(force=True))
+    timed("无变化刷新", lambda: index.refresh(force=True))
+    for i in range(0, files, max(1, files // 10)):
+        path = os.path.join(workspace, f"pkg{i % 100}", f"mod{i % 1000 // 100}", f"file_{i}.py")
+        with open(path, "a") as f:
+            f.write("# touched\n")
+    timed("10 个文件变化后刷新", lambda: index.refresh(force=True))
+    timed("重新加载持久化索引", lambda: len(WorkspaceIndex(workspace, index_dir=os.path.realpath(".index")).files))
+
+    target = files // 2
+    timed("search_code 精确标识符", lambda: index.search(f"helper_{target}", max_results=20), queries)
+    timed("search_code 标识符片段", lambda: index.search(f"dle_{target}", max_results=20), queries)
+    timed("find_symbol", lambda: index.find_symbol(f"Model{target}"), queries)
+
+    def full_scan():
+        needle, hits = f"helper_{target}", []
+        for dirpath, _, names in os.walk(workspace):
+            for name in names:
+                with open(os.path.join(dirpath, name), encoding="utf-8") as f:
+                    for lineno, line in enumerate(f, 1):
+                        if needle in line:
+                            hits.append((name, lineno))
+        return hits
+    timed("对比：全量扫描 grep", full_scan)
+    report(f"index ({files} 个文件)", rows)
+
+
+# ============================================================
+# 场景：大目录列表
+# ============================================================
+
+def bench_list_files(entries: int):
+    """单个目录放 N 个文件，对比原来的 listdir + isdir + getsize 和 scandir 分页实现"""
+    workspace = os.path.realpath(".")
+    os.environ["WORKSPACE_PATH"] = workspace
+    os.environ["TOOL_CACHE"] = "0"   # 测的是遍历本身，不走结果缓存
+    import tools
+
+    big = os.path.join(workspace, "big_dir")
+    os.makedirs(big)
+    for i in range(entries):
+        with open(os.path.join(big, f"file_{i:06d}.txt"), "w") as f:
+            f.write("x" * (i % 100))
+
+    def legacy():
+        result = []
+        for entry in sorted(os.listdir(big)):
+            full_path = os.path.join(big, entry)
+            if os.path.isdir(full_path):
+                result.append(f"  [目录] {entry}/")
+            else:
+                result.append(f"  [文件] {entry} ({os.path.getsize(full_path)} bytes)")
+        return f"目录 {big} 的内容：\n" + "\n".join(result)
+
+    def all_pages():
+        pages, cursor, total = 0, None, 0
+        while True:
+            out = tools.list_files(big, page_size=tools.LIST_PAGE_SIZE * 10, cursor=cursor)
+            pages += 1
+            total += len(out)
+            if 'cursor="' not in out:
+                return f"{pages} 页 / {total // 1024} KB"
+            cursor = out.rsplit('cursor="', 1)[1].rstrip('"')
+
+    middle = f"file_{entries // 2:06d}.txt"
+    cases = [
+        ("legacy listdir 全量", legacy),
+        ("scandir 第一页", lambda: tools.list_files(big)),
+        ("scandir 游标续页（中间）", lambda: tools.list_files(big, cursor=middle)),
+        ("scandir pattern 过滤", lambda: tools.list_files(big, pattern="file_0000*")),
+        ("scandir 翻完所有页", all_pages),
+    ]
+    rows = []
+    for name, fn in cases:
+        samples = []
+        for _ in range(3):
+            start = time.perf_counter()
+            result = fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        rows.append({"case": name, "p50_ms": percentile(samples, 50),
+                     "result": result if name.endswith("所有页") else f"{len(result) // 1024} KB"})
+    report(f"list_files ({entries} 个条目)", rows)
+
+
+# ============================================================
+# 场景：会话持久化
+# ============================================================
+
+def bench_persist(turns: int, per_turn: int):
+    """每轮写 per_turn 条消息：原来的逐条 open/append/close vs SessionFile 各种落盘策略"""
+    from session_log import SessionFile
+    line = '{"role": "assistant", "content": [{"type": "text", "text": "%s"}]}\n' % ("x" * 400)
+
+    def legacy(path):
+        for _ in range(turns):
+            for _ in range(per_turn):
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(line)
+
+    def buffered(durability):
+        def run(path):
+            log = SessionFile(path, durability=durability)
+            for _ in range(turns):
+                for _ in range(per_turn):
+                    log.append(line)
+                log.flush()
+            log.close()
+            return log
+        return run
+
+    cases = [("legacy 逐条 open/close", legacy)] + [
+        (f"SessionFile durability={d}", buffered(d)) for d in ("none", "turn", "message")
+    ]
+    rows = []
+    for i, (name, fn) in enumerate(cases):
+        path = os.path.join("sessions", f"bench_{i}.jsonl")
+        os.makedirs("sessions", exist_ok=True)
+        start = time.perf_counter()
+        log = fn(path)
+        elapsed = time.perf_counter() - start
+        rows.append({
+            "case": name,
+            "msg/s": turns * per_turn / elapsed,
+            "turn/s": turns / elapsed,
+            "writes": log.writes if log else turns * per_turn,
+            "fsyncs": log.fsyncs if log else 0,
+            "mb": os.path.getsize(path) / (1 << 20),
+        })
+    report(f"persist ({turns} 轮 × {per_turn} 条消息，单会话)", rows)
+
+
+# ============================================================
+# 场景：会话存储冷加载
+# ============================================================
+
+def bench_store(counts: list[int]):
+    """
+    N 条消息的会话，冷启动（新建 AsyncAgent）加载耗时：jsonl vs sqlite。
+    另测 sqlite 里 N 条已被压缩归档、只剩 200 条当前历史的情况（只读最后一次压缩之后的行）。
+    """
+    import agent as agent_module
+    from agent import AsyncAgent
+    from session_store import JsonlStore, SqliteStore
+
+    def message(i: int) -> str:
+        if i % 3 == 2:
+            body = {"role": "user", "content": [
+                {"type": "tool_result", "tool_use_id": f"toolu_{i}", "content": "def f():\n    pass\n" * 40}]}
+        elif i % 3 == 1:
+            body = {"role": "assistant", "content": [
+                {"type": "text", "text": "看一下这个文件"},
+                {"type": "tool_use", "id": f"toolu_{i + 1}", "name": "read_file", "input": {"path": f"src/m{i}.py"}}]}
+        else:
+            body = {"role": "user", "content": f"第 {i} 条消息：帮我看看这个函数"}
+        return json.dumps(body, ensure_ascii=False) + "\n"
+
+    def cold_load(store, session_id: str) -> float:
+        agent_module.get_store = lambda: store
+        start = time.perf_counter()
+        a = AsyncAgent(session_id)
+        elapsed = (time.perf_counter() - start) * 1000
+        assert a.conversation_history
+        return elapsed
+
+    rows = []
+    for n in counts:
+        lines = [message(i) for i in range(n)]
+        jsonl = JsonlStore(directory=f"jsonl_{n}")
+        jsonl.rewrite("s", lines)
+        sqlite = SqliteStore(path=f"sqlite_{n}.db")
+        sqlite.rewrite("s", lines)
+        sqlite.rewrite("compacted", lines)
+        sqlite.rewrite("compacted", lines[-200:])
+        rows.append({
+            "messages": n,
+            "jsonl_ms": cold_load(jsonl, "s"),
+            "sqlite_ms": cold_load(sqlite, "s"),
+            "sqlite_compacted_ms": cold_load(sqlite, "compacted"),
+            "jsonl_mb": os.path.getsize(os.path.join(f"jsonl_{n}", "s.jsonl")) / (1 << 20),
+            # 库里有两个会话（s 和 compacted），WAL 里还没 checkpoint 的部分也算上
+            "sqlite_mb": sum(os.path.getsize(p) for p in (f"sqlite_{n}.db", f"sqlite_{n}.db-wal")
+                             if os.path.exists(p)) / (1 << 20),
+        })
+    report("store 冷加载（新建 AsyncAgent）", rows)
+
+
+# ============================================================
+# 场景：多进程 supervisor
+# ============================================================
+
+def _supervisor_worker_init(latency: float, cpu_ms: float):
+    """worker 进程里装上假 LLM（Supervisor 的 initializer，必须是模块级函数才能传给 spawn 的子进程）"""
+    logging.basicConfig(level=logging.WARNING)
+    install_fake_llm(latency, cpu_ms)
+
+
+def bench_supervisor(worker_counts: list[int], sessions: int, messages: int, latency: float, cpu_ms: float):
+    """
+    sessions 个会话并发、每个串行发 messages 条消息，经 Supervisor 路由到 N 个 worker 进程。
+    每次 LLM 调用有 cpu_ms 的 CPU 开销：单进程受 GIL 限制，吞吐上限约 1000 / cpu_ms msg/s，
+    多进程时随核数增长（本机核数见表头）。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from supervisor import Supervisor
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rows = []
+    for n in worker_counts:
+        sup = Supervisor(n, initializer=_supervisor_worker_init, initargs=(latency, cpu_ms)).start()
+        # 预热：让每个 worker 都完成 import
+        for chat_id in range(n * 8):
+            sup.handle_message(chat_id, "/start")
+        warmup = list(sup.routed)
+
+        def session(chat_id: int) -> list[float]:
+            latencies = []
+            for i in range(messages):
+                start = time.perf_counter()
+                sup.handle_message(chat_id, f"第 {i} 条消息")
+                latencies.append((time.perf_counter() - start) * 1000)
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as ex:
+            latencies = [ms for result in ex.map(session, range(1000, 1000 + sessions)) for ms in result]
+        elapsed = time.perf_counter() - start
+        stats = sup.stats()
+        sup.stop()
+        rows.append({
+            "workers": n,
+            "msg/s": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+            "routed": "/".join(str(r - w) for r, w in zip(stats["routed"], warmup)),
+        })
+    report(f"supervisor ({sessions} 会话 × {messages} 条，LLM 延迟 {latency * 1000:.0f}ms + CPU {cpu_ms:.0f}ms，"
+           f"本机 {os.cpu_count()} 核)", rows)
+
+
+# ============================================================
+# 场景：连发消息合并
+# ============================================================
+
+def bench_burst(sessions: int, burst: int, gap_ms: float, latency: float, window: float):
+    """
+    sessions 个会话，每个连发 burst 条消息（间隔 gap_ms），对比合并关 / 开时
+    run() 次数、LLM 调用次数和最后一条消息的回复延迟。
+    """
+    install_fake_llm(latency)
+    import gateway
+    from runtime import run_sync
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def user(chat_id: int) -> list[float]:
+        async def send(i: int) -> float:
+            await asyncio.sleep(i * gap_ms / 1000)
+            start = time.perf_counter()
+            await gateway.handle_message_async(chat_id, f"第 {i} 段：补充一点需求")
+            return (time.perf_counter() - start) * 1000
+        return await asyncio.gather(*(send(i) for i in range(burst)))
+
+    async def run_all(base: int) -> list[float]:
+        results = await asyncio.gather(*(user(base + i) for i in range(sessions)))
+        return [ms for r in results for ms in r]
+
+    rows = []
+    for base, coalesce in ((0, False), (100000, True)):
+        gateway.SESSION_COALESCE = coalesce
+        gateway.SESSION_COALESCE_WINDOW = window
+        before = dict(gateway.coalesce_stats)
+        start = time.perf_counter()
+        latencies = run_sync(run_all(base))
+        elapsed = time.perf_counter() - start
+        calls = sum(gateway.sessions.get(base + i).llm_calls for i in range(sessions))
+        after = gateway.coalesce_stats
+        rows.append({
+            "coalesce": "on" if coalesce else "off",
+            "messages": sessions * burst,
+            "runs": sessions * burst - (after["merged_messages"] - before["merged_messages"]),
+            "llm_calls": calls,
+            "saved_est": after["saved_llm_calls"] - before["saved_llm_calls"],
+            "wall_s": elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+        })
+    report(f"burst ({sessions} 会话 × 连发 {burst} 条，间隔 {gap_ms:.0f}ms，"
+           f"LLM 延迟 {latency * 1000:.0f}ms，合并窗口 {window:.1f}s)", rows)
+
+
+# ============================================================
+# 场景：Telegram 接收并发
+# ============================================================
+
+def bench_telegram(chats: int, latency: float, reply_chars: int, chat_rate: float):
+    """
+    本地假 Bot API + 假 LLM：chats 个聊天几乎同时各发一条消息，
+    对比阻塞模式（telebot handler 线程里等回复）和并发模式（轮询线程只分发）的端到端延迟。
+    假服务器按 chat_rate 对单个聊天限流，检查长回复分段发送时 429 的次数。
+    """
+    from fake_telegram import FakeTelegramServer
+    server = FakeTelegramServer(chat_rate=chat_rate).start()
+    os.environ["TELEGRAM_API_URL"] = server.url
+    install_fake_llm(latency, text="x" * reply_chars)
+    import gateway
+    import telegram_channel
+    import telebot
+    from telebot import apihelper
+    logging.getLogger().setLevel(logging.WARNING)
+    apihelper.API_URL = server.url + "/bot{0}/{1}"
+    telegram_channel.is_authorized = lambda message: True   # 假服务器上每个聊天都放行
+    chunks = len(telegram_channel.split_message("x" * reply_chars))
+
+    rows = []
+    base = 0
+    for concurrent in (False, True):
+        telegram_channel.TELEGRAM_CONCURRENT = concurrent
+        telegram_channel.bot = telebot.TeleBot(os.environ["TELEGRAM_BOT_TOKEN"])   # stop_polling 之后不能再次轮询
+        thread = threading.Thread(target=telegram_channel.start_polling,
+                                  args=(gateway.handle_message, gateway.submit_message), daemon=True)
+        thread.start()
+
+        ids = range(base, base + chats)
+        before = dict(server.stats)
+        limited_before = telegram_channel.stats["rate_limited"]
+        pushed = {}
+        start = time.perf_counter()
+        for chat_id in ids:
+            pushed[chat_id] = time.perf_counter()
+            server.push(chat_id, "你好")
+
+        last_chunk = telegram_channel.split_message("x" * reply_chars)[-1]
+
+        def complete(s) -> bool:
+            # 每个聊天都已看到回复的最后一段
+            return all(any(e["text"] == last_chunk for e in s.sent(c)) for c in ids)
+        finished = server.wait_for(complete, timeout=chats * latency * 2 + 60)
+        elapsed = time.perf_counter() - start
+
+        last = {}
+        for e in server.sent():
+            if e["chat_id"] in pushed:
+                last[e["chat_id"]] = e["t"]
+        latencies = [(last[c] - pushed[c]) * 1000 for c in ids if c in last]
+        telegram_channel.bot.stop_polling()
+        thread.join(timeout=30)
+        rows.append({
+            "mode": "concurrent" if concurrent else "blocking",
+            "done": "yes" if finished else "timeout",
+            "wall_s": elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+            "sent": server.stats["sent"] - before["sent"],
+            "edited": server.stats["edited"] - before["edited"],
+            "typing": server.stats["typing"] - before["typing"],
+            "429": telegram_channel.stats["rate_limited"] - limited_before,
+            "threads": threading.active_count(),
+        })
+        base += chats
+    report(f"telegram ({chats} 个聊天各发 1 条，LLM 延迟 {latency * 1000:.0f}ms，"
+           f"回复 {reply_chars} 字符 = {chunks} 段，假服务器单聊天限流 {chat_rate:g} 条/秒)", rows)
+    server.stop()
+
+
+# ============================================================
+# 场景：HTTP 频道饱和压测
+# ============================================================
+
+def bench_http(concurrencies: list[int], requests: int, sessions: int, latency: float,
+               max_in_flight: int, timeout: float):
+    """
+    HTTP 频道 + gateway + 假 LLM 全链路压测。客户端并发超过 max_in_flight 后，
+    多出来的请求应该快速拿到 503 / 429，而不是全部排队拖慢所有人。
+    """
+    import socket
+    import urllib.request
+    import urllib.error
+    from concurrent.futures import ThreadPoolExecutor
+
+    os.environ["HTTP_MAX_IN_FLIGHT"] = str(max_in_flight)
+    os.environ["HTTP_REQUEST_TIMEOUT"] = str(timeout)
+    install_fake_llm(latency)
+    import gateway
+    import http_channel
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    gateway.get_loop()
+    http_channel.start_http(gateway.handle_message, port=port)
+    url = f"http://127.0.0.1:{port}/message"
+    for _ in range(50):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    def one(i: int):
+        body = json.dumps({"chat_id": i % sessions, "text": "你好"}).encode()
+        req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=timeout + 30) as resp:
+                resp.read()
+                status = resp.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = "conn_err"
+        return status, (time.perf_counter() - start) * 1000
+
+    rows = []
+    for c in concurrencies:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=c) as ex:
+            results = list(ex.map(one, range(requests)))
+        elapsed = time.perf_counter() - start
+        ok = [ms for status, ms in results if status == 200]
+        codes = {}
+        for status, _ in results:
+            codes[status] = codes.get(status, 0) + 1
+        rows.append({
+            "concurrency": c,
+            "req/s": requests / elapsed,
+            "ok": codes.pop(200, 0),
+            "503": codes.pop(503, 0),
+            "429": codes.pop(429, 0),
+            "504": codes.pop(504, 0),
+            "other": sum(codes.values()),
+            "ok_p50_ms": percentile(ok, 50),
+            "ok_p95_ms": percentile(ok, 95),
+            "ok_p99_ms": percentile(ok, 99),
+            "all_p99_ms": percentile([ms for _, ms in results], 99),
+        })
+    report(f"http ({requests} 请求 / {sessions} 会话，LLM 延迟 {latency * 1000:.0f}ms，"
+           f"在途上限 {max_in_flight}，超时 {timeout:.0f}s)", rows)
+
+
+# ============================================================
+# 场景：整条链路压测（假 Messages API + 真实 agent 循环）
+#
+# 和上面几个场景不同，这里不替换 AsyncAgent 的方法：LLM 请求真的发到本地的
+# fake_anthropic 服务器（SSE 流式、tool_use、按 token 速率输出、注入 429 / 断连），
+# 工具真的在临时工作区里执行。每个 (workload, channel) 组合跑在一个新的子进程里，
+# RSS 和线程数互不影响；假 API 服务器在父进程里，不计入被测进程。
+# ============================================================
+
+# workload → 假 API 的行为 + 子进程的环境变量
+LOAD_WORKLOADS = {
+    "code": {"tool_rounds": 1, "output_tokens": 150, "env": {}},
+    "chat": {"tool_rounds": 0, "output_tokens": 80, "env": {}},
+    "compaction": {"tool_rounds": 1, "output_tokens": 600, "env": {"COMPACT_TOKEN_THRESHOLD": "3000"}},
+    "many": {"tool_rounds": 0, "output_tokens": 40, "env": {}},
+}
+
+
+def _synthetic_conversations(workload: str, sessions: int, turns: int) -> list[list[str]]:
+    """内置的对话脚本：code 的请求足够长会触发规划，chat 先切换模式再闲聊"""
+    conversations = []
+    for i in range(sessions):
+        if workload == "chat":
+            texts = ["/chat"] + [f"随便聊聊，第 {t} 句" for t in range(turns)]
+        elif workload == "many":
+            texts = [f"你好 {t}" for t in range(turns)]
+        else:
+            texts = [f"请看一下工作区的目录结构，找到和第 {t} 个模块相关的文件，"
+                     f"分析它们之间的依赖关系，并给出重构建议（会话 {i}）" for t in range(turns)]
+        conversations.append(texts)
+    return conversations
+
+
+def _recorded_conversations(directory: str, limit: int) -> list[list[str]]:
+    """从会话目录（sessions/<id>.jsonl）里取出用户真正发过的消息，按会话回放"""
+    from agent import SUMMARY_PREFIX
+    conversations = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".jsonl"):
+            continue
+        texts = []
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    m = json.loads(line)
+                except ValueError:
+                    continue
+                content = m.get("content")
+                if m.get("role") != "user" or not isinstance(content, str):
+                    continue
+                if content.startswith(SUMMARY_PREFIX) or content.startswith("好，请严格按照计划执行"):
+                    continue
+                texts.append(content)
+        if texts:
+            conversations.append(texts)
+        if len(conversations) >= limit:
+            break
+    return conversations
+
+
+class _Sampler:
+    """后台每 50ms 采一次线程数和 RSS，记峰值"""
+
+    def __init__(self):
+        self.peak_threads = threading.active_count()
+        self.peak_rss = rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.wait(0.05):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss = max(self.peak_rss, rss_mb())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _load_senders(channel: str):
+    """返回 send(chat_id, text) -> (是否成功, 回复)，三种入口走的都是同一个 gateway"""
+    import gateway
+
+    if channel == "gateway":
+        def send(chat_id: int, text: str):
+            reply = gateway.handle_message(chat_id, text)
+            return not reply.startswith("[错误]"), reply
+        return send
+
+    if channel == "http":
+        import urllib.request
+        import urllib.error
+        from http_channel import start_http
+        port = _free_port()
+        start_http(gateway.handle_message, port=port)
+        url = f"http://127.0.0.1:{port}/message"
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+        def send(chat_id: int, text: str):
+            req = urllib.request.Request(url, data=json.dumps({"chat_id": chat_id, "text": text}).encode(),
+                                         headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(req, timeout=300) as resp:
+                    reply = json.loads(resp.read())["reply"]
+                return not reply.startswith("[错误]"), reply
+            except urllib.error.HTTPError as e:
+                return False, f"HTTP {e.code}"
+            except OSError as e:
+                return False, str(e)
+        return send
+
+    if channel == "telegram":
+        import telegram_channel
+        from fake_telegram import FakeTelegramServer
+        from telebot import apihelper
+        server = FakeTelegramServer().start()
+        apihelper.API_URL = server.url + "/bot{0}/{1}"
+        telegram_channel.TELEGRAM_STREAMING = False   # 每条回复正好一条 sendMessage，便于对账
+        telegram_channel.is_authorized = lambda message: True
+        threading.Thread(target=telegram_channel.start_polling,
+                         args=(gateway.handle_message, gateway.submit_message), daemon=True).start()
+        sent_counts: dict[int, int] = {}
+
+        def send(chat_id: int, text: str):
+            expected = sent_counts.get(chat_id, 0) + 1
+            sent_counts[chat_id] = expected
+            server.push(chat_id, text)
+            ok = server.wait_for(lambda s: len(s.sent(chat_id)) >= expected, timeout=300)
+            reply = server.sent(chat_id)[expected - 1]["text"] if ok else "[超时]"
+            return ok and not reply.startswith("[错误]"), reply
+        return send
+
+    raise ValueError(f"未知 channel: {channel}")
+
+
+def bench_load_one(channel: str, workload: str, sessions: int, turns: int, concurrency: int,
+                   replay: str | None):
+    """子进程：跑一个 (workload, channel) 组合，最后一行输出 RESULT {json}"""
+    from concurrent.futures import ThreadPoolExecutor
+    workspace = os.path.abspath("workspace")
+    for d in range(5):
+        os.makedirs(os.path.join(workspace, f"pkg{d}"), exist_ok=True)
+        for f in range(20):
+            with open(os.path.join(workspace, f"pkg{d}", f"mod{f}.py"), "w") as fh:
+                fh.write(f"def f{f}():\n    return {f}\n")
+    os.environ["WORKSPACE_PATH"] = workspace
+    for key, value in LOAD_WORKLOADS[workload]["env"].items():
+        os.environ[key] = value
+
+    conversations = (_recorded_conversations(replay, sessions) if replay
+                     else _synthetic_conversations(workload, sessions, turns))
+    send = _load_senders(channel)
+    import tracing
+    import model_router
+    logging.getLogger().setLevel(logging.ERROR)
+    base_rss = rss_mb()
+
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def converse(item):
+        nonlocal errors
+        chat_id, texts = item
+        for text in texts:
+            start = time.perf_counter()
+            ok, _ = send(chat_id, text)
+            ms = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(ms)
+                errors += 0 if ok else 1
+
+    with _Sampler() as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as ex:
+            list(ex.map(converse, enumerate(conversations, start=1)))
+        elapsed = time.perf_counter() - start
+        time.sleep(0.2)   # 让回复后启动的后台压缩也被采样到
+
+    stages = tracing.stage_latency
+    result = {
+        "messages": len(latencies),
+        "msg/s": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "errors": errors,
+        "threads": sampler.peak_threads,
+        "rss_mb": sampler.peak_rss,
+        "rss_growth_mb": sampler.peak_rss - base_rss,
+        "ttft_p50_ms": stages["llm.ttft"].percentile(50) if "llm.ttft" in stages else 0.0,
+        "tools": stages["tool"].count if "tool" in stages else 0,
+        "compactions": stages["compaction"].count if "compaction" in stages else 0,
+        "escalated": sum(n for (_, _, outcome), n in model_router.outcomes.items() if outcome == "escalated"),
+        "cost_usd": round(sum(model_router.cost.values()), 4),
+    }
+    print("RESULT " + json.dumps(result), flush=True)
+
+
+def bench_load(workloads: list[str], channels: list[str], sessions: int, turns: int, concurrency: int,
+               latency: float, tokens_per_sec: float, rate_limit_rate: float, disconnect_rate: float,
+               replay: str | None):
+    """
+    父进程：起假 Messages API，每个 (workload, channel) 组合开一个子进程压测，汇总成一张表。
+    llm_req / 429 / disconn 来自假服务器，是这个组合期间实际收到的请求和注入的故障数。
+    """
+    from fake_anthropic import FakeAnthropicServer
+    server = FakeAnthropicServer(latency=latency, tokens_per_sec=tokens_per_sec,
+                                 rate_limit_rate=rate_limit_rate, disconnect_rate=disconnect_rate,
+                                 seed=0).start()
+    rows = []
+    for workload in workloads:
+        for channel in channels:
+            spec = LOAD_WORKLOADS[workload]
+            server.tool_rounds = spec["tool_rounds"]
+            server.output_tokens = spec["output_tokens"]
+            n_sessions = sessions * 10 if workload == "many" else sessions
+            before = server.stats
+            env = {**os.environ, "ANTHROPIC_BASE_URL": server.url, "ANTHROPIC_API_KEY": "bench"}
+            cmd = [sys.executable, BENCH_PATH, "load-one", "--channel", channel, "--workload", workload,
+                   "--sessions", str(n_sessions), "--turns", str(turns), "--concurrency", str(concurrency)]
+            if replay:
+                cmd += ["--replay", os.path.abspath(replay)]
+            proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+            result_lines = [line for line in proc.stdout.splitlines() if line.startswith("RESULT ")]
+            if not result_lines:
+                print(f"[{workload}/{channel}] 子进程失败：\n{proc.stderr[-2000:]}")
+                continue
+            after = server.stats
+            rows.append({
+                "workload": workload,
+                "channel": channel,
+                **json.loads(result_lines[-1][len("RESULT "):]),
+                "llm_req": after["requests"] - before["requests"],
+                "429": after["rate_limited"] - before["rate_limited"],
+                "disconn": after["disconnects"] - before["disconnects"],
+            })
+    server.stop()
+    report(f"load ({sessions} 会话 × {turns} 轮（many ×10 会话），并发 {concurrency}，"
+           f"首 token {latency * 1000:.0f}ms，{tokens_per_sec:g} tokens/s，"
+           f"注入 429 {rate_limit_rate:.0%} / 断连 {disconnect_rate:.0%}）", rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mini-claw 性能基准")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    p = sub.add_parser("sessions", help="并发会话数增长时的内存与延迟")
+    p.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000])
+    p.add_argument("--latency", type=float, default=0.2, help="假 LLM 每次调用的延迟（秒）")
+
+    p = sub.add_parser("client", help="共享连接池 vs 每会话一个客户端")
+    p.add_argument("--requests", type=int, default=50)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.add_argument("--latency", type=float, default=0.01, help="假 API 每次请求的延迟（秒）")
+
+    p = sub.add_parser("read_file", help="大文件整体读取 vs 分块读取")
+    p.add_argument("--size-mb", type=int, default=128)
+
+    p = sub.add_parser("index", help="工作区索引建立、增量刷新与查询延迟")
+    p.add_argument("--files", type=int, default=100000)
+    p.add_argument("--queries", type=int, default=20)
+
+    p = sub.add_parser("list_files", help="大目录：listdir 全量 vs scandir 分页")
+    p.add_argument("--entries", type=int, default=100000)
+
+    p = sub.add_parser("persist", help="会话文件写入：逐条 open/close vs 按轮批量写")
+    p.add_argument("--turns", type=int, default=2000)
+    p.add_argument("--per-turn", type=int, default=5)
+
+    p = sub.add_parser("store", help="会话存储冷加载：jsonl vs sqlite")
+    p.add_argument("--messages", type=int, nargs="+", default=[1000, 10000, 100000])
+
+    p = sub.add_parser("supervisor", help="多进程 supervisor：吞吐随 worker 数的变化")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--sessions", type=int, default=64)
+    p.add_argument("--messages", type=int, default=20)
+    p.add_argument("--latency", type=float, default=0.05, help="假 LLM 每次调用的延迟（秒）")
+    p.add_argument("--cpu-ms", type=float, default=5.0, help="假 LLM 每次调用的 CPU 开销（毫秒）")
+
+    p = sub.add_parser("burst", help="连发消息合并：省下的 run() / LLM 调用与回复延迟")
+    p.add_argument("--sessions", type=int, default=50)
+    p.add_argument("--burst", type=int, default=4)
+    p.add_argument("--gap-ms", type=float, default=300, help="同一会话相邻两条消息的间隔（毫秒）")
+    p.add_argument("--latency", type=float, default=0.5, help="假 LLM 每次调用的延迟（秒）")
+    p.add_argument("--window", type=float, default=1.0, help="SESSION_COALESCE_WINDOW（秒）")
+
+    p = sub.add_parser("telegram", help="Telegram 接收：阻塞 handler vs 并发分发（本地假 Bot API）")
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--latency", type=float, default=1.0, help="假 LLM 每次调用的延迟（秒）")
+    p.add_argument("--reply-chars", type=int, default=9000, help="每条回复的长度（超过 4096 会分段）")
+    p.add_argument("--chat-rate", type=float, default=1.0, help="假服务器单聊天限流（条/秒，0 不限）")
+
+    p = sub.add_parser("load", help="整条链路压测：假 Messages API + 真实 agent 循环，按 workload × channel 出表")
+    p.add_argument("--workloads", nargs="+", default=["code", "chat", "compaction", "many"],
+                   choices=sorted(LOAD_WORKLOADS))
+    p.add_argument("--channels", nargs="+", default=["gateway", "http", "telegram"],
+                   choices=["gateway", "http", "telegram"])
+    p.add_argument("--sessions", type=int, default=20)
+    p.add_argument("--turns", type=int, default=3)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--latency", type=float, default=0.1, help="假 API 的首 token 延迟（秒）")
+    p.add_argument("--tokens-per-sec", type=float, default=1000, help="假 API 的输出速度")
+    p.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回 429 的概率")
+    p.add_argument("--disconnect-rate", type=float, default=0.0, help="直接断开连接的概率")
+    p.add_argument("--replay", help="回放这个会话目录（sessions/*.jsonl）里的真实对话，代替内置脚本")
+
+    p = sub.add_parser("load-one", help=argparse.SUPPRESS)
+    p.add_argument("--channel", required=True)
+    p.add_argument("--workload", required=True)
+    p.add_argument("--sessions", type=int, required=True)
+    p.add_argument("--turns", type=int, required=True)
+    p.add_argument("--concurrency", type=int, required=True)
+    p.add_argument("--replay")
+
+    p = sub.add_parser("http", help="HTTP 频道饱和压测：在途上限、429/503 与延迟分位数")
+    p.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256])
+    p.add_argument("--requests", type=int, default=1000)
+    p.add_argument("--sessions", type=int, default=200)
+    p.add_argument("--latency", type=float, default=0.2, help="假 LLM 每次调用的延迟（秒）")
+    p.add_argument("--max-in-flight", type=int, default=32)
+    p.add_argument("--timeout", type=float, default=10.0, help="HTTP_REQUEST_TIMEOUT（秒）")
+
+    args = parser.parse_args()
+
+    # 会话文件写到临时目录，不污染工作区
+    os.chdir(tempfile.mkdtemp(prefix="mini-claw-bench-"))
+
+    if args.scenario == "sessions":
+        bench_sessions(args.counts, args.latency)
+    elif args.scenario == "client":
+        bench_client(args.requests, args.concurrency, args.latency)
+    elif args.scenario == "read_file":
+        bench_read_file(args.size_mb)
+    elif args.scenario == "index":
+        bench_index(args.files, args.queries)
+    elif args.scenario == "list_files":
+        bench_list_files(args.entries)
+    elif args.scenario == "persist":
+        bench_persist(args.turns, args.per_turn)
+    elif args.scenario == "store":
+        bench_store(args.messages)
+    elif args.scenario == "supervisor":
+        bench_supervisor(args.workers, args.sessions, args.messages, args.latency, args.cpu_ms)
+    elif args.scenario == "burst":
+        bench_burst(args.sessions, args.burst, args.gap_ms, args.latency, args.window)
+    elif args.scenario == "telegram":
+        bench_telegram(args.chats, args.latency, args.reply_chars, args.chat_rate)
+    elif args.scenario == "load":
+        bench_load(args.workloads, args.channels, args.sessions, args.turns, args.concurrency,
+                   args.latency, args.tokens_per_sec, args.rate_limit_rate, args.disconnect_rate, args.replay)
+    elif args.scenario == "load-one":
+        bench_load_one(args.channel, args.workload, args.sessions, args.turns, args.concurrency, args.replay)
+    elif args.scenario == "http":
+        bench_http(args.concurrency, args.requests, args.sessions, args.latency,
+                   args.max_in_flight, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
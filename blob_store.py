@@ -0,0 +1,212 @@
+"""
+大 tool_result 的内容寻址存储
+
+一次 read_file 的结果可能有几十上百 KB，原来原样放在 conversation_history 里：
+常驻内存一份，每次保存写一份，压缩重写再写一份，同一个文件读几次就存几份。
+
+超过 BLOB_MIN_BYTES 的 tool_result 正文按 sha256 存成 BLOB_DIR 下的一个文件（相同内容只存一份），
+history 和会话文件里只留引用：
+
+    {"type": "tool_result", "tool_use_id": "...", "blob": "<sha256>", "chars": 12345, "tokens": 3100}
+
+引用不是合法的 API 字段，发请求前由 resolve_blobs() 换回正文；
+较早的大结果在 tokens.truncate_old_tool_results 里只读开头一段，不整体载入。
+最近读过的正文放在一个按字节预算淘汰的 LRU 里（BLOB_CACHE_BYTES）。
+
+blob 在会话之间共享，/reset、压缩重写之后没有会话再引用的 blob 由标记-清除回收：
+标记 = 会话存储里所有会话当前历史引用的 blob，清除 = BLOB_DIR 里其余的文件。
+reset / 压缩后调用 schedule_gc()，在后台线程里跑，两次之间至少隔 BLOB_GC_INTERVAL 秒。
+引用可能还在会话的写缓存里没写出，所以最近 BLOB_GC_GRACE 秒内写入或复用过（put 会刷新 mtime）的 blob 不删。
+"""
+
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock, Timer
+
+from session_store import get_store
+
+logger = logging.getLogger(__name__)
+
+BLOB_DIR = os.environ.get("BLOB_DIR", os.path.join("sessions", "blobs"))
+BLOB_MIN_BYTES = int(os.environ.get("BLOB_MIN_BYTES", "4096"))
+BLOB_CACHE_BYTES = int(os.environ.get("BLOB_CACHE_BYTES", str(32 << 20)))
+BLOB_GC_INTERVAL = float(os.environ.get("BLOB_GC_INTERVAL", "300"))
+BLOB_GC_GRACE = float(os.environ.get("BLOB_GC_GRACE", "3600"))
+
+_cache: OrderedDict[str, str] = OrderedDict()
+_cache_bytes = 0
+_lock = Lock()
+# put 的「已存在就复用」和 GC 的「过了宽限期就删」互斥，不会删掉刚被复用的 blob
+_gc_lock = Lock()
+
+
+def _path(digest: str) -> str:
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def _remember(digest: str, text: str) -> None:
+    global _cache_bytes
+    if len(text) > BLOB_CACHE_BYTES:
+        return
+    with _lock:
+        if digest in _cache:
+            _cache.move_to_end(digest)
+            return
+        _cache[digest] = text
+        _cache_bytes += len(text)
+        while _cache_bytes > BLOB_CACHE_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
+
+
+def put(text: str) -> str:
+    """写入正文，返回 sha256；已存在就不再写"""
+    data = text.encode("utf-8", "surrogatepass")
+    digest = hashlib.sha256(data).hexdigest()
+    path = _path(digest)
+    with _gc_lock:
+        try:
+            os.utime(path)   # 已存在：刷新 mtime，GC 的宽限期从现在算
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+    _remember(digest, text)
+    return digest
+
+
+def get(digest: str) -> str:
+    """读取完整正文；blob 丢失时返回一句说明，不让整个请求失败"""
+    with _lock:
+        text = _cache.get(digest)
+        if text is not None:
+            _cache.move_to_end(digest)
+            return text
+    try:
+        with open(_path(digest), "rb") as f:
+            text = f.read().decode("utf-8", "surrogatepass")
+    except OSError as e:
+        logger.error(f"tool_result blob 丢失 {digest[:12]}: {e}")
+        return "[该工具结果的存档已丢失，如需内容请重新调用工具]"
+    _remember(digest, text)
+    return text
+
+
+def head(digest: str, max_chars: int) -> str:
+    """只读开头大约 max_chars 个字符（截断旧结果时用，不整体载入）"""
+    with _lock:
+        text = _cache.get(digest)
+    if text is not None:
+        return text[:max_chars]
+    try:
+        with open(_path(digest), "rb") as f:
+            data = f.read(max_chars * 4)   # UTF-8 最多 4 字节 / 字符
+    except OSError:
+        return "[该工具结果的存档已丢失]"
+    return data.decode("utf-8", "ignore")[:max_chars]
+
+
+# ============================================================
+# tool_result block 的引用 / 还原
+# ============================================================
+
+def externalize(block: dict, tokens: int) -> dict:
+    """正文超过 BLOB_MIN_BYTES 的 tool_result 换成引用；tokens 是正文的估算 token 数"""
+    content = block.get("content")
+    if not isinstance(content, str) or len(content) < BLOB_MIN_BYTES:
+        return block
+    ref = {k: v for k, v in block.items() if k != "content"}
+    ref.update(blob=put(content), chars=len(content), tokens=tokens)
+    return ref
+
+
+def is_ref(block) -> bool:
+    return isinstance(block, dict) and block.get("type") == "tool_result" and "blob" in block
+
+
+def resolve(block: dict, content: str | None = None) -> dict:
+    """引用 → 合法的 tool_result；content 不给时读取完整正文"""
+    out = {k: v for k, v in block.items() if k not in ("blob", "chars", "tokens")}
+    out["content"] = get(block["blob"]) if content is None else content
+    return out
+
+
+def resolve_blobs(messages: list) -> list:
+    """把消息里剩下的引用都换回正文（只复制含引用的消息，其余原样返回）"""
+    out = []
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list) and any(is_ref(b) for b in content):
+            m = {**m, "content": [resolve(b) if is_ref(b) else b for b in content]}
+        out.append(m)
+    return out
+
+
+# ============================================================
+# 垃圾回收（标记-清除）
+# ============================================================
+
+_gc_timer: Timer | None = None
+_last_gc = 0.0
+
+
+def collect_garbage(grace: float | None = None) -> tuple[int, int]:
+    """删除没有会话引用、且超过宽限期没写入过的 blob，返回 (删除个数, 释放字节数)"""
+    global _cache_bytes
+    grace = BLOB_GC_GRACE if grace is None else grace
+    live = get_store().referenced_blobs()
+    deleted = freed = 0
+    try:
+        shards = [entry.path for entry in os.scandir(BLOB_DIR) if entry.is_dir()]
+    except FileNotFoundError:
+        return 0, 0
+    for shard in shards:
+        for entry in os.scandir(shard):
+            digest = entry.name.split(".", 1)[0]
+            if digest in live:
+                continue
+            with _gc_lock:
+                try:
+                    st = entry.stat()
+                    if st.st_mtime > time.time() - grace:
+                        continue
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    continue
+            deleted += 1
+            freed += st.st_size
+            with _lock:
+                text = _cache.pop(digest, None)
+                if text is not None:
+                    _cache_bytes -= len(text)
+    if deleted:
+        logger.info(f"blob 回收：删除 {deleted} 个没有会话引用的 blob，释放 {freed} 字节")
+    return deleted, freed
+
+
+def _run_gc():
+    global _gc_timer, _last_gc
+    with _lock:
+        _gc_timer = None
+        _last_gc = time.monotonic()
+    try:
+        collect_garbage()
+    except Exception as e:
+        logger.error(f"blob 回收失败：{e}")
+
+
+def schedule_gc() -> None:
+    """会话历史变短之后（reset / 压缩）调用：安排一次后台回收，已经安排了就不重复"""
+    global _gc_timer
+    with _lock:
+        if _gc_timer is not None:
+            return
+        delay = max(0.0, _last_gc + BLOB_GC_INTERVAL - time.monotonic())
+        _gc_timer = Timer(delay, _run_gc)
+        _gc_timer.daemon = True
+        _gc_timer.start()
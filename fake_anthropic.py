@@ -0,0 +1,291 @@
+"""
+本地假 Messages API
+
+实现 POST /v1/messages（流式 SSE 和非流式两种）和 POST /v1/messages/count_tokens。
+给 bench.py 用：测连接复用、冷/热启动延迟和整条 agent 链路，不需要真实 API Key，也不花钱。
+
+HTTP/1.1 + chunked 编码，支持 keep-alive，客户端可以复用连接。
+
+可以模拟的行为：
+  - 延迟：latency 秒后开始输出（首 token 时间），之后按 tokens_per_sec 的速度逐段推送
+  - 回复长度：reply_text 固定文本，或 output_tokens 指定长度的填充文本（约 4 字符 / token），
+    超过请求的 max_tokens 时截断并返回 stop_reason=max_tokens
+  - tool_use：请求里带 tools 时，每个用户回合先回 tool_rounds 轮工具调用（tool_name / tool_input），
+    之后才 end_turn；规划、压缩这类不带 tools 的请求不受影响
+  - 故障注入：按 rate_limit_rate 的概率返回 429（带 retry-after），
+    按 disconnect_rate 的概率读完请求后直接断开连接（客户端看到的是连接错误），
+    按 stream_cut_rate 的概率在流式文字推到一半时断开连接；
+    script("cut", "overloaded", ...) 指定接下来几个请求依次遇到的故障（None 表示正常），用完后再按概率
+    （overloaded：流式推到一半时发 overloaded_error 事件）
+
+用法：
+    server = FakeAnthropicServer(latency=0.05, tokens_per_sec=200, tool_rounds=1)
+    server.start()
+    os.environ["ANTHROPIC_BASE_URL"] = server.url
+"""
+
+import json
+import time
+import uuid
+import random
+import socket
+from threading import Thread, Lock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHARS_PER_TOKEN = 4
+_FILLER = "这是一段用于压测的假回复内容。The quick brown fox jumps over the lazy dog. "
+
+
+def _estimate_tokens(payload) -> int:
+    return max(1, len(json.dumps(payload, ensure_ascii=False)) // CHARS_PER_TOKEN)
+
+
+def _turn_tool_rounds(messages: list) -> int:
+    """当前用户回合里已经进行了几轮工具调用（从最后一条纯文本 user 消息往后数 tool_result 消息）"""
+    rounds = 0
+    for m in reversed(messages):
+        if m.get("role") != "user":
+            continue
+        content = m.get("content")
+        if isinstance(content, list) and any(isinstance(b, dict) and b.get("type") == "tool_result"
+                                             for b in content):
+            rounds += 1
+        else:
+            break
+    return rounds
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.fake.count("connections")
+
+    def handle(self):
+        # 客户端取消请求（如 speculative 规划被丢弃）时连接会被重置，不算错误
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+    def do_POST(self):
+        fake: FakeAnthropicServer = self.server.fake
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        fake.count("requests")
+        path = self.path.split("?")[0]
+
+        if path == "/v1/messages/count_tokens":
+            self._send_json(200, {"input_tokens": _estimate_tokens(body.get("messages", []))})
+            return
+        if path != "/v1/messages":
+            self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+            return
+
+        fault = fake.pick_fault()
+        if fault == "disconnect":
+            fake.count("disconnects")
+            # 不回任何字节直接断开，客户端得到 APIConnectionError
+            self.close_connection = True
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+        if fault == "rate_limit":
+            fake.count("rate_limited")
+            self._send_json(429, {"type": "error", "error": {"type": "rate_limit_error",
+                                                             "message": "fake rate limit"}},
+                            {"retry-after": str(fake.retry_after)})
+            return
+
+        message = fake.build_message(body)
+        if body.get("stream"):
+            if fault in ("cut", "overloaded"):
+                fake.count("stream_cuts")
+            self._send_stream(message, fake, fault)
+        else:
+            time.sleep(fake.latency + message["usage"]["output_tokens"] / fake.tokens_per_sec
+                       if fake.tokens_per_sec else fake.latency)
+            self._send_json(200, message)
+
+    def _send_json(self, status: int, payload: dict, headers: dict | None = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, message: dict, fake, fault: str | None = None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        start = {**message, "content": [], "stop_reason": None,
+                 "usage": {**message["usage"], "output_tokens": 0}}
+        self._event("message_start", {"type": "message_start", "message": start})
+        time.sleep(fake.latency)   # 首 token 时间
+
+        chunk_chars = 8
+        pause = chunk_chars / CHARS_PER_TOKEN / fake.tokens_per_sec if fake.tokens_per_sec else 0.0
+        for index, block in enumerate(message["content"]):
+            if block["type"] == "text":
+                text = block["text"]
+                self._event("content_block_start", {"type": "content_block_start", "index": index,
+                                                    "content_block": {"type": "text", "text": ""}})
+                for i in range(0, len(text), chunk_chars):
+                    if fault and i >= len(text) // 2:
+                        self._fail_stream(fault)
+                        return
+                    if pause:
+                        time.sleep(pause)
+                    self._event("content_block_delta", {"type": "content_block_delta", "index": index,
+                                                        "delta": {"type": "text_delta",
+                                                                  "text": text[i:i + chunk_chars]}})
+            else:
+                self._event("content_block_start", {"type": "content_block_start", "index": index,
+                                                    "content_block": {**block, "input": {}}})
+                self._event("content_block_delta", {"type": "content_block_delta", "index": index,
+                                                    "delta": {"type": "input_json_delta",
+                                                              "partial_json": json.dumps(block["input"])}})
+            self._event("content_block_stop", {"type": "content_block_stop", "index": index})
+        self._event("message_delta", {"type": "message_delta",
+                                      "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+                                      "usage": {"output_tokens": message["usage"]["output_tokens"]}})
+        self._event("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _fail_stream(self, fault: str):
+        """流式输出到一半出故障：直接断开连接，或者发一个 overloaded_error 事件后正常结束响应"""
+        if fault == "overloaded":
+            self._event("error", {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+            return
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _event(self, name: str, data: dict):
+        chunk = f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+        self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeAnthropicServer:
+    """在后台线程里跑的假 API 服务器，port=0 表示随机端口"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, reply_text: str = "ok",
+                 output_tokens: int = 0, tokens_per_sec: float = 0.0,
+                 tool_rounds: int = 0, tool_name: str = "list_files", tool_input: dict | None = None,
+                 rate_limit_rate: float = 0.0, disconnect_rate: float = 0.0, stream_cut_rate: float = 0.0,
+                 retry_after: float = 0, seed: int | None = None):
+        self.latency = latency
+        self.reply_text = reply_text
+        self.output_tokens = output_tokens        # >0 时用填充文本代替 reply_text
+        self.tokens_per_sec = tokens_per_sec      # 0 表示一次性输出
+        self.tool_rounds = tool_rounds
+        self.tool_name = tool_name
+        self.tool_input = tool_input if tool_input is not None else {"path": "."}
+        self.rate_limit_rate = rate_limit_rate
+        self.disconnect_rate = disconnect_rate
+        self.stream_cut_rate = stream_cut_rate
+        self._script: list = []
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+
+        self._stats = {"connections": 0, "requests": 0, "rate_limited": 0, "disconnects": 0, "stream_cuts": 0,
+                       "tool_use": 0, "input_tokens": 0, "output_tokens": 0}
+        self._lock = Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def count(self, key: str, n: int = 1):
+        with self._lock:
+            self._stats[key] += n
+
+    def script(self, *faults: str | None):
+        """接下来的请求依次遇到这些故障：rate_limit / disconnect / cut / overloaded / None"""
+        with self._lock:
+            self._script.extend(faults)
+
+    def pick_fault(self) -> str | None:
+        with self._lock:
+            if self._script:
+                return self._script.pop(0)
+            r = self._random.random()
+        if r < self.rate_limit_rate:
+            return "rate_limit"
+        if r < self.rate_limit_rate + self.disconnect_rate:
+            return "disconnect"
+        if r < self.rate_limit_rate + self.disconnect_rate + self.stream_cut_rate:
+            return "cut"
+        return None
+
+    def _reply_text(self) -> str:
+        if not self.output_tokens:
+            return self.reply_text
+        chars = self.output_tokens * CHARS_PER_TOKEN
+        return (_FILLER * (chars // len(_FILLER) + 1))[:chars]
+
+    def build_message(self, body: dict) -> dict:
+        messages = body.get("messages", [])
+        if body.get("tools") and _turn_tool_rounds(messages) < self.tool_rounds:
+            content = [{"type": "text", "text": "先看一下目录。"},
+                       {"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:24]}",
+                        "name": self.tool_name, "input": self.tool_input}]
+            stop_reason = "tool_use"
+            self.count("tool_use")
+        else:
+            text = self._reply_text()
+            stop_reason = "end_turn"
+            limit = body.get("max_tokens")
+            if limit and len(text) > limit * CHARS_PER_TOKEN:
+                text = text[:limit * CHARS_PER_TOKEN]   # 和真实 API 一样截断在 max_tokens 处
+                stop_reason = "max_tokens"
+            content = [{"type": "text", "text": text}]
+        input_tokens = _estimate_tokens([body.get("system", ""), body.get("tools", []), messages])
+        output_tokens = max(1, sum(len(b.get("text", "")) for b in content) // CHARS_PER_TOKEN)
+        self.count("input_tokens", input_tokens)
+        self.count("output_tokens", output_tokens)
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "fake"),
+            "content": content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+        }
+
+    def start(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,232 @@
+"""
+本地假 Telegram Bot API
+
+实现 telegram_channel.py 用到的几个方法：getUpdates（长轮询）、sendMessage、
+editMessageText、deleteMessage、sendChatAction，其余方法一律返回 ok。
+给 bench.py 用：不需要真实 Bot Token，也不会真的发消息。
+
+  - push(chat_id, text) 模拟用户发来一条消息，正在长轮询的 getUpdates 立即返回
+  - 发出去的消息 / 编辑 / typing 都带时间戳记在 events 里
+  - 可以模拟 Telegram 的限流：单个聊天每秒超过 chat_rate 条（可突发 chat_burst 条）
+    sendMessage / editMessageText 就返回 429 和 retry_after
+
+用法：
+    server = FakeTelegramServer(chat_rate=1).start()
+    os.environ["TELEGRAM_API_URL"] = server.url      # 在导入 telegram_channel 之前
+    server.push(123, "你好")
+"""
+
+import json
+import time
+from threading import Condition, RLock, Thread
+from urllib.parse import parse_qsl, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _params(self) -> dict:
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body or b"{}"))
+            else:
+                params.update(parse_qsl(body.decode()))
+        return params
+
+    def _dispatch(self):
+        # 路径形如 /bot<token>/<method>
+        method = urlsplit(self.path).path.rsplit("/", 1)[-1]
+        params = self._params()
+        fake: FakeTelegramServer = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        status, payload = fake.call(method, params)
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeTelegramServer:
+    """在后台线程里跑的假 Bot API 服务器，port=0 表示随机端口"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 chat_rate: float = 0.0, chat_burst: int = 3, retry_after: int = 1):
+        self.latency = latency
+        self.chat_rate = chat_rate      # 0 表示不限流
+        self.chat_burst = chat_burst
+        self.retry_after = retry_after
+        self.events: list[dict] = []    # {"t", "method", "chat_id", "message_id", "text"}
+        self.stats = {"requests": 0, "get_updates": 0, "sent": 0, "edited": 0,
+                      "typing": 0, "deleted": 0, "rate_limited": 0}
+        self._updates: list[dict] = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._buckets: dict[int, list] = {}    # chat_id → [令牌数, 上次补充时间]
+        self._cond = Condition(RLock())
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # ---------------- 测试方用的接口 ----------------
+
+    def push(self, chat_id: int, text: str) -> int:
+        """模拟用户 chat_id 发来一条消息，返回 update_id"""
+        with self._cond:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": self._new_message_id(),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+                    "text": text,
+                },
+            })
+            self._cond.notify_all()
+        return update_id
+
+    def sent(self, chat_id: int | None = None) -> list[dict]:
+        """sendMessage / editMessageText 记录（按时间顺序）"""
+        with self._cond:
+            return [e for e in self.events if e["method"] in ("sendMessage", "editMessageText")
+                    and (chat_id is None or e["chat_id"] == chat_id)]
+
+    def visible(self, chat_id: int) -> list[str]:
+        """聊天里现在能看到的 bot 消息（每条取最后一次编辑后的内容，删掉的不算），按发送顺序"""
+        with self._cond:
+            texts: dict[int, str] = {}
+            for e in self.events:
+                if e["chat_id"] != chat_id:
+                    continue
+                if e["method"] in ("sendMessage", "editMessageText"):
+                    texts[e["message_id"]] = e["text"]
+                elif e["method"] == "deleteMessage":
+                    texts.pop(e["message_id"], None)
+            return [texts[m] for m in sorted(texts)]
+
+    def wait_for(self, predicate, timeout: float = 10.0) -> bool:
+        """等到 predicate(self) 为真（每次有 API 调用时重新检查）"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not predicate(self):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # ---------------- Bot API ----------------
+
+    def _new_message_id(self) -> int:
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return message_id
+
+    def _limited(self, chat_id: int) -> bool:
+        if not self.chat_rate:
+            return False
+        now = time.monotonic()
+        bucket = self._buckets.setdefault(chat_id, [float(self.chat_burst), now])
+        bucket[0] = min(self.chat_burst, bucket[0] + (now - bucket[1]) * self.chat_rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return True
+        bucket[0] -= 1
+        return False
+
+    def _record(self, method: str, chat_id: int, message_id: int, text: str = ""):
+        self.events.append({"t": time.perf_counter(), "method": method,
+                            "chat_id": chat_id, "message_id": message_id, "text": text})
+        self._cond.notify_all()
+
+    def call(self, method: str, params: dict) -> tuple[int, dict]:
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+
+        with self._cond:
+            self.stats["requests"] += 1
+            if method == "getMe":
+                return 200, {"ok": True, "result": {"id": 1, "is_bot": True,
+                                                    "first_name": "fake", "username": "fake_bot"}}
+            chat_id = int(params.get("chat_id", 0))
+            if method in ("sendMessage", "editMessageText") and self._limited(chat_id):
+                self.stats["rate_limited"] += 1
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+            if method == "sendMessage":
+                self.stats["sent"] += 1
+                message_id = self._new_message_id()
+            elif method == "editMessageText":
+                self.stats["edited"] += 1
+                message_id = int(params["message_id"])
+            elif method == "deleteMessage":
+                self.stats["deleted"] += 1
+                self._record(method, chat_id, int(params["message_id"]))
+                return 200, {"ok": True, "result": True}
+            elif method == "sendChatAction":
+                self.stats["typing"] += 1
+                self._record(method, chat_id, 0)
+                return 200, {"ok": True, "result": True}
+            else:
+                return 200, {"ok": True, "result": True}
+            text = params.get("text", "")
+            self._record(method, chat_id, message_id, text)
+        return 200, {"ok": True, "result": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "fake"},
+            "text": text,
+        }}
+
+    def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset", 0) or 0)
+        timeout = float(params.get("timeout", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.stats["get_updates"] += 1
+            # 确认 offset 之前的更新（和真实 API 一样，确认后就不再返回）
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._updates[:limit]
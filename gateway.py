@@ -25,13 +25,21 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-from queue import Queue
-from threading import Thread
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
 
-from agent import Agent
+from agent import AsyncAgent
 from telegram_channel import start_polling
 from http_channel import start_http
+from runtime import get_loop, run_sync, submit
+from session_pool import SessionPool, SessionQueueFull, MERGED_REPLY
+from supervisor import Supervisor, GATEWAY_WORKERS
 import hooks
+import metrics
+import tracing
 
 # ============================================================
 # 会话管理
@@ -44,60 +52,248 @@ import hooks
 #
 # OpenClaw 用 session key（如 agent:main:direct:telegram:123456）
 # mini-claw 直接用 chat_id 做 key，效果一样。
+#
+# 会话放在有内存预算的 LRU 池里（session_pool.py），
+# 空闲太久的 Agent 会被淘汰，下次来消息时从会话存储（sessions/<id>.jsonl 或 SQLite）重建。
 # ============================================================
 
-sessions: dict[int, Agent] = {}
+SESSION_POOL_MAX_SESSIONS = int(os.environ.get("SESSION_POOL_MAX_SESSIONS", "1000"))
+SESSION_POOL_MAX_BYTES = int(os.environ.get("SESSION_POOL_MAX_BYTES", "0"))
+
+# 被淘汰会话的对话模式（mode 只在内存里，不记下来重建后会变回 code）。
+# 按 LRU 最多记 SESSION_EVICTED_MODES_MAX 个，再早淘汰的会话重建后回到 code 模式。
+# 淘汰在事件循环里、重建在线程里，所以要加锁
+SESSION_EVICTED_MODES_MAX = int(os.environ.get("SESSION_EVICTED_MODES_MAX", "10000"))
+_evicted_modes: OrderedDict[int, str] = OrderedDict()
+_evicted_modes_lock = threading.Lock()
+
+
+def _create_session(chat_id: int) -> AsyncAgent:
+    agent = AsyncAgent(str(chat_id))
+    with _evicted_modes_lock:
+        agent.mode = _evicted_modes.pop(chat_id, agent.mode)
+    return agent
+
+
+def _on_session_evicted(chat_id: int, agent: AsyncAgent):
+    if agent.mode != "code":
+        with _evicted_modes_lock:
+            _evicted_modes[chat_id] = agent.mode
+            _evicted_modes.move_to_end(chat_id)
+            while len(_evicted_modes) > SESSION_EVICTED_MODES_MAX:
+                _evicted_modes.popitem(last=False)
+    agent.close()
+
+
+sessions = SessionPool(
+    _create_session,
+    max_sessions=SESSION_POOL_MAX_SESSIONS,
+    max_bytes=SESSION_POOL_MAX_BYTES,
+    is_busy=lambda chat_id: chat_id in task_queues,
+    on_evict=_on_session_evicted,
+    size_of=lambda agent: agent.history_bytes,
+)
 
 # ============================================================
 # 串行任务队列
 #
 # 对应 OpenClaw：Task Channel Queue
 #
-# 每个 session 一个队列 + 一个后台 worker 线程。
-# 消息进来先入队，worker 串行取出处理，消除竞态。
-# 不同用户之间互不影响，仍然并行。
+# 每个 session 一个 asyncio.Queue + 一个 worker 协程（跑在 runtime.py 的后台事件循环里）。
+# 消息进来先入队，worker 按 FIFO 串行取出处理，消除竞态。
+# 不同用户之间互不影响，仍然并发。
+#
+# 和线程版的区别：队列空了 worker 协程就退出，不会有上千个常驻的空闲线程；
+# 下一条消息进来时再重新拉起。
+#
+# 每个会话最多排队 SESSION_QUEUE_MAX 条（不含正在处理的那条），
+# 满了直接抛 SessionQueueFull，由 Channel 转成 429 / 提示语，不无限堆积。
 # ============================================================
 
-task_queues: dict[int, Queue] = {}
+SESSION_QUEUE_MAX = int(os.environ.get("SESSION_QUEUE_MAX", "8"))
+
+# 连发合并：开启后，排队中的连续消息合并成一轮 run()，流式输出和回复只随最后一条发出，
+# 前面几条的等待方拿到 MERGED_REPLY（Channel 收到它不发任何消息）。
+# 取出第一条后再等 SESSION_COALESCE_WINDOW 秒（每来一条新消息重新计时），
+# 最多等 SESSION_COALESCE_MAX_WAIT 秒；命令（/reset 等）不参与合并。
+SESSION_COALESCE = os.environ.get("SESSION_COALESCE", "0") == "1"
+SESSION_COALESCE_WINDOW = float(os.environ.get("SESSION_COALESCE_WINDOW", "1.0"))
+SESSION_COALESCE_MAX_WAIT = float(os.environ.get("SESSION_COALESCE_MAX_WAIT", "3.0"))
 
+coalesce_stats = {
+    "batches": 0,            # 发生合并的 run() 次数
+    "merged_messages": 0,    # 被并进别人那一轮的消息数（= 省下的 run() 次数）
+    "saved_llm_calls": 0.0,  # 按每轮平均 LLM 调用次数折算
+    "avg_llm_calls_per_run": 0.0,
+}
+_coalesce_runs = 0
 
-def get_or_create_session(chat_id: int) -> Agent:
-    """获取或创建该 chat_id 的 Agent 会话"""
-    if chat_id not in sessions:
-        sessions[chat_id] = Agent(str(chat_id))
-    return sessions[chat_id]
+task_queues: dict[int, asyncio.Queue] = {}
+worker_tasks: dict[int, asyncio.Task] = {}   # 持有引用，防止运行中的 Task 被 GC
 
 
-def _worker(chat_id: int, q: Queue):
-    """每个 session 的串行 worker 线程"""
+# 正在线程里重建的会话：同一个 chat_id 同时来几条消息 / 命令时共用一次加载
+_loading: dict[int, asyncio.Future] = {}
+
+
+async def get_or_create_session_async(chat_id: int) -> AsyncAgent:
+    """
+    事件循环里用的版本：不在池里时，在线程里构造 Agent（读取并解析整个会话文件），
+    构造好才放进会话池，加载大会话时不会卡住其他会话的协程。
+    """
+    if chat_id in sessions:
+        return sessions.get(chat_id)
+    future = _loading.get(chat_id)
+    if future is None:
+        future = _loading[chat_id] = asyncio.ensure_future(asyncio.to_thread(_create_session, chat_id))
+
+        def loaded(f: asyncio.Future):
+            # 在唤醒等待方之前放进池，之后来的调用直接命中
+            _loading.pop(chat_id, None)
+            if not f.cancelled() and f.exception() is None and chat_id not in sessions:
+                sessions.insert(chat_id, f.result())
+        future.add_done_callback(loaded)
+    return await asyncio.shield(future)
+
+
+def _is_command(text: str) -> bool:
+    return text.startswith("/")
+
+
+async def _collect_burst(q: asyncio.Queue, batch: list):
+    """
+    合并窗口：收集紧跟着到来的普通消息。
+    返回 (batch, carry)：carry 是窗口里遇到的命令，留给下一轮单独处理。
+    """
+    loop = asyncio.get_running_loop()
+    hard_deadline = loop.time() + SESSION_COALESCE_MAX_WAIT
     while True:
-        text, response_q = q.get()
-        try:
-            agent = get_or_create_session(chat_id)
-            if text == "/reset":
-                agent.reset()
-                result = "✅ 对话已重置"
-            else:
-                hooks.fire("before_agent_run", {"chat_id": chat_id, "text": text, "mode": agent.mode})
-                result = agent.run(text)
-                logger.info(f"[{chat_id}] <<< {result[:80]!r}{'...' if len(result) > 80 else ''}")
-                hooks.fire("after_reply", {"chat_id": chat_id, "text": text, "reply": result})
-        except Exception as e:
-            result = f"[错误] {e}"
-            logger.error(f"[{chat_id}] worker 异常: {e}")
-        finally:
-            response_q.put(result)
+        if not q.empty():
+            item = q.get_nowait()
+        else:
+            timeout = min(SESSION_COALESCE_WINDOW, hard_deadline - loop.time())
+            if timeout <= 0:
+                return batch, None
+            try:
+                item = await asyncio.wait_for(q.get(), timeout)
+            except asyncio.TimeoutError:
+                return batch, None
+        if _is_command(item[0]):
+            return batch, item
+        batch.append(item)
+
+
+def _record_coalesced(merged: int, llm_calls: int):
+    """合并了 merged 条消息的一轮跑了 llm_calls 次 LLM 调用，按平均值折算省下的调用"""
+    global _coalesce_runs
+    _coalesce_runs += 1
+    s = coalesce_stats
+    s["avg_llm_calls_per_run"] += (llm_calls - s["avg_llm_calls_per_run"]) / _coalesce_runs
+    if merged:
+        s["batches"] += 1
+        s["merged_messages"] += merged
+        s["saved_llm_calls"] += merged * s["avg_llm_calls_per_run"]
+        logger.info(f"合并 {merged + 1} 条连发消息为一轮，累计省下约 {s['saved_llm_calls']:.0f} 次 LLM 调用")
+
+
+async def _process(chat_id: int, q: asyncio.Queue, item: tuple, span):
+    """处理一轮（开启合并时可能包含多条消息），返回合并窗口里遇到的命令"""
+    batch, carry = [item], None
+    if SESSION_COALESCE and not _is_command(item[0]):
+        with tracing.span("coalesce"):
+            batch, carry = await _collect_burst(q, batch)
+    span.set(messages=len(batch))
+    text = "\n\n".join(t for t, _, _, _ in batch)
+    # 合并的一轮只对最后一条消息流式输出、回复；前面几条拿到 MERGED_REPLY，Channel 不再各发一份
+    on_event = batch[-1][2]
+    try:
+        agent = await get_or_create_session_async(chat_id)
+        if text == "/reset":
+            agent.reset()
+            result = "✅ 对话已重置"
+        else:
+            hooks.fire("before_agent_run", {"chat_id": chat_id, "text": text, "mode": agent.mode})
+            calls_before = agent.llm_calls
+            result = await agent.run(text, on_event=on_event)
+            _record_coalesced(len(batch) - 1, agent.llm_calls - calls_before)
+            logger.info(f"[{chat_id}] <<< {result[:80]!r}{'...' if len(result) > 80 else ''}")
+            hooks.fire("after_reply", {"chat_id": chat_id, "text": text, "reply": result})
+    except Exception as e:
+        result = f"[错误] {e}"
+        logger.error(f"[{chat_id}] worker 异常: {e}")
+        span.error = f"{type(e).__name__}: {e}"
+    finally:
+        for i, (_, future, _, _) in enumerate(batch):
+            if not future.done():
+                future.set_result(result if i == len(batch) - 1 else MERGED_REPLY)
             q.task_done()
+    return carry
+
+
+async def _worker(chat_id: int, q: asyncio.Queue):
+    """每个 session 的串行 worker 协程，队列清空后退出"""
+    carry = None
+    while carry is not None or not q.empty():
+        item = carry if carry is not None else q.get_nowait()
+        # 每一轮一条 trace，从入队时间算起（tracing.py）
+        with tracing.trace("message", start=item[3], chat_id=chat_id) as span:
+            tracing.record("queue_wait", item[3])
+            carry = await _process(chat_id, q, item, span)
+
+    # empty() 检查和这里的删除之间没有 await，不会漏掉新入队的消息
+    del task_queues[chat_id]
+    del worker_tasks[chat_id]
+
+    # 本会话刚变为空闲，历史也变长了，检查一次内存预算
+    if sessions.trim():
+        logger.info(f"会话池淘汰后：{sessions.stats()}")
 
 
-def get_or_create_queue(chat_id: int) -> Queue:
-    """获取或创建该 chat_id 的任务队列，首次创建时启动 worker 线程"""
+async def _snapshot() -> dict:
+    """
+    在事件循环线程上读取会话池和队列状态。
+    task_queues / worker_tasks / sessions 只在循环线程上修改，HTTP 线程直接遍历会撞上
+    「dictionary changed size during iteration」，所以 /metrics 通过 run_sync 到循环上来读。
+    """
+    return {
+        "pool": sessions.stats(),
+        "queued": sum(q.qsize() for q in task_queues.values()),
+        "active": len(worker_tasks),
+        "merged_messages": coalesce_stats["merged_messages"],
+        "saved_llm_calls": coalesce_stats["saved_llm_calls"],
+    }
+
+
+def _collect_metrics():
+    snap = run_sync(_snapshot(), timeout=5)
+    pool = snap["pool"]
+    return [
+        ("mini_claw_sessions", "gauge", "会话池中的 Agent 数", [({}, pool["sessions"])]),
+        ("mini_claw_session_pool_events_total", "counter", "会话池命中 / 未命中 / 淘汰次数",
+         [({"event": k}, pool[k]) for k in ("hits", "misses", "evictions")]),
+        ("mini_claw_session_queue_depth", "gauge", "各会话排队中的消息总数", [({}, snap["queued"])]),
+        ("mini_claw_active_sessions", "gauge", "正在处理消息的会话数", [({}, snap["active"])]),
+        ("mini_claw_coalesced_messages_total", "counter", "被合并进其他消息那一轮的消息数",
+         [({}, snap["merged_messages"])]),
+        ("mini_claw_coalesce_saved_llm_calls_total", "counter", "合并消息估算省下的 LLM 调用",
+         [({}, snap["saved_llm_calls"])]),
+    ]
+
+
+metrics.register(_collect_metrics)
+
+
+def get_or_create_queue(chat_id: int) -> asyncio.Queue:
+    """
+    获取或创建该 chat_id 的任务队列，首次创建时启动 worker 协程。
+
+    必须在事件循环线程内调用。
+    """
     if chat_id not in task_queues:
-        q = Queue()
+        q = asyncio.Queue()
         task_queues[chat_id] = q
-        t = Thread(target=_worker, args=(chat_id, q), daemon=True)
-        t.start()
-        logger.info(f"[{chat_id}] 新建 session worker")
+        worker_tasks[chat_id] = asyncio.get_running_loop().create_task(_worker(chat_id, q))
+        logger.debug(f"[{chat_id}] 启动 session worker")
     return task_queues[chat_id]
 
 
@@ -107,12 +303,28 @@ def get_or_create_queue(chat_id: int) -> Queue:
 # 对应 OpenClaw：dispatchReplyFromConfig → getReplyFromConfig
 # ============================================================
 
-def handle_message(chat_id: int, text: str) -> str:
+def _track_first_token(chat_id: int, on_event):
+    """包一层事件回调，记录从收到消息到第一个可见文字的耗时"""
+    start = time.perf_counter()
+    seen = False
+
+    def wrapper(event: dict):
+        nonlocal seen
+        if not seen and event["type"] == "text_delta":
+            seen = True
+            logger.info(f"[{chat_id}] 首个可见 token：{(time.perf_counter() - start) * 1000:.0f}ms")
+        on_event(event)
+    return wrapper
+
+
+async def handle_message_async(chat_id: int, text: str, on_event=None) -> str:
     """
     消息路由核心：收到消息 → 找到对应 Agent → 返回回复
 
     内置命令直接返回，不走队列。
-    普通消息入队，等 worker 串行处理完再返回。
+    普通消息入队，等 worker 串行处理完再返回；该会话排队已满时抛 SessionQueueFull。
+
+    on_event：可选的流式事件回调，透传给 Agent.run()（见 agent.py）。
     """
     text = text.strip()
     logger.info(f"[{chat_id}] >>> {text!r}")
@@ -130,31 +342,71 @@ def handle_message(chat_id: int, text: str) -> str:
             "/reset — 清空对话历史，重新开始"
         )
 
-    # /chat 和 /code 只改内存状态，不涉及文件，直接处理
+    # /chat 和 /code 只改内存状态，不写文件，直接处理（会话不在内存时在线程里从磁盘重建）
     if text == "/chat":
-        agent = get_or_create_session(chat_id)
+        agent = await get_or_create_session_async(chat_id)
         agent.mode = "chat"
         return "💬 已切换到聊天模式，随便聊吧"
 
     if text == "/code":
-        agent = get_or_create_session(chat_id)
+        agent = await get_or_create_session_async(chat_id)
         agent.mode = "code"
         return "💻 已切换到编程助手模式"
 
     # /reset 和普通消息都走队列，保证串行，避免和 worker 竞争 session 文件
-    response_q: Queue = Queue()
-    get_or_create_queue(chat_id).put((text, response_q))
-    return response_q.get()  # 阻塞等待，直到 worker 处理完
+    if on_event is not None:
+        on_event = _track_first_token(chat_id, on_event)
+    q = get_or_create_queue(chat_id)
+    if SESSION_QUEUE_MAX and q.qsize() >= SESSION_QUEUE_MAX:
+        logger.warning(f"[{chat_id}] 排队消息已达上限 {SESSION_QUEUE_MAX}，拒绝")
+        raise SessionQueueFull(f"会话 {chat_id} 已有 {q.qsize()} 条消息在排队")
+    future = asyncio.get_running_loop().create_future()
+    q.put_nowait((text, future, on_event, time.perf_counter()))
+    return await future  # 挂起等待，不占线程
+
+
+def handle_message(chat_id: int, text: str, on_event=None) -> str:
+    """
+    同步适配器：给 Telegram / HTTP 这类线程模型的 Channel 用。
+
+    把 handle_message_async 提交到后台事件循环，当前线程阻塞等待回复。
+    on_event 会在事件循环线程上被调用，Channel 需要自己做线程安全的转交。
+    """
+    return run_sync(handle_message_async(chat_id, text, on_event))
+
+
+def submit_message(chat_id: int, text: str, on_event=None):
+    """
+    非阻塞适配器：把消息提交到后台事件循环，立即返回 concurrent.futures.Future。
+
+    同一线程里先提交的消息先入队（handle_message_async 在入队前没有 await），
+    Telegram 轮询线程用它分发消息，不会被某个慢会话卡住。
+    """
+    return submit(handle_message_async(chat_id, text, on_event))
 
 
 # ============================================================
 # 启动
 # ============================================================
 
-if __name__ == "__main__":
-    # 注册 hook（测试用）
+def register_hooks():
+    """
+    注册 hook（测试用）。Agent 在哪个进程里跑就要在哪个进程里注册：
+    单进程模式在这里直接调用，多进程模式作为 Supervisor 的 initializer 在每个 worker 进程启动时调用
+    """
     hooks.register("after_reply", lambda d: print(f"HOOK: {d['chat_id']} 收到了回复"))
 
+
+if __name__ == "__main__":
     print("🚀 Mini-Claw Gateway 启动中...")
-    start_http(handle_message)      # 后台线程，不阻塞
-    start_polling(handle_message)   # 主线程阻塞，保持进程存活
+    if GATEWAY_WORKERS > 1:
+        # 多进程模式：本进程只跑 Channel，消息按 chat_id 转发给 worker 进程；
+        # hook 由 initializer 在各 worker 里注册，也在 worker 里触发
+        supervisor = Supervisor(GATEWAY_WORKERS, initializer=register_hooks).start()
+        route, dispatch = supervisor.handle_message, supervisor.submit_message
+    else:
+        register_hooks()
+        get_loop()                  # 启动后台事件循环
+        route, dispatch = handle_message, submit_message
+    start_http(route)               # 后台线程，不阻塞
+    start_polling(route, dispatch)  # 主线程阻塞，保持进程存活
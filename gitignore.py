@@ -0,0 +1,127 @@
+"""
+.gitignore 匹配
+
+list_files 递归列目录时用来剪枝：被忽略的目录（node_modules、build 产物等）整棵跳过，
+不进入、不 stat。只实现常用语法：
+
+  - 空行和 # 注释
+  - ! 取反（后面的规则覆盖前面的）
+  - 结尾 / 只匹配目录
+  - 含 / 的规则相对 .gitignore 所在目录锚定，否则匹配任意层级的名字
+  - * ? [...] 和 **
+"""
+
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 无论有没有 .gitignore 都跳过
+ALWAYS_IGNORED = {".git", ".hg", ".svn"}
+
+
+def _translate(pattern: str) -> str:
+    """gitignore 通配符 → 正则"""
+    out, i, n = [], 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == n:
+            out.append("/.*")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class GitIgnore:
+    """
+    一组规则，不可变：进入带 .gitignore 的子目录时用 child() 生成新实例，
+    兄弟目录之间互不影响。
+    """
+
+    def __init__(self, rules: tuple = ()):
+        # (规则所在目录的绝对路径, 正则, 是否取反, 是否只匹配目录, 是否锚定)
+        self.rules = rules
+
+    def child(self, directory: str) -> "GitIgnore":
+        """读取 directory 下的 .gitignore（没有就返回自己）"""
+        try:
+            with open(os.path.join(directory, ".gitignore"), encoding="utf-8", errors="replace") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return self
+        rules = []
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if not line:
+                continue
+            rules.append((directory, re.compile(_translate(line) + r"\Z"), negate, dir_only, anchored))
+        return GitIgnore(self.rules + tuple(rules)) if rules else self
+
+    def ignored(self, path: str, name: str, is_dir: bool) -> bool:
+        """path 是绝对路径，name 是最后一段；最后一条匹配的规则说了算"""
+        if name in ALWAYS_IGNORED:
+            return True
+        result = False
+        for base, regex, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if anchored:
+                if not path.startswith(base + os.sep):
+                    continue
+                target = path[len(base) + 1:].replace(os.sep, "/")
+            else:
+                target = name
+            if regex.match(target):
+                result = not negate
+        return result
+
+
+def for_directory(root: str, directory: str) -> GitIgnore:
+    """从 root 往下到 directory，沿途每一层的 .gitignore 都生效"""
+    root, directory = os.path.realpath(root), os.path.realpath(directory)
+    rules = GitIgnore()
+    if directory != root and not directory.startswith(root + os.sep):
+        return rules.child(directory)
+    current = root
+    rules = rules.child(current)
+    for part in os.path.relpath(directory, root).split(os.sep):
+        if part in (".", ""):
+            continue
+        current = os.path.join(current, part)
+        rules = rules.child(current)
+    return rules
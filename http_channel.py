@@ -10,14 +10,52 @@ HTTP 频道适配器
 
 安全设计：只绑定 127.0.0.1，不对公网暴露端口。
 适合本机调试、脚本自动化、与其他本机程序集成。
+
+服务方式（HTTP_SERVER）：
+  threaded — 默认。进程内嵌的 WSGI 服务器（标准库 wsgiref），请求交给固定大小的线程池处理
+  waitress — 装了 waitress 时可选
+  dev      — 原来的 Flask 开发服务器
+
+背压：
+  - 同时处理中的消息最多 HTTP_MAX_IN_FLIGHT 条，超出直接 503，不再无限占连接
+  - 单个会话排队满了（gateway 的 SESSION_QUEUE_MAX）返回 429
+  - /message 最多等 HTTP_REQUEST_TIMEOUT 秒，超时返回 504 和 job_id，处理继续在后台进行，可以轮询结果
+  - /message/async 立即返回 job_id，之后 GET /jobs/<job_id> 取结果
+
+连发合并（gateway 的 SESSION_COALESCE=1）时，并进同一会话下一条消息那一轮的请求不带回复：
+/message 返回 {"reply": null, "merged": true}，任务状态是 merged，SSE 的 done 事件同样带 merged，
+回复（和流式事件）都在这一轮最后一条消息的响应里。
+
+观测：
+  - GET /metrics        Prometheus 文本格式（各阶段耗时直方图、token 用量、队列深度等）
+  - GET /debug/traces   最近的请求 trace（tracing.py）
+  多进程模式（GATEWAY_WORKERS > 1）下 Agent 在 worker 进程里，这两个接口只反映主进程
 """
 
+import os
+import json
+import time
+import uuid
 import logging
-from threading import Thread
-from flask import Flask, request, jsonify
+from queue import Queue, Empty
+from threading import Thread, Lock
+from socketserver import ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+from flask import Flask, Response, request, jsonify, stream_with_context
+
+import metrics
+import tracing
+from session_pool import SessionQueueFull, MERGED_REPLY
 
 logger = logging.getLogger(__name__)
 
+HTTP_SERVER = os.environ.get("HTTP_SERVER", "threaded")
+HTTP_MAX_IN_FLIGHT = int(os.environ.get("HTTP_MAX_IN_FLIGHT", "64"))
+HTTP_REQUEST_TIMEOUT = float(os.environ.get("HTTP_REQUEST_TIMEOUT", "120"))
+HTTP_JOB_TTL = float(os.environ.get("HTTP_JOB_TTL", "600"))
+HTTP_SPARE_THREADS = 8   # 满载时仍留几个线程给 503 / 轮询 / 健康检查
+
 app = Flask(__name__)
 app.logger.setLevel(logging.WARNING)   # 静默 Flask 自己的请求日志
 app.json.ensure_ascii = False          # 回复中文直接显示，不转义成 \uXXXX
@@ -25,6 +63,83 @@ app.json.ensure_ascii = False          # 回复中文直接显示，不转义成
 _on_message = None   # gateway 启动时注入
 
 
+# ============================================================
+# 任务：每条消息在 _executor 里跑一次 on_message，结果记在 _jobs 里供轮询
+# ============================================================
+
+_in_flight = 0
+_in_flight_lock = Lock()
+_executor = ThreadPoolExecutor(max_workers=HTTP_MAX_IN_FLIGHT, thread_name_prefix="http-job")
+_jobs: dict[str, dict] = {}
+_jobs_lock = Lock()
+stats = {"accepted": 0, "rejected_busy": 0, "rejected_queue_full": 0, "timeouts": 0, "merged": 0}
+
+
+def _expire_jobs():
+    now = time.time()
+    with _jobs_lock:
+        for job_id in [j for j, job in _jobs.items()
+                       if job["finished_at"] and now - job["finished_at"] > HTTP_JOB_TTL]:
+            del _jobs[job_id]
+
+
+def _submit(chat_id: int, text: str, on_event=None):
+    """
+    提交一条消息，返回 (job_id, future)；在途消息已满时返回 None。
+    名额在任务结束时归还，所以 504 之后后台仍在处理的消息也算在途。
+    """
+    global _in_flight
+    with _in_flight_lock:
+        if _in_flight >= HTTP_MAX_IN_FLIGHT:
+            stats["rejected_busy"] += 1
+            return None
+        _in_flight += 1
+    _expire_jobs()
+    job_id = uuid.uuid4().hex
+    job = {"status": "pending", "chat_id": chat_id, "reply": None,
+           "created_at": time.time(), "finished_at": None}
+    with _jobs_lock:
+        _jobs[job_id] = job
+    stats["accepted"] += 1
+
+    def run():
+        global _in_flight
+        try:
+            reply = _on_message(chat_id, text, on_event=on_event)
+            if reply == MERGED_REPLY:
+                stats["merged"] += 1
+                job.update(status="merged")
+            else:
+                job.update(status="done", reply=reply)
+        except SessionQueueFull as e:
+            stats["rejected_queue_full"] += 1
+            job.update(status="rejected", reply=str(e))
+            raise
+        except Exception as e:
+            job.update(status="error", reply=f"[错误] {e}")
+            raise
+        finally:
+            job["finished_at"] = time.time()
+            with _in_flight_lock:
+                _in_flight -= 1
+        return reply
+
+    return job_id, _executor.submit(run)
+
+
+def _busy():
+    return jsonify({"error": "服务繁忙，请稍后重试"}), 503, {"Retry-After": "1"}
+
+
+def _queue_full(e):
+    return jsonify({"error": f"该会话排队的消息太多，请等前面的处理完：{e}"}), 429, {"Retry-After": "5"}
+
+
+def _parse():
+    data = request.get_json(silent=True) or {}
+    return int(data.get("chat_id", 0)), data.get("text", "").strip()
+
+
 @app.route("/message", methods=["POST"])
 def receive_message():
     """
@@ -34,23 +149,201 @@ def receive_message():
         {"chat_id": 0, "text": "你好"}
 
     chat_id 可选，默认 0（HTTP 用户）。
+    503：在途消息已满；429：该会话排队已满；504：超过 HTTP_REQUEST_TIMEOUT，响应里带 job_id 可继续轮询。
     """
-    data = request.get_json(silent=True) or {}
-    chat_id = int(data.get("chat_id", 0))
-    text = data.get("text", "").strip()
-
+    chat_id, text = _parse()
     if not text:
         return jsonify({"error": "text 不能为空"}), 400
 
     logger.info(f"[HTTP] chat_id={chat_id} text={text!r}")
-    reply = _on_message(chat_id, text)
+    submitted = _submit(chat_id, text)
+    if submitted is None:
+        return _busy()
+    job_id, future = submitted
+    try:
+        reply = future.result(timeout=HTTP_REQUEST_TIMEOUT)
+    except FutureTimeout:
+        stats["timeouts"] += 1
+        return jsonify({"error": "处理超时，结果可稍后查询", "job_id": job_id,
+                        "status_url": f"/jobs/{job_id}"}), 504
+    except SessionQueueFull as e:
+        return _queue_full(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if reply == MERGED_REPLY:
+        return jsonify({"reply": None, "merged": True})
     return jsonify({"reply": reply})
 
 
+@app.route("/message/async", methods=["POST"])
+def receive_message_async():
+    """
+    异步版本：立即返回 202 和 job_id，用 GET /jobs/<job_id> 轮询结果。
+    """
+    chat_id, text = _parse()
+    if not text:
+        return jsonify({"error": "text 不能为空"}), 400
+
+    logger.info(f"[HTTP/async] chat_id={chat_id} text={text!r}")
+    submitted = _submit(chat_id, text)
+    if submitted is None:
+        return _busy()
+    job_id, _ = submitted
+    return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str):
+    """
+    查询任务状态：pending / done / merged（回复在同一轮最后一条消息的任务里）/ rejected（会话排队已满，HTTP 429）/ error。
+    完成的任务保留 HTTP_JOB_TTL 秒。
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "job 不存在或已过期"}), 404
+    body = {"job_id": job_id, "status": job["status"], "reply": job["reply"]}
+    return jsonify(body), 429 if job["status"] == "rejected" else 200
+
+
+@app.route("/message/stream", methods=["POST"])
+def receive_message_stream():
+    """
+    流式版本：用 Server-Sent Events 边处理边推送。
+
+    请求格式同 /message。响应是 text/event-stream，事件依次为：
+        event: plan        data: {"text": 执行计划}
+        event: tool_start  data: {"name": ..., "input": {...}}
+        event: tool_end    data: {"name": ...}
+        event: text_delta  data: {"text": 增量文字}
+        event: text_reset  data: {"chars": n}   前面推送的文字里最后 n 个字作废（重试 / 升级模型后重新生成），
+                                              客户端应从已显示的文字末尾删掉 n 个字
+        event: done        data: {"reply": 最终回复}（并进下一条消息那一轮时为 {"reply": null, "merged": true}）
+      排队已满时最后一个事件是 error（status 429），超过 HTTP_REQUEST_TIMEOUT 时是 timeout（带 job_id）。
+
+    curl 示例：
+        curl -N -X POST localhost:5000/message/stream -H 'Content-Type: application/json' \\
+             -d '{"text": "看看 main.py"}'
+    """
+    chat_id, text = _parse()
+    if not text:
+        return jsonify({"error": "text 不能为空"}), 400
+
+    logger.info(f"[HTTP/SSE] chat_id={chat_id} text={text!r}")
+
+    # on_message 会阻塞到处理完，放到任务线程里跑；事件经线程安全队列转给响应生成器
+    events: Queue = Queue()
+    submitted = _submit(chat_id, text, on_event=events.put)
+    if submitted is None:
+        return _busy()
+    job_id, future = submitted
+
+    def finished(f):
+        try:
+            reply = f.result()
+            events.put({"type": "done", "reply": None, "merged": True} if reply == MERGED_REPLY
+                       else {"type": "done", "reply": reply})
+        except SessionQueueFull as e:
+            events.put({"type": "error", "status": 429, "error": str(e)})
+        except Exception as e:
+            events.put({"type": "done", "reply": f"[错误] {e}"})
+    future.add_done_callback(finished)
+
+    def generate():
+        deadline = time.monotonic() + HTTP_REQUEST_TIMEOUT
+        while True:
+            try:
+                event = events.get(timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                stats["timeouts"] += 1
+                event = {"type": "timeout", "job_id": job_id, "status_url": f"/jobs/{job_id}"}
+            event_type = event.pop("type")
+            yield f"event: {event_type}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            if event_type in ("done", "error", "timeout"):
+                break
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/health", methods=["GET"])
 def health():
     """简单的健康检查接口"""
-    return jsonify({"status": "ok"})
+    return jsonify({"status": "ok", "in_flight": _in_flight, **stats})
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus 文本格式的运行指标（本进程：各阶段耗时直方图、token 用量、队列深度等）"""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/debug/traces", methods=["GET"])
+def debug_traces():
+    """
+    最近的请求 trace（tracing.py 的环形缓冲区），新的在前。
+
+    参数：limit（默认 20）、name（message / compaction）、min_ms（只看慢于这个耗时的）
+    """
+    return jsonify({"traces": tracing.recent(
+        limit=request.args.get("limit", 20, type=int),
+        name=request.args.get("name") or None,
+        min_ms=request.args.get("min_ms", 0, type=float),
+    )})
+
+
+def _collect_metrics():
+    return [
+        ("mini_claw_http_in_flight", "gauge", "HTTP 频道处理中的消息数", [({}, _in_flight)]),
+        ("mini_claw_http_requests_total", "counter", "HTTP 频道按结果分类的消息数",
+         [({"result": k}, v) for k, v in stats.items()]),
+    ]
+
+
+metrics.register(_collect_metrics)
+
+
+# ============================================================
+# 服务器
+# ============================================================
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """每个连接交给固定大小的线程池，而不是每个连接新开一个线程"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, *args, threads: int = HTTP_MAX_IN_FLIGHT + HTTP_SPARE_THREADS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+
+def _serve(host: str, port: int):
+    mode = HTTP_SERVER
+    if mode == "waitress":
+        try:
+            from waitress import serve
+            serve(app, host=host, port=port, threads=HTTP_MAX_IN_FLIGHT + HTTP_SPARE_THREADS)
+            return
+        except ImportError:
+            logger.warning("未安装 waitress，改用内置的 threaded 服务器")
+            mode = "threaded"
+    if mode == "dev":
+        app.run(host=host, port=port, use_reloader=False, threaded=True)
+        return
+    server = make_server(host, port, app, server_class=_PooledWSGIServer, handler_class=_QuietHandler)
+    server.serve_forever()
 
 
 def start_http(on_message, host="127.0.0.1", port=5000):
@@ -58,14 +351,12 @@ def start_http(on_message, host="127.0.0.1", port=5000):
     启动 HTTP 服务器（后台线程），持续监听 HTTP 消息。
 
     on_message：回调函数，由 gateway.py 提供
-                签名：(chat_id: int, text: str) -> str
+                签名：(chat_id: int, text: str, on_event=None) -> str
     """
     global _on_message
     _on_message = on_message
 
-    def run():
-        app.run(host=host, port=port, use_reloader=False)
-
-    t = Thread(target=run, daemon=True)
+    t = Thread(target=_serve, args=(host, port), daemon=True)
     t.start()
-    print(f"🌐 HTTP 频道已启动：http://{host}:{port}/message")
+    print(f"🌐 HTTP 频道已启动：http://{host}:{port}/message（流式：/message/stream，异步：/message/async）"
+          f"  server={HTTP_SERVER} 在途上限={HTTP_MAX_IN_FLIGHT}")
@@ -0,0 +1,153 @@
+"""
+共享 LLM 客户端
+
+以前每个 Agent 都 new 一个 Anthropic 客户端，各自带一个 httpx 连接池，
+每个会话都要重新做 TCP / TLS 握手。
+这里改成进程级的客户端注册表：所有 Agent 共用同一个连接池，
+连接数上限、keep-alive 数量和过期时间都可以通过环境变量调整，
+装了 h2 的话自动启用 HTTP/2（一条连接多路复用多个流式请求）。
+
+异步客户端关掉了 SDK 自带的重试（max_retries=0）：排队、限流和重试统一由 llm_scheduler.py 负责。
+
+连接池的使用情况通过 httpx 的 trace 扩展统计，见 pool_stats() 和 /metrics。
+"""
+
+import os
+import logging
+import weakref
+import asyncio
+from threading import Lock
+
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
+
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "1") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================
+# 连接池统计
+#
+# httpcore 会在连接建立、TLS 握手、发请求、关闭响应时回调 trace，
+# 据此算出新建连接数、复用率和并发占用。
+# ============================================================
+
+_stats_lock = Lock()
+_stats = {
+    "requests": 0,              # 发出的 HTTP 请求数
+    "connections_opened": 0,    # 新建的 TCP 连接数
+    "tls_handshakes": 0,        # TLS 握手次数
+    "in_flight": 0,             # 当前占用连接的请求数
+    "peak_in_flight": 0,
+}
+
+
+def _on_trace(name: str, info: dict):
+    with _stats_lock:
+        if name == "connection.connect_tcp.complete":
+            _stats["connections_opened"] += 1
+        elif name == "connection.start_tls.complete":
+            _stats["tls_handshakes"] += 1
+        elif name.endswith(".send_request_headers.started"):
+            _stats["requests"] += 1
+            _stats["in_flight"] += 1
+            _stats["peak_in_flight"] = max(_stats["peak_in_flight"], _stats["in_flight"])
+        elif name.endswith(".response_closed.complete") or name.endswith(".response_closed.failed"):
+            _stats["in_flight"] -= 1
+
+
+async def _on_trace_async(name: str, info: dict):
+    _on_trace(name, info)
+
+
+async def _attach_trace_async(request: httpx.Request):
+    request.extensions["trace"] = _on_trace_async
+
+
+def pool_stats() -> dict:
+    """连接池使用情况：请求数、新建连接数、复用率、当前/峰值占用"""
+    with _stats_lock:
+        stats = dict(_stats)
+    requests = stats["requests"]
+    stats["reuse_ratio"] = 1 - stats["connections_opened"] / requests if requests else 0.0
+    stats["utilization"] = stats["in_flight"] / LLM_MAX_CONNECTIONS
+    stats["max_connections"] = LLM_MAX_CONNECTIONS
+    return stats
+
+
+def _collect_metrics():
+    stats = pool_stats()
+    return [
+        ("mini_claw_llm_http_requests_total", "counter", "发给 LLM API 的 HTTP 请求数", [({}, stats["requests"])]),
+        ("mini_claw_llm_connections_opened_total", "counter", "新建的 LLM API 连接数（TCP / TLS 握手）",
+         [({"stage": "tcp"}, stats["connections_opened"]), ({"stage": "tls"}, stats["tls_handshakes"])]),
+        ("mini_claw_llm_connection_reuse_ratio", "gauge", "连接复用率（1 - 新建连接数 / 请求数）",
+         [({}, stats["reuse_ratio"])]),
+        ("mini_claw_llm_connections_in_flight", "gauge", "正在占用连接的请求数",
+         [({}, stats["in_flight"])]),
+        ("mini_claw_llm_connections_peak_in_flight", "gauge", "占用连接的请求数峰值",
+         [({}, stats["peak_in_flight"])]),
+        ("mini_claw_llm_connection_utilization", "gauge", "连接池占用率（占用数 / LLM_MAX_CONNECTIONS）",
+         [({}, stats["utilization"])]),
+    ]
+
+
+metrics.register(_collect_metrics)
+
+
+# ============================================================
+# 客户端注册表
+# ============================================================
+
+def _http2_enabled() -> bool:
+    if not LLM_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+_client_lock = Lock()
+
+# httpx 的异步连接池绑定在创建它的事件循环上，所以按事件循环各建一个
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncAnthropic]" = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> AsyncAnthropic:
+    """当前事件循环共享的异步客户端（所有 AsyncAgent 共用一个连接池），需在协程内调用"""
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = AsyncAnthropic(
+                api_key=ANTHROPIC_API_KEY,
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=_limits(),
+                    http2=_http2_enabled(),
+                    event_hooks={"request": [_attach_trace_async]},
+                ),
+            )
+            _async_clients[loop] = client
+            logger.debug(f"创建共享 AsyncAnthropic 客户端 http2={_http2_enabled()}")
+    return client
@@ -0,0 +1,338 @@
+"""
+LLM 调用准入控制
+
+以前每个 Agent 想调就调：负载一上来，所有会话一起撞上 429，
+再一起按固定的 2 ** attempt 秒退避，醒来后又一起重试，越挤越糟。
+
+这里在所有 LLM 调用（执行轮次、规划、后台压缩）前面放一个进程级调度器：
+  - 请求数 / token 数两个令牌桶：LLM_RPM 次/分钟、LLM_TPM tokens/分钟（0 不限制）
+    准入时按估算的输入 token 预扣，响应回来后按 usage 多退少补（输出 token 也算在内）
+  - LLM_MAX_CONCURRENT 限制同时在途的请求数（0 不限制）
+  - 按会话轮转排队：一个会话连发再多调用，也只能占到自己那一份
+  - 两个优先级：执行轮次和规划（用户在等）先于后台压缩
+  - 收到 429 时按 Retry-After 整体暂停准入，所有会话一起等，而不是各自立刻重试；
+    重试前的退避加随机抖动，错开醒来的时间
+  - 排队深度、排队时间、限流次数见 stats() 和 /metrics，每次排队也记成 llm_queue span
+
+SDK 自带的重试（llm_client.py 里 max_retries=0）关掉了，重试统一在这里做，
+否则 SDK 会在调度器看不见的地方再打几次。
+
+多进程模式（GATEWAY_WORKERS > 1）下每个 worker 各有一个调度器，预算按进程数平分。
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict, deque, Counter
+from threading import Lock
+
+import httpx
+import anthropic as anthropic_lib
+
+import metrics
+import tracing
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+_WORKERS = max(1, int(os.environ.get("GATEWAY_WORKERS", "1")))
+LLM_RPM = float(os.environ.get("LLM_RPM", "0")) / _WORKERS
+LLM_TPM = float(os.environ.get("LLM_TPM", "0")) / _WORKERS
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", "0"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "30"))
+
+# 调用类型 → 优先级（数字小的先调度），没列出的按 0
+PRIORITY = {"compact": 1}
+
+# 限流 / 连接错误 / 服务端过载（5xx、529）可以重试，其余错误直接抛给调用方。
+# 流式响应读到一半连接断开时 SDK 不做包装，直接抛 httpx.TransportError，也按连接错误处理
+RETRYABLE = (anthropic_lib.RateLimitError, anthropic_lib.APIConnectionError, anthropic_lib.InternalServerError,
+             httpx.TransportError)
+# 流式响应中途收到的 error 事件（HTTP 状态码是 200），按错误类型判断能否重试
+RETRYABLE_STREAM_ERRORS = {"overloaded_error", "api_error", "rate_limit_error"}
+
+
+def retryable(error: Exception) -> bool:
+    if isinstance(error, RETRYABLE):
+        return True
+    if isinstance(error, anthropic_lib.APIStatusError) and isinstance(error.body, dict):
+        return (error.body.get("error") or {}).get("type") in RETRYABLE_STREAM_ERRORS
+    return False
+
+
+class _Budget:
+    """每分钟 limit 个单位的令牌桶，容量就是 limit；余额可以是负数（响应后补扣的超额部分）"""
+
+    def __init__(self, per_minute: float):
+        self.limit = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.limit, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, n: float, now: float) -> float:
+        """还要等多少秒才够扣 n 个（n 超过容量时等桶满即可，否则大请求永远进不去）"""
+        if self.limit <= 0:
+            return 0.0
+        self._refill(now)
+        need = min(n, self.limit)
+        return 0.0 if self.level >= need else (need - self.level) / self.rate
+
+    def take(self, n: float):
+        if self.limit > 0:
+            self.level -= n
+
+
+class _Request:
+    __slots__ = ("session", "kind", "tokens", "loop", "granted", "enqueued_at", "admitted", "cancelled")
+
+    def __init__(self, session: str, kind: str, tokens: int, loop: asyncio.AbstractEventLoop):
+        self.session = session
+        self.kind = kind
+        self.tokens = tokens
+        self.loop = loop
+        self.granted = loop.create_future()
+        self.enqueued_at = time.perf_counter()
+        self.admitted = False
+        self.cancelled = False
+
+
+def _grant(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def retry_after(error: Exception) -> float | None:
+    """从 429 / 529 响应里取 Retry-After（秒），没有时返回 None"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class LLMScheduler:
+    """
+    调度状态由一把锁保护，请求方可以在任意事件循环里等待，
+    准入结果通过 call_soon_threadsafe 交回请求方所在的循环（和 tool_pool.py 一样）。
+    令牌不够或处于 429 暂停期时，在队首请求的循环上定一个定时器，到点再调度。
+    """
+
+    def __init__(self, rpm: float = LLM_RPM, tpm: float = LLM_TPM, max_concurrent: int = LLM_MAX_CONCURRENT):
+        self.max_concurrent = max_concurrent
+        self._requests = _Budget(rpm)
+        self._tokens = _Budget(tpm)
+        self._lock = Lock()
+        # 优先级 → (会话 → 排队中的请求，按轮转顺序)
+        self._queues: dict[int, OrderedDict[str, deque]] = {}
+        self._running = 0
+        self._paused_until = 0.0
+        self._wake_at = None   # 已经定好的下一次调度时间（monotonic）
+
+        self.queue_wait: dict[str, Histogram] = {}
+        self.counters = Counter()   # admitted / rate_limited / retries / connection_errors / server_errors / gave_up
+
+    # ---------------- 对外接口 ----------------
+
+    async def call(self, session: str, kind: str, tokens: int, attempt):
+        """
+        排队拿到准入后执行 attempt()（一次完整的请求，返回 Message），返回它的结果。
+        tokens 是估算的输入 token 数，用于 LLM_TPM 预扣；返回值带 usage 时按实际用量校正。
+        可重试的错误按 Retry-After / 抖动退避后重新排队，最多重试 LLM_MAX_RETRIES 次。
+        """
+        for n in range(LLM_MAX_RETRIES + 1):
+            request = await self._acquire(session, kind, tokens)
+            used = None
+            try:
+                result = await attempt()
+                usage = getattr(result, "usage", None)
+                if usage is not None:
+                    used = ((usage.input_tokens or 0) + (usage.output_tokens or 0)
+                            + (getattr(usage, "cache_read_input_tokens", None) or 0)
+                            + (getattr(usage, "cache_creation_input_tokens", None) or 0))
+                return result
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                if n == LLM_MAX_RETRIES:
+                    self.counters["gave_up"] += 1
+                    raise
+                delay = self._backoff(e, n)
+                error = e
+            finally:
+                self._release(request, used)
+            logger.warning(f"[{kind}] {type(error).__name__}，{delay:.1f}s 后重试（第 {n + 1} 次）")
+            with tracing.span("retry_sleep", attempt=n + 1, error=type(error).__name__):
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued = Counter()
+            sessions = set()
+            for queues in self._queues.values():
+                for session, q in queues.items():
+                    sessions.add(session)
+                    for r in q:
+                        if not r.cancelled:
+                            queued[r.kind] += 1
+            now = time.monotonic()
+            return {
+                "running": self._running,
+                "queued": dict(queued),
+                "queued_sessions": len(sessions),
+                "paused_for": max(0.0, self._paused_until - now),
+                "rpm_available": self._requests.level if self._requests.limit > 0 else None,
+                "tpm_available": self._tokens.level if self._tokens.limit > 0 else None,
+                "counters": dict(self.counters),
+                "queue_wait": {kind: h.stats() for kind, h in self.queue_wait.items()},
+            }
+
+    # ---------------- 排队 / 准入 ----------------
+
+    async def _acquire(self, session: str, kind: str, tokens: int) -> _Request:
+        request = _Request(session, kind, tokens, asyncio.get_running_loop())
+        with self._lock:
+            priority = PRIORITY.get(kind, 0)
+            self._queues.setdefault(priority, OrderedDict()).setdefault(session, deque()).append(request)
+        self._dispatch()
+        try:
+            await request.granted
+        except asyncio.CancelledError:
+            # 排队中被取消（如投机规划被丢弃）：调度时跳过；已经准入的话归还名额
+            with self._lock:
+                request.cancelled = True
+                admitted = request.admitted
+            if admitted:
+                self._release(request, 0)
+            raise
+        waited = (time.perf_counter() - request.enqueued_at) * 1000
+        self.queue_wait.setdefault(kind, Histogram()).observe(waited)
+        tracing.record("llm_queue", request.enqueued_at, kind=kind)
+        return request
+
+    def _head(self) -> _Request | None:
+        """按优先级、会话轮转找到下一个该调度的请求（不出队）；必须持有锁"""
+        for priority in sorted(self._queues):
+            queues = self._queues[priority]
+            for session in list(queues):
+                q = queues[session]
+                while q and q[0].cancelled:
+                    q.popleft()
+                if q:
+                    return q[0]
+                del queues[session]
+        return None
+
+    def _pop(self, request: _Request):
+        queues = self._queues[PRIORITY.get(request.kind, 0)]
+        q = queues[request.session]
+        q.popleft()
+        if q:
+            queues.move_to_end(request.session)   # 这个会话排到最后，下次先轮别人
+        else:
+            del queues[request.session]
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self.max_concurrent and self._running >= self.max_concurrent:
+                    return
+                request = self._head()
+                if request is None:
+                    return
+                now = time.monotonic()
+                delay = max(self._paused_until - now,
+                            self._requests.wait_time(1, now),
+                            self._tokens.wait_time(request.tokens, now))
+                if delay > 0:
+                    # 队首进不去就整体等：后面的请求不能插队，否则大请求和低优先级会一直饿着
+                    self._schedule_wake(request.loop, now + delay)
+                    return
+                self._pop(request)
+                self._requests.take(1)
+                self._tokens.take(request.tokens)
+                self._running += 1
+                request.admitted = True
+                self.counters["admitted"] += 1
+            request.loop.call_soon_threadsafe(_grant, request.granted)
+
+    def _schedule_wake(self, loop: asyncio.AbstractEventLoop, at: float):
+        """必须持有锁；已经有更早的定时器就不再重复定"""
+        if self._wake_at is not None and self._wake_at <= at:
+            return
+        self._wake_at = at
+
+        def wake():
+            with self._lock:
+                if self._wake_at == at:
+                    self._wake_at = None
+            self._dispatch()
+
+        loop.call_soon_threadsafe(lambda: loop.call_later(max(0.0, at - time.monotonic()), wake))
+
+    def _release(self, request: _Request, used: int | None):
+        with self._lock:
+            if not request.admitted:
+                return
+            request.admitted = False
+            self._running -= 1
+            if used is not None:
+                self._tokens.take(used - request.tokens)   # 多退少补
+        self._dispatch()
+
+    # ---------------- 退避 ----------------
+
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        """
+        算出这次重试前要等的秒数。
+        有 Retry-After：整个调度器暂停到那时，再加一点抖动错开各会话的重试；
+        没有：指数退避的全抖动（0 ~ base * 2^attempt 之间随机）。
+        """
+        if isinstance(error, anthropic_lib.RateLimitError):
+            self.counters["rate_limited"] += 1
+        elif isinstance(error, (anthropic_lib.APIConnectionError, httpx.TransportError)):
+            self.counters["connection_errors"] += 1
+        else:
+            self.counters["server_errors"] += 1
+        self.counters["retries"] += 1
+
+        wait = retry_after(error)
+        if wait is not None:
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + wait)
+            return min(LLM_BACKOFF_MAX, wait) + random.uniform(0, LLM_BACKOFF_BASE)
+        return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+scheduler = LLMScheduler()
+
+
+def _collect_metrics():
+    stats = scheduler.stats()
+    return [
+        ("mini_claw_llm_running", "gauge", "正在进行的 LLM 请求数", [({}, stats["running"])]),
+        ("mini_claw_llm_queued", "gauge", "在准入队列里等待的 LLM 调用数",
+         [({"call": kind}, n) for kind, n in sorted(stats["queued"].items())] or [({}, 0)]),
+        ("mini_claw_llm_paused_seconds", "gauge", "429 后剩余的整体暂停时间（秒）", [({}, stats["paused_for"])]),
+        ("mini_claw_llm_queue_wait_ms", "histogram", "LLM 调用在准入队列里的等待时间（毫秒）",
+         [({"call": kind}, h) for kind, h in sorted(scheduler.queue_wait.items())]),
+        ("mini_claw_llm_scheduler_total", "counter", "LLM 调度器事件（准入 / 限流 / 重试 / 放弃）",
+         [({"event": k}, v) for k, v in sorted(stats["counters"].items())]),
+    ]
+
+
+metrics.register(_collect_metrics)
@@ -0,0 +1,122 @@
+"""
+运行指标
+
+固定分桶的直方图（毫秒），线程安全。记录开销是一次二分查找加一次加法，
+可以放在每次工具调用、每次 LLM 请求这样的热路径上。
+
+各模块用 register() 注册一个采集函数，render_prometheus() 汇总成
+Prometheus 文本格式（HTTP 频道的 /metrics）。只统计本进程。
+"""
+
+import bisect
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# 默认分桶上界（毫秒），最后一个桶是 +Inf
+DEFAULT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value_ms: float) -> None:
+        i = bisect.bisect_left(self.buckets, value_ms)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value_ms
+
+    def percentile(self, p: float) -> float:
+        """按桶上界估算分位数（落在 +Inf 桶时返回最后一个有限上界）"""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = self.count * p / 100
+            seen = 0
+            for i, n in enumerate(self.counts):
+                seen += n
+                if seen >= rank and n:
+                    return float(self.buckets[min(i, len(self.buckets) - 1)])
+            return float(self.buckets[-1])
+
+    def snapshot(self) -> dict:
+        """累计分桶计数（le → count），和 Prometheus histogram 的语义一致"""
+        with self._lock:
+            cumulative, total = {}, 0
+            for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+                total += n
+                cumulative[bound] = total
+            return {"buckets": cumulative, "count": self.count, "sum": self.sum}
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count, 1) if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+        }
+
+
+# ============================================================
+# Prometheus 文本格式
+# ============================================================
+
+_collectors: list = []
+
+
+def register(collector) -> None:
+    """
+    注册一个采集函数，/metrics 被请求时调用。
+
+    collector() 返回 [(指标名, 类型, 说明, [(labels, 值)])]：
+    类型是 counter / gauge / histogram，histogram 的值是 Histogram 对象。
+    """
+    _collectors.append(collector)
+
+
+def _number(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict, le=None) -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in labels.items()]
+    if le is not None:
+        parts.append(f'le="{_number(le)}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_prometheus() -> str:
+    lines = []
+    for collector in _collectors:
+        try:
+            families = collector()
+        except Exception as e:
+            logger.error(f"指标采集失败 {collector!r}: {e}")
+            continue
+        for name, kind, help_text, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                snap = value.snapshot()
+                for bound, count in snap["buckets"].items():
+                    lines.append(f"{name}_bucket{_labels(labels, bound)} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(snap['sum'])}")
+                lines.append(f"{name}_count{_labels(labels)} {snap['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,185 @@
+"""
+分档模型路由
+
+以前 Agent.model 写死一个模型，规划、压缩摘要、chat 模式闲聊都用最强（也最贵、最慢）的那个。
+这里按 调用类型（plan / turn / compact）× 对话模式（code / chat）从配置里选模型和 max_tokens：
+
+    MODEL_ROUTES=plan=fast:512,compact=fast:1024,turn.chat=fast:2048,turn=strong:4096
+
+  - 每一项是 调用类型[.模式]=档位或模型名[:max_tokens]，带模式的优先于不带模式的
+  - 档位 strong / fast 对应 MODEL_STRONG / MODEL_FAST，也可以直接写完整的模型名
+  - 没有配置的调用类型用 strong 和 DEFAULT_MAX_TOKENS
+
+MODEL_ESCALATE=1 时，非 strong 档的调用失败（重试用完仍限流、模型不可用、请求被拒等）
+或者因为 max_tokens 被截断，就换 strong 档（max_tokens 至少翻倍）重做一次。
+
+每次调用按 (调用类型, 模型) 记耗时、token 用量和估算费用，见 stats() 和 /metrics，
+用来对照数据检验路由配置是否划算。
+"""
+
+import os
+import logging
+from collections import Counter
+from threading import Lock
+from typing import NamedTuple
+
+import anthropic as anthropic_lib
+
+import metrics
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+MODEL_STRONG = os.environ.get("MODEL_STRONG", "claude-sonnet-4-20250514")
+MODEL_FAST = os.environ.get("MODEL_FAST", "claude-haiku-4-5-20251001")
+MODEL_ROUTES = os.environ.get("MODEL_ROUTES", "plan=fast:512,compact=fast:1024,turn.chat=fast:2048,turn=strong:4096")
+MODEL_ESCALATE = os.environ.get("MODEL_ESCALATE", "1") == "1"
+
+TIERS = {"strong": MODEL_STRONG, "fast": MODEL_FAST}
+DEFAULT_MAX_TOKENS = {"plan": 512, "compact": 1024, "turn": 4096}
+
+# 每百万 token 的美元价格（输入, 输出），按模型名前缀匹配；缓存读 0.1 倍、缓存写 1.25 倍输入价
+# 不认识的模型费用记 0，只看 token 数
+PRICES = {
+    "claude-opus-4": (15.0, 75.0),
+    "claude-sonnet-4": (3.0, 15.0),
+    "claude-3-7-sonnet": (3.0, 15.0),
+    "claude-3-5-sonnet": (3.0, 15.0),
+    "claude-haiku-4": (1.0, 5.0),
+    "claude-3-5-haiku": (0.8, 4.0),
+    "claude-3-haiku": (0.25, 1.25),
+}
+
+# 换强模型也没用的错误，不升级
+_NO_ESCALATE = (anthropic_lib.AuthenticationError, anthropic_lib.PermissionDeniedError)
+
+
+class Route(NamedTuple):
+    model: str
+    max_tokens: int
+    tier: str            # strong / fast / custom
+
+
+def _resolve(value: str, kind: str) -> Route:
+    name, _, limit = value.partition(":")
+    name = name.strip()
+    max_tokens = int(limit) if limit.strip() else DEFAULT_MAX_TOKENS.get(kind, 4096)
+    if name in TIERS:
+        return Route(TIERS[name], max_tokens, name)
+    return Route(name, max_tokens, "strong" if name == MODEL_STRONG else "custom")
+
+
+def parse_routes(spec: str) -> dict[str, Route]:
+    """'plan=fast:512,turn.chat=fast' → {"plan": Route, "turn.chat": Route}"""
+    routes = {}
+    for item in spec.split(","):
+        key, sep, value = item.partition("=")
+        if not sep or not value.strip():
+            continue
+        key = key.strip()
+        routes[key] = _resolve(value, key.split(".")[0])
+    return routes
+
+
+_routes = parse_routes(MODEL_ROUTES)
+
+
+def route(kind: str, mode: str) -> Route:
+    """这次调用用哪个模型、max_tokens 多少"""
+    found = _routes.get(f"{kind}.{mode}") or _routes.get(kind)
+    if found is not None:
+        return found
+    return Route(MODEL_STRONG, DEFAULT_MAX_TOKENS.get(kind, 4096), "strong")
+
+
+def escalate(kind: str, current: Route, error: Exception | None = None) -> Route | None:
+    """失败（error）或被 max_tokens 截断（error=None）后该换成的路由；不该升级时返回 None"""
+    if not MODEL_ESCALATE or current.model == MODEL_STRONG:
+        return None
+    if error is not None and (isinstance(error, _NO_ESCALATE) or not isinstance(error, anthropic_lib.APIError)):
+        return None
+    max_tokens = max(DEFAULT_MAX_TOKENS.get(kind, 4096), current.max_tokens * 2)
+    return Route(MODEL_STRONG, max_tokens, "strong")
+
+
+# ============================================================
+# 按调用类型 × 模型统计
+# ============================================================
+
+def _price(model: str) -> tuple[float, float]:
+    for prefix, price in PRICES.items():
+        if model.startswith(prefix):
+            return price
+    return 0.0, 0.0
+
+
+def cost_usd(model: str, usage) -> float:
+    """按 PRICES 估算一次响应的费用（美元）"""
+    if usage is None:
+        return 0.0
+    price_in, price_out = _price(model)
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return ((usage.input_tokens or 0) * price_in + cache_read * price_in * 0.1
+            + cache_write * price_in * 1.25 + (usage.output_tokens or 0) * price_out) / 1e6
+
+
+_lock = Lock()
+latency: dict[tuple[str, str], Histogram] = {}     # (调用类型, 模型) → 单次请求耗时（毫秒，不含排队）
+tokens: Counter = Counter()                         # (调用类型, 模型, input/output) → token 数
+cost: Counter = Counter()                           # (调用类型, 模型) → 美元
+outcomes: Counter = Counter()                       # (调用类型, 模型, ok/error/max_tokens/escalated) → 次数
+
+
+def record(kind: str, model: str, ms: float | None, usage=None, outcome: str = "ok") -> None:
+    with _lock:
+        if ms is not None:
+            hist = latency.get((kind, model))
+            if hist is None:
+                hist = latency[(kind, model)] = Histogram()
+            hist.observe(ms)
+        outcomes[(kind, model, outcome)] += 1
+        if usage is not None:
+            tokens[(kind, model, "input")] += usage.input_tokens or 0
+            tokens[(kind, model, "output")] += usage.output_tokens or 0
+            cost[(kind, model)] += cost_usd(model, usage)
+
+
+def stats() -> dict:
+    """{"plan/claude-haiku-4-5-...": {calls, p50_ms, p95_ms, input_tokens, output_tokens, cost_usd, ...}}"""
+    with _lock:
+        keys = {(k, m) for k, m, _ in outcomes}
+        out = {}
+        for kind, model in sorted(keys):
+            hist = latency.get((kind, model))
+            out[f"{kind}/{model}"] = {
+                "calls": hist.count if hist else 0,
+                "p50_ms": hist.percentile(50) if hist else 0.0,
+                "p95_ms": hist.percentile(95) if hist else 0.0,
+                "input_tokens": tokens[(kind, model, "input")],
+                "output_tokens": tokens[(kind, model, "output")],
+                "cost_usd": round(cost[(kind, model)], 6),
+                **{o: n for (k, m, o), n in outcomes.items() if (k, m) == (kind, model) and o != "ok"},
+            }
+        return out
+
+
+def _collect_metrics():
+    with _lock:
+        hists = sorted(latency.items())
+        token_items = sorted(tokens.items())
+        cost_items = sorted(cost.items())
+        outcome_items = sorted(outcomes.items())
+    return [
+        ("mini_claw_llm_call_ms", "histogram", "单次 LLM 请求耗时（毫秒，不含准入排队），按调用类型和模型",
+         [({"call": k, "model": m}, h) for (k, m), h in hists]),
+        ("mini_claw_llm_model_tokens_total", "counter", "LLM token 用量，按调用类型和模型",
+         [({"call": k, "model": m, "type": t}, n) for (k, m, t), n in token_items]),
+        ("mini_claw_llm_cost_usd_total", "counter", "按价目表估算的 LLM 费用（美元）",
+         [({"call": k, "model": m}, v) for (k, m), v in cost_items]),
+        ("mini_claw_llm_calls_total", "counter", "LLM 调用次数，按结果（ok / error / max_tokens / escalated）",
+         [({"call": k, "model": m, "outcome": o}, n) for (k, m, o), n in outcome_items]),
+    ]
+
+
+metrics.register(_collect_metrics)
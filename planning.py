@@ -0,0 +1,152 @@
+"""
+规划策略
+
+code 模式下每条消息都要先单独调一次 LLM 做规划，简单问题也不例外，
+还会往历史里塞三条合成消息。这里决定每条消息要不要规划、怎么规划：
+
+  always       — 总是先规划（原来的行为）
+  heuristic    — 简短、单一的请求跳过规划，直接进入执行
+  speculative  — 规划和第一轮执行同时发出：第一轮直接答完就不要计划了，
+                 需要调工具再等计划、按计划执行
+
+三种模式都会先查计划缓存（按规范化后的请求文本），命中就不再调 LLM。
+每种决策都记录节省的延迟和 token，见 stats() 和 /metrics。
+"""
+
+import os
+import re
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PLANNING_MODE = os.environ.get("PLANNING_MODE", "heuristic")
+PLAN_CACHE_SIZE = int(os.environ.get("PLAN_CACHE_SIZE", "256"))
+PLAN_MIN_CHARS = int(os.environ.get("PLAN_MIN_CHARS", "60"))
+
+# 出现这些词通常意味着多步骤任务，值得先规划
+_MULTI_STEP_HINTS = (
+    "然后", "并且", "之后", "接着", "步骤", "所有", "每个", "全部", "整个", "对比", "比较",
+    "重构", "梳理", "分析一下", "总结", "架构",
+    " then ", " and then ", "step", "all ", "every ", "each ", "compare", "refactor",
+)
+
+_PUNCT_RE = re.compile(r"[\s\.,!?;:，。！？；：、…~]+")
+
+
+def normalize(text: str) -> str:
+    """计划缓存的 key：小写、去掉标点、合并空白"""
+    return _PUNCT_RE.sub(" ", text.lower()).strip()
+
+
+def looks_simple(text: str) -> bool:
+    """启发式分类：短、单行、没有多步骤信号的请求视为简单请求"""
+    if len(text) >= PLAN_MIN_CHARS or "\n" in text.strip():
+        return False
+    lowered = f" {text.lower()} "
+    return not any(hint in lowered for hint in _MULTI_STEP_HINTS)
+
+
+class PlanningPolicy:
+    """进程共享：决策 + 计划缓存 + 统计"""
+
+    def __init__(self, mode: str = PLANNING_MODE, cache_size: int = PLAN_CACHE_SIZE):
+        if mode not in ("always", "heuristic", "speculative"):
+            logger.warning(f"未知 PLANNING_MODE={mode!r}，改用 heuristic")
+            mode = "heuristic"
+        self.mode = mode
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._lock = Lock()
+
+        # 一次真实规划调用的平均耗时 / token（指数移动平均），用来折算节省量
+        self.avg_plan_ms = 0.0
+        self.avg_plan_tokens = 0.0
+        self.counts = {"planned": 0, "skipped": 0, "cache_hits": 0,
+                       "speculative_direct": 0, "speculative_planned": 0}
+        self.saved_ms = 0.0
+        self.saved_tokens = 0.0
+        self.wasted_tokens = 0
+
+    def decide(self, text: str) -> str:
+        """返回 "cached" / "skip" / "plan" / "speculative" 之一"""
+        if self.lookup(text) is not None:
+            return "cached"
+        if self.mode == "heuristic" and looks_simple(text):
+            return "skip"
+        if self.mode == "speculative":
+            return "speculative"
+        return "plan"
+
+    def lookup(self, text: str) -> str | None:
+        with self._lock:
+            key = normalize(text)
+            plan = self._cache.get(key)
+            if plan is not None:
+                self._cache.move_to_end(key)
+            return plan
+
+    def remember(self, text: str, plan: str) -> None:
+        with self._lock:
+            key = normalize(text)
+            self._cache[key] = plan
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # ---------------- 统计 ----------------
+
+    def record_plan(self, elapsed_ms: float, tokens: int) -> None:
+        """真实调用了一次规划"""
+        self.counts["planned"] += 1
+        if self.counts["planned"] == 1:
+            self.avg_plan_ms, self.avg_plan_tokens = elapsed_ms, float(tokens)
+        else:
+            self.avg_plan_ms = 0.8 * self.avg_plan_ms + 0.2 * elapsed_ms
+            self.avg_plan_tokens = 0.8 * self.avg_plan_tokens + 0.2 * tokens
+
+    def record_saved(self, kind: str) -> None:
+        """kind：skipped / cache_hits / speculative_direct，按平均规划开销折算节省量"""
+        self.counts[kind] += 1
+        self.saved_ms += self.avg_plan_ms
+        self.saved_tokens += self.avg_plan_tokens
+
+    def record_speculation_wasted(self, tokens: int) -> None:
+        """投机执行的第一轮被丢弃（需要工具，改为按计划执行）"""
+        self.counts["speculative_planned"] += 1
+        self.wasted_tokens += tokens
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            **self.counts,
+            "cache_size": len(self._cache),
+            "avg_plan_ms": round(self.avg_plan_ms, 1),
+            "saved_ms": round(self.saved_ms, 1),
+            "saved_tokens": round(self.saved_tokens),
+            "wasted_tokens": self.wasted_tokens,
+        }
+
+
+policy = PlanningPolicy()
+
+
+def _collect_metrics():
+    stats = policy.stats()
+    return [
+        ("mini_claw_planning_decisions_total", "counter", "规划决策次数，按决策类型",
+         [({"decision": k}, stats[k]) for k in policy.counts]),
+        ("mini_claw_planning_saved_ms_total", "counter", "跳过规划、命中缓存、投机直接答完折算省下的规划耗时（毫秒）",
+         [({}, stats["saved_ms"])]),
+        ("mini_claw_planning_tokens_total", "counter", "规划省下的 token（saved）和投机执行被丢弃的 token（wasted）",
+         [({"type": "saved"}, stats["saved_tokens"]), ({"type": "wasted"}, stats["wasted_tokens"])]),
+        ("mini_claw_planning_avg_plan_ms", "gauge", "一次真实规划调用的平均耗时（毫秒，指数移动平均）",
+         [({}, stats["avg_plan_ms"])]),
+        ("mini_claw_plan_cache_entries", "gauge", "计划缓存条目数", [({}, stats["cache_size"])]),
+    ]
+
+
+metrics.register(_collect_metrics)
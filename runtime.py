@@ -0,0 +1,52 @@
+"""
+后台事件循环
+
+整个进程共用一个 asyncio 事件循环，跑在一个 daemon 线程里。
+Gateway 的调度器和所有 AsyncAgent 都挂在这个循环上，
+同步代码（Flask 请求线程、Telegram 轮询线程）通过 run_sync() 提交协程并等待结果。
+
+这样无论有多少个会话，等待 LLM 时都不再各自占用一个 OS 线程。
+"""
+
+import asyncio
+import logging
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+_loop: asyncio.AbstractEventLoop | None = None
+_lock = Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """获取后台事件循环，首次调用时启动循环线程"""
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            t = Thread(target=loop.run_forever, name="mini-claw-loop", daemon=True)
+            t.start()
+            _loop = loop
+            logger.debug("后台事件循环已启动")
+    return _loop
+
+
+def submit(coro):
+    """把协程提交到后台事件循环，立即返回 concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_sync(coro, timeout: float | None = None):
+    """
+    同步适配器：提交协程并阻塞等待结果。
+
+    不能在事件循环线程内部调用（会死锁），协程代码里请直接 await。
+    """
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is not None and running is _loop:
+        coro.close()
+        raise RuntimeError("run_sync() 不能在后台事件循环内调用，请直接 await")
+    return submit(coro).result(timeout)
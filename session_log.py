@@ -0,0 +1,216 @@
+"""
+会话文件写入
+
+原来每条消息都 open(..., "a") → 写一行 → close，一次 code 模式的 run() 至少写五次，
+慢盘 / 网络盘上每次 open/close 都是看得见的延迟。
+
+SessionFile 把一次 run() 里的消息先缓存在内存，run() 结束时一次 write 写出，
+文件句柄保持打开（全进程最多 SESSION_MAX_OPEN_FILES 个，超出按 LRU 关掉最久没用的，
+下次写时再打开）。
+
+SESSION_DURABILITY 决定落盘策略：
+  none     — 每轮一次 write，不 fsync（交给操作系统刷盘；进程崩溃会丢当前这一轮）
+  turn     — 每轮一次 write + fsync
+  message  — 每条消息立即 write + fsync（最慢，最安全）
+
+压缩后的整体重写走临时文件 + fsync + os.replace，中途崩溃不会留下半个文件。
+
+write / fsync / rename / unlink 都不在调用方线程上做，而是交给写线程（SESSION_WRITER_THREADS 个，
+按文件路径分片，每个线程一个 FIFO 队列），慢盘上的 fsync 不会卡住事件循环：
+  - 同一个文件的操作总在同一个写线程上按提交顺序执行，写入顺序和调用顺序一致
+  - append（message 策略）/ rewrite / delete / close 只提交不等待
+  - flush_async() 提交本轮缓存并等到这个文件之前提交的所有操作都完成，run() 结束时 await 它；
+    flush() 是同步版本，给不在事件循环上的调用方（加载历史、统计、迁移）用
+"""
+
+import os
+import atexit
+import asyncio
+import logging
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+SESSION_DURABILITY = os.environ.get("SESSION_DURABILITY", "none")
+SESSION_MAX_OPEN_FILES = int(os.environ.get("SESSION_MAX_OPEN_FILES", "256"))
+SESSION_WRITER_THREADS = max(1, int(os.environ.get("SESSION_WRITER_THREADS", "4")))
+
+if SESSION_DURABILITY not in ("none", "turn", "message"):
+    logger.warning(f"未知 SESSION_DURABILITY={SESSION_DURABILITY!r}，改用 none")
+    SESSION_DURABILITY = "none"
+
+# 当前持有打开句柄的 SessionFile，按最近使用排序
+_open_files: OrderedDict = OrderedDict()
+_open_lock = Lock()
+# 所有还有未写出内容的 SessionFile，进程退出时补写
+_live_files: "weakref.WeakSet[SessionFile]" = weakref.WeakSet()
+# 写线程：每个只有一个线程，保证分到它上面的文件按提交顺序写
+_writers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"session-writer-{i}")
+            for i in range(SESSION_WRITER_THREADS)]
+
+
+class SessionFile:
+    def __init__(self, path, durability: str = SESSION_DURABILITY):
+        self.path = str(path)
+        self.durability = durability
+        self._buffer: list[str] = []
+        self._handle = None
+        self._io_lock = Lock()      # 写线程写入时持有；别的文件按 LRU 关句柄前要先拿到它
+        self._writer = _writers[hash(self.path) % len(_writers)]
+        self._last: Future | None = None
+        self.writes = 0    # 实际 write 次数
+        self.fsyncs = 0
+        _live_files.add(self)
+
+    # ---------------- 读 ----------------
+
+    def exists(self) -> bool:
+        pending = self._last is not None and not self._last.done()
+        return bool(self._buffer) or pending or os.path.exists(self.path)
+
+    def lines(self):
+        """逐行读取（含还没写出的缓存）"""
+        self.flush()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                yield from f
+        except FileNotFoundError:
+            return
+
+    # ---------------- 写 ----------------
+
+    def append(self, line: str) -> None:
+        """追加一行（line 已带换行符）；message 策略下立即交给写线程"""
+        self._buffer.append(line)
+        if self.durability == "message":
+            self._submit(self._write, self._take())
+
+    def flush(self) -> None:
+        """把缓存的行写出，等到这个文件之前提交的操作全部完成；turn / message 策略下 fsync"""
+        self._submit(self._write, self._take()).result()
+
+    async def flush_async(self) -> None:
+        """flush() 的协程版本：写入和 fsync 在写线程上做，事件循环只等结果"""
+        # shield：调用方被取消时已经提交的写入照样完成，不能被一起取消
+        await asyncio.shield(asyncio.wrap_future(self._submit(self._write, self._take())))
+
+    def wait(self) -> None:
+        """等到已经提交给写线程的操作都完成（不写出缓存，可以在其他线程上调用）"""
+        last = self._last
+        if last is not None:
+            last.exception()
+
+    def rewrite(self, lines: list[str]) -> None:
+        """用 lines 整体替换文件内容：写临时文件、fsync、再原子 rename（在写线程上执行，不等待）"""
+        self._buffer.clear()
+        self._submit(self._rewrite, list(lines))
+
+    def delete(self) -> None:
+        self._buffer.clear()
+        self._submit(self._delete)
+
+    def _take(self) -> str:
+        data = "".join(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def _submit(self, fn, *args) -> Future:
+        self._last = future = self._writer.submit(self._run, fn, *args)
+        return future
+
+    def _run(self, fn, *args):
+        try:
+            return fn(*args)
+        except Exception as e:
+            logger.error(f"写会话文件失败 {self.path}: {e}")
+            raise
+
+    # 以下在写线程上执行（进程退出时由 _flush_all 直接调用）
+
+    def _write(self, data: str) -> None:
+        if not data:
+            return
+        with self._io_lock:
+            f = self._open()
+            f.write(data)
+            f.flush()
+            self.writes += 1
+            if self.durability != "none":
+                os.fsync(f.fileno())
+                self.fsyncs += 1
+
+    def _rewrite(self, lines: list[str]) -> None:
+        self._close()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.writes += 1
+        self.fsyncs += 1
+
+    def _delete(self) -> None:
+        self._close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    # ---------------- 句柄 ----------------
+
+    def _open(self):
+        """调用方持有 self._io_lock"""
+        with _open_lock:
+            if self._handle is not None:
+                _open_files.move_to_end(self)
+                return self._handle
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._handle = open(self.path, "a", encoding="utf-8")
+            _open_files[self] = None
+            # 超出上限按 LRU 关句柄；正在别的写线程上写的文件跳过，下次再关
+            for oldest in list(_open_files):
+                if len(_open_files) <= SESSION_MAX_OPEN_FILES:
+                    break
+                if oldest is self or not oldest._io_lock.acquire(blocking=False):
+                    continue
+                try:
+                    del _open_files[oldest]
+                    oldest._close_handle()
+                finally:
+                    oldest._io_lock.release()
+            return self._handle
+
+    def _close_handle(self):
+        """关闭句柄；调用方持有 _open_lock"""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _close(self) -> None:
+        with self._io_lock, _open_lock:
+            _open_files.pop(self, None)
+            self._close_handle()
+
+    def close(self) -> None:
+        """写出缓存并关闭句柄（会话被逐出会话池时调用；交给写线程，不等待）"""
+        self._submit(self._write_and_close, self._take())
+
+    def _write_and_close(self, data: str) -> None:
+        self._write(data)
+        self._close()
+
+
+@atexit.register
+def _flush_all():
+    # 写线程在 atexit 之前已经跑完队列并退出，这里直接在当前线程写
+    for f in list(_live_files):
+        try:
+            f._write(f._take())
+            f._close()
+        except Exception as e:
+            logger.error(f"退出时写出会话文件失败 {f.path}: {e}")
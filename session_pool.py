@@ -0,0 +1,127 @@
+"""
+会话池
+
+对应 OpenClaw：session 生命周期管理
+
+gateway 原来用一个普通 dict 存所有 Agent，进程活多久就涨多久。
+会话池给它加上内存预算：
+  - 按会话数（max_sessions）或历史消息的近似字节数（max_bytes）限额
+  - 超出预算时按 LRU 顺序淘汰空闲的 Agent（正在处理消息的不动）
+  - 被淘汰的会话下次来消息时由 factory 重新创建，
+    Agent 构造时会从会话存储（session_store.py）重新加载历史，用户无感知
+"""
+
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class SessionQueueFull(Exception):
+    """该会话排队等待的消息数已达上限（gateway 抛出，Channel 转成 429 或提示语）"""
+
+
+# 开启连发合并（gateway 的 SESSION_COALESCE）时，并进同一轮的消息里除最后一条以外拿到的结果：
+# 这一轮的流式输出和回复只随最后一条发出，Channel 收到它时什么都不发
+MERGED_REPLY = "\x00merged"
+
+
+class SessionPool:
+    """
+    带 LRU 淘汰的会话池。
+
+    factory(key)          → 创建新会话对象
+    is_busy(key)          → 该会话是否正在使用（忙碌的会话不会被淘汰）
+    on_evict(key, value)  → 淘汰前回调，可用来保存少量内存状态
+    size_of(value)        → 会话占用的近似字节数
+
+    max_sessions / max_bytes 为 0 表示不限制。
+    """
+
+    def __init__(self, factory, max_sessions: int = 0, max_bytes: int = 0,
+                 is_busy=None, on_evict=None, size_of=None):
+        self._factory = factory
+        self._is_busy = is_busy or (lambda key: False)
+        self._on_evict = on_evict
+        self._size_of = size_of or (lambda value: 0)
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._items: OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """获取会话，不存在则创建（或从磁盘重建），并标记为最近使用"""
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+
+        self.misses += 1
+        value = self._factory(key)
+        self._items[key] = value
+        self.trim(protect=key)
+        return value
+
+    def insert(self, key, value) -> None:
+        """放入在别处创建好的会话（比如在线程里从磁盘重建的），计一次未命中"""
+        self.misses += 1
+        self._items[key] = value
+        self._items.move_to_end(key)
+        self.trim(protect=key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def total_bytes(self) -> int:
+        """池内所有会话的近似字节数"""
+        return sum(self._size_of(v) for v in self._items.values())
+
+    def _over_budget(self, count: int, total: int) -> bool:
+        if self.max_sessions and count > self.max_sessions:
+            return True
+        if self.max_bytes and total > self.max_bytes:
+            return True
+        return False
+
+    def trim(self, protect=None) -> int:
+        """
+        淘汰空闲会话直到回到预算内，返回淘汰数量。
+
+        从最久未使用的开始，跳过忙碌的会话和 protect 指定的会话（刚创建、马上要用）；
+        如果剩下的全是忙碌会话，就暂时超出预算，等它们空闲后再淘汰。
+        """
+        count = len(self._items)
+        total = self.total_bytes() if self.max_bytes else 0
+        if not self._over_budget(count, total):
+            return 0
+        evicted = 0
+        for key in list(self._items):
+            if not self._over_budget(count, total):
+                break
+            if key == protect or self._is_busy(key):
+                continue
+            value = self._items.pop(key)
+            count -= 1
+            total -= self._size_of(value) if self.max_bytes else 0
+            if self._on_evict:
+                self._on_evict(key, value)
+            evicted += 1
+            logger.debug(f"[{key}] 会话被淘汰（LRU）")
+        self.evictions += evicted
+        return evicted
+
+    def stats(self) -> dict:
+        """命中/未命中/淘汰计数，以及当前占用"""
+        return {
+            "sessions": len(self._items),
+            "bytes": self.total_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
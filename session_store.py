@@ -0,0 +1,444 @@
+"""
+会话存储
+
+AsyncAgent 通过 SessionStore 接口读写历史，后端可替换（SESSION_STORE）：
+
+  jsonl   — 原来的 sessions/<id>.jsonl，每个会话一个文件（写入走 session_log.py 的缓冲）
+  sqlite  — 标准库 sqlite3，WAL 模式，所有会话一个数据库文件（SESSION_DB）
+
+SQLite 后端按 (session_id, seq) 有序存行。压缩重写不删旧行，而是把它们标记为 archived，
+再插入新的历史（摘要 + 保留的近期消息），所以：
+  - 冷启动只按索引读取最后一次压缩之后的行，不解析被压缩掉的历史
+  - 旧对话仍然留在库里，可以跨会话查询（sessions() / search()）
+
+已有的 sessions/*.jsonl 用迁移命令导入：
+    python session_store.py migrate --src sessions --db sessions/sessions.db
+"""
+
+import os
+import glob
+import json
+import re
+import time
+import asyncio
+import sqlite3
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from session_log import SessionFile, SESSION_DURABILITY
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORE = os.environ.get("SESSION_STORE", "jsonl")
+SESSION_DIR = os.environ.get("SESSION_DIR", "sessions")
+SESSION_DB = os.environ.get("SESSION_DB", os.path.join(SESSION_DIR, "sessions.db"))
+
+# 会话行里的 blob 引用（blob_store.externalize 产生的 "blob": "<sha256>"）
+_BLOB_REF_RE = re.compile(r'"blob":\s*"([0-9a-f]{64})"')
+
+
+def clean_content_blocks(message: dict) -> dict:
+    """
+    清理消息 content 中多余的字段，只保留 API 协议字段。
+
+    加载旧版 .jsonl 时修复因 SDK 升级引入的额外字段
+    （如 citations、parsed_output、caller 等）。
+    """
+    content = message.get("content")
+    if not isinstance(content, list):
+        return message
+    cleaned = []
+    for block in content:
+        if not isinstance(block, dict):
+            cleaned.append(block)
+            continue
+        t = block.get("type")
+        if t == "text":
+            cleaned.append({"type": "text", "text": block["text"]})
+        elif t == "tool_use":
+            cleaned.append({"type": "tool_use", "id": block["id"],
+                             "name": block["name"], "input": block["input"]})
+        else:
+            cleaned.append(block)  # tool_result 等保持原样
+    return {**message, "content": cleaned}
+
+
+class SessionStore(ABC):
+    """
+    存储接口。消息以序列化好的 JSON 行（带换行符）进出，
+    序列化由 AsyncAgent 负责，存储层不关心消息结构（旧版 jsonl 的多余字段用 clean_content_blocks 清理）。
+    """
+
+    # 读出来的消息是否还需要 clean_content_blocks 清理（旧版 jsonl 可能带多余字段）
+    clean_on_load = True
+
+    @abstractmethod
+    def load(self, session_id: str) -> list[str]:
+        """读取会话当前的历史（最后一次压缩之后的部分）"""
+
+    @abstractmethod
+    def append(self, session_id: str, line: str) -> None:
+        """追加一条消息（可以先缓存，flush 时写出）"""
+
+    @abstractmethod
+    def flush(self, session_id: str) -> None:
+        """写出该会话缓存的消息"""
+
+    async def flush_async(self, session_id: str) -> None:
+        """flush() 的协程版本，每轮 run() 结束时 await；落盘（fsync）不在事件循环线程上做"""
+        await asyncio.to_thread(self.flush, session_id)
+
+    @abstractmethod
+    def rewrite(self, session_id: str, lines: list[str]) -> None:
+        """压缩后用新的历史整体替换，必须是原子的"""
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        """/reset：删除会话的全部历史"""
+
+    def close(self, session_id: str) -> None:
+        """会话被逐出会话池：写出缓存、释放资源"""
+        self.flush(session_id)
+
+    @abstractmethod
+    def sessions(self) -> list[dict]:
+        """所有会话的概况：[{"session_id", "messages", "updated_at"}]"""
+
+    @abstractmethod
+    def search(self, text: str, limit: int = 50) -> list[dict]:
+        """跨会话按子串搜索当前历史：[{"session_id", "seq", "role", "content"}]"""
+
+    @abstractmethod
+    def referenced_blobs(self) -> set[str]:
+        """
+        所有会话当前历史里引用的 blob（blob_store 垃圾回收的标记阶段）。
+        在 GC 线程上调用：只读已经写出的内容，不动各会话的写缓存（还没写出的引用由 GC 宽限期兜底）
+        """
+
+
+# ============================================================
+# JSONL 后端
+# ============================================================
+
+class JsonlStore(SessionStore):
+    clean_on_load = True
+
+    def __init__(self, directory: str = SESSION_DIR, durability: str = SESSION_DURABILITY):
+        self.directory = directory
+        self.durability = durability
+        self._files: dict[str, SessionFile] = {}
+
+    def _file(self, session_id: str) -> SessionFile:
+        f = self._files.get(session_id)
+        if f is None:
+            f = self._files[session_id] = SessionFile(
+                os.path.join(self.directory, f"{session_id}.jsonl"), durability=self.durability)
+        return f
+
+    def load(self, session_id: str) -> list[str]:
+        return list(self._file(session_id).lines())
+
+    def append(self, session_id: str, line: str) -> None:
+        self._file(session_id).append(line)
+
+    def flush(self, session_id: str) -> None:
+        f = self._files.get(session_id)
+        if f is not None:
+            f.flush()
+
+    async def flush_async(self, session_id: str) -> None:
+        f = self._files.get(session_id)
+        if f is not None:
+            await f.flush_async()
+
+    def rewrite(self, session_id: str, lines: list[str]) -> None:
+        self._file(session_id).rewrite(lines)
+
+    def delete(self, session_id: str) -> None:
+        self._file(session_id).delete()
+
+    def close(self, session_id: str) -> None:
+        f = self._files.pop(session_id, None)
+        if f is not None:
+            f.close()
+
+    def sessions(self) -> list[dict]:
+        for f in list(self._files.values()):
+            f.flush()   # 只在写缓存里的新会话还没有文件，先写出来，和 SqliteStore 一致
+        result = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.jsonl"))):
+            session_id = os.path.basename(path)[:-len(".jsonl")]
+            with open(path, "rb") as f:
+                count = sum(1 for line in f if line.strip())
+            result.append({"session_id": session_id, "messages": count,
+                           "updated_at": os.path.getmtime(path)})
+        return result
+
+    def referenced_blobs(self) -> set[str]:
+        for f in list(self._files.values()):
+            f.wait()   # 已提交的 rewrite / delete 先落地，比如刚 /reset 的会话
+        refs = set()
+        for path in glob.glob(os.path.join(self.directory, "*.jsonl")):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if '"blob"' in line:
+                            refs.update(_BLOB_REF_RE.findall(line))
+            except FileNotFoundError:
+                continue
+        return refs
+
+    def search(self, text: str, limit: int = 50) -> list[dict]:
+        """没有索引，逐个文件扫描"""
+        results = []
+        for info in self.sessions():
+            for seq, line in enumerate(self.load(info["session_id"])):
+                if text in line:
+                    message = json.loads(line)
+                    results.append({"session_id": info["session_id"], "seq": seq,
+                                    "role": message.get("role"), "content": message.get("content")})
+                    if len(results) >= limit:
+                        return results
+        return results
+
+
+# ============================================================
+# SQLite 后端
+# ============================================================
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    seq        INTEGER NOT NULL,
+    role       TEXT,
+    body       TEXT NOT NULL,
+    archived   INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE INDEX IF NOT EXISTS messages_live ON messages (session_id, archived, seq);
+"""
+
+# 落盘策略 → PRAGMA synchronous（WAL 模式下 NORMAL 只在 checkpoint 时 fsync）
+_SYNCHRONOUS = {"none": "OFF", "turn": "NORMAL", "message": "FULL"}
+
+
+class SqliteStore(SessionStore):
+    """
+    一个连接 + 一把锁（会话都在同一个事件循环线程上，写入很短，不需要连接池）。
+    append 先缓存，flush 时一个事务 executemany 写入；durability=message 时每条立即提交。
+
+    和 JsonlStore 的写线程一样，提交事务都交给一个专门的写线程，按提交顺序执行，不在事件循环上等磁盘：
+    rewrite / delete / close 和 message 策略下的 append 只提交不等待，flush_async 等到之前提交的都完成。
+    """
+
+    clean_on_load = False   # 写入前已经由 _serialize_message 清理过
+
+    def __init__(self, path: str = SESSION_DB, durability: str = SESSION_DURABILITY):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.durability = durability
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={_SYNCHRONOUS.get(durability, 'NORMAL')}")
+        self._conn.executescript(_SCHEMA)
+        self._lock = Lock()
+        self._pending: dict[str, list[str]] = {}
+        self._next_seq: dict[str, int] = {}
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+    def _seq(self, session_id: str) -> int:
+        """下一个序号；调用方持有锁"""
+        if session_id not in self._next_seq:
+            row = self._conn.execute(
+                "SELECT MAX(seq) FROM messages WHERE session_id = ?", (session_id,)).fetchone()
+            self._next_seq[session_id] = (row[0] + 1) if row[0] is not None else 0
+        return self._next_seq[session_id]
+
+    def _insert(self, session_id: str, lines: list[str]) -> None:
+        """插入一批行；调用方持有锁并已开启事务"""
+        start = self._seq(session_id)
+        now = time.time()
+        self._conn.executemany(
+            "INSERT INTO messages (session_id, seq, role, body, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(session_id, start + i, _role(line), line, now) for i, line in enumerate(lines)])
+        self._next_seq[session_id] = start + len(lines)
+
+    def load(self, session_id: str) -> list[str]:
+        self.flush(session_id)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT body FROM messages WHERE session_id = ? AND archived = 0 ORDER BY seq",
+                (session_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def append(self, session_id: str, line: str) -> None:
+        self._pending.setdefault(session_id, []).append(line)
+        if self.durability == "message":
+            self._submit(self._commit, session_id, self._pending.pop(session_id))
+
+    def flush(self, session_id: str) -> None:
+        self._submit(self._commit, session_id, self._pending.pop(session_id, None)).result()
+
+    async def flush_async(self, session_id: str) -> None:
+        future = self._submit(self._commit, session_id, self._pending.pop(session_id, None))
+        await asyncio.shield(asyncio.wrap_future(future))
+
+    def rewrite(self, session_id: str, lines: list[str]) -> None:
+        self._pending.pop(session_id, None)
+        self._submit(self._rewrite, session_id, list(lines))
+
+    def delete(self, session_id: str) -> None:
+        self._pending.pop(session_id, None)
+        self._submit(self._delete, session_id)
+
+    def close(self, session_id: str) -> None:
+        self._submit(self._commit, session_id, self._pending.pop(session_id, None), True)
+
+    def flush_all(self) -> None:
+        """写出所有会话的缓存，并等到之前提交的写入都完成"""
+        for session_id in list(self._pending):
+            self._submit(self._commit, session_id, self._pending.pop(session_id, None))
+        self._submit(lambda: None).result()
+
+    def _submit(self, fn, *args) -> Future:
+        def run():
+            try:
+                return fn(*args)
+            except Exception as e:
+                logger.error(f"写入 SQLite 会话存储失败：{e}")
+                raise
+        return self._writer.submit(run)
+
+    # 以下在写线程上执行
+
+    def _commit(self, session_id: str, lines: list[str] | None, forget: bool = False) -> None:
+        with self._lock:
+            if lines:
+                self._conn.execute("BEGIN")
+                try:
+                    self._insert(session_id, lines)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            if forget:
+                self._next_seq.pop(session_id, None)
+
+    def _rewrite(self, session_id: str, lines: list[str]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE messages SET archived = 1 WHERE session_id = ? AND archived = 0", (session_id,))
+                self._insert(session_id, lines)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _delete(self, session_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._next_seq.pop(session_id, None)
+
+    def sessions(self) -> list[dict]:
+        self.flush_all()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id, SUM(archived = 0), MAX(created_at) FROM messages "
+                "GROUP BY session_id ORDER BY session_id").fetchall()
+        return [{"session_id": s, "messages": n, "updated_at": t} for s, n, t in rows]
+
+    def referenced_blobs(self) -> set[str]:
+        """只看当前历史：被压缩归档的行里的 blob 不再保留（归档行仍可搜索，但大结果正文读不到了）"""
+        self._submit(lambda: None).result()   # 已提交的 rewrite / delete 先落地，比如刚 /reset 的会话
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT body FROM messages WHERE archived = 0 AND instr(body, '\"blob\"') > 0").fetchall()
+        refs = set()
+        for (body,) in rows:
+            refs.update(_BLOB_REF_RE.findall(body))
+        return refs
+
+    def search(self, text: str, limit: int = 50, include_archived: bool = False) -> list[dict]:
+        """include_archived=True 时连压缩前的原始对话一起搜"""
+        self.flush_all()
+        sql = "SELECT session_id, seq, role, body FROM messages WHERE instr(body, ?) > 0"
+        if not include_archived:
+            sql += " AND archived = 0"
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY session_id, seq LIMIT ?", (text, limit)).fetchall()
+        return [{"session_id": s, "seq": seq, "role": role, "content": json.loads(body).get("content")}
+                for s, seq, role, body in rows]
+
+
+def _role(line: str) -> str | None:
+    try:
+        return json.loads(line).get("role")
+    except ValueError:
+        return None
+
+
+_store: SessionStore | None = None
+_store_lock = Lock()
+
+
+def get_store() -> SessionStore:
+    """进程共享的存储实例，后端由 SESSION_STORE 决定"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if SESSION_STORE == "sqlite":
+                _store = SqliteStore()
+            else:
+                if SESSION_STORE != "jsonl":
+                    logger.warning(f"未知 SESSION_STORE={SESSION_STORE!r}，改用 jsonl")
+                _store = JsonlStore()
+        return _store
+
+
+# ============================================================
+# 迁移：sessions/*.jsonl → SQLite
+# ============================================================
+
+def migrate(src: str = SESSION_DIR, db: str = SESSION_DB) -> dict:
+    """
+    把 src 下的 .jsonl 会话导入 SQLite，导入时顺便清理多余字段。
+    已经在库里有数据的会话跳过，可以重复执行。
+    """
+    store = SqliteStore(db)
+    done = {s["session_id"] for s in store.sessions()}
+    imported = skipped = messages = 0
+    for path in sorted(glob.glob(os.path.join(src, "*.jsonl"))):
+        session_id = os.path.basename(path)[:-len(".jsonl")]
+        if session_id in done:
+            skipped += 1
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            lines = [
+                json.dumps(clean_content_blocks(json.loads(line)), ensure_ascii=False) + "\n"
+                for line in f if line.strip()
+            ]
+        store.rewrite(session_id, lines)
+        imported += 1
+        messages += len(lines)
+    store.flush_all()
+    logger.info(f"迁移完成：导入 {imported} 个会话 / {messages} 条消息，跳过 {skipped} 个已存在的会话")
+    return {"imported": imported, "skipped": skipped, "messages": messages}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="会话存储工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("migrate", help="把 sessions/*.jsonl 导入 SQLite")
+    p.add_argument("--src", default=SESSION_DIR)
+    p.add_argument("--db", default=SESSION_DB)
+    args = parser.parse_args()
+    if args.command == "migrate":
+        print(migrate(args.src, args.db))
@@ -0,0 +1,230 @@
+"""
+多进程 Supervisor
+
+单进程的 gateway 受 GIL 限制：JSON 序列化、history 处理、Flask 解析请求都抢同一个核。
+Supervisor 模式（GATEWAY_WORKERS > 1）下：
+
+  - 主进程只跑 Channel（Telegram 轮询、HTTP），不持有任何 Agent
+  - 启动 N 个 worker 进程，每个进程跑一份完整的 gateway（事件循环 + 会话池 + 串行队列）
+  - 每个 chat_id 按一致性哈希固定落到一个 worker：同一会话的消息仍然串行，
+    session 文件也只被一个进程读写
+  - 主进程和 worker 之间用 multiprocessing.Pipe（Unix socket）传消息，
+    流式事件（plan / text_delta / tool_*）也经同一条管道转发回来
+  - worker 意外退出时，它上面等待中的请求返回错误，supervisor 自动拉起一个新进程
+
+接口和 gateway.handle_message / submit_message 一致，Channel 不需要改：
+    sup = Supervisor(4).start()
+    start_http(sup.handle_message)
+    start_polling(sup.handle_message, sup.submit_message)
+"""
+
+import os
+import time
+import bisect
+import hashlib
+import logging
+import itertools
+import multiprocessing
+from concurrent.futures import Future
+from threading import Lock, Thread
+
+from session_pool import SessionQueueFull
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_WORKERS = int(os.environ.get("GATEWAY_WORKERS", "1"))
+HASH_REPLICAS = 100   # 每个 worker 在哈希环上的虚拟节点数
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """一致性哈希：增减 worker 时只有约 1/N 的 chat_id 换归属"""
+
+    def __init__(self, nodes: list[int], replicas: int = HASH_REPLICAS):
+        ring = sorted((_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [k for k, _ in ring]
+        self._nodes = [n for _, n in ring]
+
+    def lookup(self, chat_id) -> int:
+        i = bisect.bisect(self._keys, _hash(str(chat_id))) % len(self._keys)
+        return self._nodes[i]
+
+
+# ============================================================
+# worker 进程
+# ============================================================
+
+def _worker_main(conn, index: int, initializer=None, initargs=()):
+    """
+    worker 进程入口：收 (req_id, chat_id, text, stream)，
+    回 ("event", req_id, event) 若干条，最后 ("done", req_id, reply)；
+    会话排队已满时回 ("full", req_id, 说明)，supervisor 侧重新抛出 SessionQueueFull。
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    import gateway
+    from runtime import submit
+
+    send_lock = Lock()
+
+    def send(message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (OSError, EOFError):
+                pass   # supervisor 已经退出
+
+    logger.info(f"worker {index} 已启动（pid {os.getpid()}）")
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        req_id, chat_id, text, stream = request
+        on_event = (lambda event, req_id=req_id: send(("event", req_id, event))) if stream else None
+        future = submit(gateway.handle_message_async(chat_id, text, on_event))
+
+        def finished(f, req_id=req_id):
+            try:
+                reply = f.result()
+            except SessionQueueFull as e:
+                send(("full", req_id, str(e)))
+                return
+            except Exception as e:
+                reply = f"[错误] {e}"
+            send(("done", req_id, reply))
+        future.add_done_callback(finished)
+
+
+# ============================================================
+# supervisor（主进程）
+# ============================================================
+
+class _Pending:
+    __slots__ = ("worker", "on_event", "future")
+
+    def __init__(self, worker: int, on_event):
+        self.worker = worker
+        self.on_event = on_event
+        self.future = Future()
+
+
+class Supervisor:
+    def __init__(self, workers: int = GATEWAY_WORKERS, initializer=None, initargs=()):
+        self.workers = max(1, workers)
+        self.ring = HashRing(list(range(self.workers)))
+        self._initializer = initializer
+        self._initargs = initargs
+        # spawn：主进程里已经有 Telegram / HTTP 线程，fork 不安全
+        self._ctx = multiprocessing.get_context("spawn")
+        self._procs: list = [None] * self.workers
+        self._conns: list = [None] * self.workers
+        self._send_locks = [Lock() for _ in range(self.workers)]
+        self._pending: dict[int, _Pending] = {}
+        self._lock = Lock()
+        self._ids = itertools.count()
+        self._stopping = False
+        self.restarts = 0
+        self.routed = [0] * self.workers
+
+    def start(self):
+        for i in range(self.workers):
+            self._spawn(i)
+        logger.info(f"Supervisor 已启动 {self.workers} 个 worker 进程")
+        return self
+
+    def _spawn(self, index: int):
+        parent, child = self._ctx.Pipe()
+        proc = self._ctx.Process(target=_worker_main, name=f"mini-claw-worker-{index}",
+                                 args=(child, index, self._initializer, self._initargs), daemon=True)
+        proc.start()
+        child.close()
+        self._procs[index], self._conns[index] = proc, parent
+        Thread(target=self._reader, args=(index, parent), name=f"supervisor-reader-{index}", daemon=True).start()
+
+    def _reader(self, index: int, conn):
+        """每个 worker 一个读线程：把回复和流式事件交给等待中的请求"""
+        while True:
+            try:
+                kind, req_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                pending = self._pending.get(req_id) if kind == "event" else self._pending.pop(req_id, None)
+            if pending is None:
+                continue
+            if kind == "event":
+                if pending.on_event is not None:
+                    try:
+                        pending.on_event(payload)
+                    except Exception as e:
+                        logger.error(f"流式事件回调失败: {e}")
+            elif kind == "full":
+                pending.future.set_exception(SessionQueueFull(payload))
+            else:
+                pending.future.set_result(payload)
+        self._on_worker_exit(index, conn)
+
+    def _on_worker_exit(self, index: int, conn):
+        if self._stopping or self._conns[index] is not conn:
+            return
+        logger.error(f"worker {index} 意外退出，重新启动")
+        with self._lock:
+            lost = [(rid, p) for rid, p in self._pending.items() if p.worker == index]
+            for rid, _ in lost:
+                del self._pending[rid]
+        for _, p in lost:
+            p.future.set_result("[错误] 处理该会话的进程意外退出，请重试")
+        self.restarts += 1
+        self._spawn(index)
+
+    def handle_message(self, chat_id: int, text: str, on_event=None) -> str:
+        """和 gateway.handle_message 同签名：路由到 chat_id 所属的 worker，阻塞等待回复；排队满时抛 SessionQueueFull"""
+        return self.submit_message(chat_id, text, on_event).result()
+
+    def submit_message(self, chat_id: int, text: str, on_event=None) -> Future:
+        """和 gateway.submit_message 同签名：发给 worker 后立即返回 Future；同一线程先提交的消息先入队"""
+        index = self.ring.lookup(chat_id)
+        req_id = next(self._ids)
+        pending = _Pending(index, on_event)
+        with self._lock:
+            self._pending[req_id] = pending
+            self.routed[index] += 1
+        try:
+            with self._send_locks[index]:
+                self._conns[index].send((req_id, chat_id, text, on_event is not None))
+        except (OSError, EOFError) as e:
+            with self._lock:
+                self._pending.pop(req_id, None)
+            pending.future.set_result(f"[错误] 无法转发到 worker {index}：{e}")
+        return pending.future
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = len(self._pending)
+        return {
+            "workers": self.workers,
+            "alive": sum(1 for p in self._procs if p is not None and p.is_alive()),
+            "in_flight": in_flight,
+            "routed": list(self.routed),
+            "restarts": self.restarts,
+        }
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping = True
+        for i, conn in enumerate(self._conns):
+            try:
+                with self._send_locks[i]:
+                    conn.send(None)
+            except (OSError, EOFError):
+                pass
+        deadline = time.monotonic() + timeout
+        for proc in self._procs:
+            proc.join(max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                proc.terminate()
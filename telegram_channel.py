@@ -11,19 +11,92 @@ OpenClaw 里每个平台（Telegram/WhatsApp/Discord...）都有一个这样的
 
 这一层叫做 "Channel Adapter"，它屏蔽了各平台的差异，
 让上层的 Gateway 不需要关心消息从哪个平台来的。
+
+并发接收（TELEGRAM_CONCURRENT=1，默认）：
+  - 轮询线程只做检查和分发：submit_message 把消息放进 gateway 的会话队列后立即返回，
+    一个慢会话不会拖住后面其他聊天的消息；同一聊天的消息按到达顺序入队
+  - 所有 Telegram API 调用（回复、流式编辑、typing）交给发送线程池，
+    同一聊天的调用按提交顺序串行，不同聊天之间并行
+  - 一个 ticker 线程负责给处理中的聊天续 typing 状态（Telegram 的 typing 只显示约 5 秒）
+    和定时刷新流式回复
+  - 发送前过限流器：全局每秒 TELEGRAM_GLOBAL_RATE 条，单个聊天每秒 TELEGRAM_CHAT_RATE 条
+    （可突发 TELEGRAM_CHAT_BURST 条）；仍然收到 429 时按 retry_after 等待后重试
+  - 长回复流水线发送：流式生成的文字一满 4096 字符就定稿成一条消息，接着开下一条，
+    不用等整轮结束再一段段补发
+
+本地测试可以把 TELEGRAM_API_URL 指向 fake_telegram.py 起的假 Bot API 服务器。
 """
 
 import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event, Lock, Thread
 import telebot
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
 from dotenv import load_dotenv
 
+import metrics
+from session_pool import SessionQueueFull, MERGED_REPLY
+
 load_dotenv()
 
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 ALLOWED_CHAT_ID = int(os.environ.get("TELEGRAM_ALLOWED_CHAT_ID", "0"))
 
+# Bot API 地址（自建 Bot API 服务器或本地假服务器），不设就用官方地址
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+
+# 流式回复：处理过程中边生成边编辑同一条消息，两次编辑至少间隔 TELEGRAM_EDIT_INTERVAL 秒
+# （Telegram 对同一聊天的编辑频率有限制，太快会被 429）
+TELEGRAM_STREAMING = os.environ.get("TELEGRAM_STREAMING", "1") == "1"
+TELEGRAM_EDIT_INTERVAL = float(os.environ.get("TELEGRAM_EDIT_INTERVAL", "1.5"))
+
+# 并发接收：轮询线程不等回复，发送交给线程池
+TELEGRAM_CONCURRENT = os.environ.get("TELEGRAM_CONCURRENT", "1") == "1"
+TELEGRAM_SEND_THREADS = int(os.environ.get("TELEGRAM_SEND_THREADS", "8"))
+TELEGRAM_TYPING_INTERVAL = float(os.environ.get("TELEGRAM_TYPING_INTERVAL", "4.0"))
+
+# 发送限流（Telegram 官方建议：全局约 30 条/秒，单个聊天约 1 条/秒）
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", "3"))
+
+# 该会话排队的消息已达上限（gateway 的 SESSION_QUEUE_MAX）时的回复
+QUEUE_FULL_REPLY = "⏳ 前面还有好几条消息在处理，请等它们完成后再发"
+MAX_MESSAGE_LENGTH = 4096
+
+logger = logging.getLogger(__name__)
+
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+
 bot = telebot.TeleBot(BOT_TOKEN)
 
+stats = {
+    "updates": 0,        # 收到的消息
+    "sent": 0,           # sendMessage 次数
+    "edited": 0,         # editMessageText 次数
+    "typing": 0,         # sendChatAction 次数
+    "deleted": 0,        # 删除作废流式消息的次数
+    "rate_limited": 0,   # 收到 429 的次数
+    "send_errors": 0,    # 重试后仍失败的调用
+}
+
+
+def _collect_metrics():
+    return [
+        ("mini_claw_telegram_calls_total", "counter", "Telegram 频道收到的消息和 Bot API 调用次数",
+         [({"kind": k}, v) for k, v in stats.items()]),
+        ("mini_claw_telegram_send_pending", "gauge", "发送线程池里排队的 Bot API 调用", [({}, sender.pending())]),
+    ]
+
+
+metrics.register(_collect_metrics)
+
 
 def is_authorized(message) -> bool:
     """
@@ -36,45 +109,418 @@ def is_authorized(message) -> bool:
     return message.chat.id == ALLOWED_CHAT_ID
 
 
+# ============================================================
+# 限流
+# ============================================================
+
+class TokenBucket:
+    """令牌桶：每秒补 rate 个，最多攒 burst 个；reserve() 预订一个令牌，返回需要等待的秒数"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    """全局 + 单聊天两级令牌桶；wait() 在调用线程里睡到允许发送为止"""
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int):
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats: dict[int, TokenBucket] = {}
+        self._lock = Lock()
+
+    def wait(self, chat_id: int, per_chat: bool = True):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._global.reserve(now)
+            if per_chat:
+                bucket = self._chats.get(chat_id)
+                if bucket is None:
+                    if len(self._chats) > 10000:
+                        self._prune(now)
+                    bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+                delay = max(delay, bucket.reserve(now))
+        if delay > 0:
+            time.sleep(delay)
+
+    def _prune(self, now: float):
+        """丢掉已经攒满的桶（和新建的桶等价）"""
+        full = self._chat_burst / self._chat_rate if self._chat_rate > 0 else 0
+        for chat_id in [c for c, b in self._chats.items() if now - b.updated >= full]:
+            del self._chats[chat_id]
+
+
+limiter = RateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+
+
+def _api(chat_id: int, counter: str, fn, *args, per_chat: bool = True, **kwargs):
+    """带限流和 429 重试的 Bot API 调用"""
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        limiter.wait(chat_id, per_chat)
+        try:
+            result = fn(*args, **kwargs)
+            stats[counter] += 1
+            return result
+        except ApiTelegramException as e:
+            if e.error_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+                stats["send_errors"] += 1
+                raise
+            stats["rate_limited"] += 1
+            retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+            logger.warning(f"[{chat_id}] Telegram 限流，{retry_after}s 后重试")
+            time.sleep(retry_after)
+
+
+# ============================================================
+# 发送
+# ============================================================
+
+class ChatSender:
+    """
+    发送线程池：同一聊天的调用按提交顺序串行（消息不乱序），不同聊天之间并行。
+    submit() 立即返回 Future，可以在任何线程（包括事件循环线程）里调用。
+    """
+
+    def __init__(self, workers: int):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="telegram-send")
+        self._queues: dict[int, deque] = {}
+        self._lock = Lock()
+
+    def submit(self, chat_id: int, fn, *args) -> Future:
+        future = Future()
+        with self._lock:
+            q = self._queues.get(chat_id)
+            idle = q is None
+            if idle:
+                q = self._queues[chat_id] = deque()
+            q.append((future, fn, args))
+        if idle:
+            self._pool.submit(self._drain, chat_id)
+        return future
+
+    def _drain(self, chat_id: int):
+        while True:
+            with self._lock:
+                q = self._queues[chat_id]
+                if not q:
+                    del self._queues[chat_id]
+                    return
+                future, fn, args = q.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                logger.warning(f"[{chat_id}] Telegram 发送失败：{e}")
+                future.set_exception(e)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+
+sender = ChatSender(TELEGRAM_SEND_THREADS)
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """按 Telegram 的长度上限分段，尽量在换行处断开"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", limit // 2, limit)
+        cut = cut + 1 if cut > 0 else limit
+        chunks.append(text[:cut])
+        text = text[cut:]
+    if text:
+        chunks.append(text)
+    return chunks
+
+
 def send_reply(chat_id: int, text: str):
     """
-    把回复发回 Telegram。
+    把回复发回 Telegram（在调用线程里同步发送）。
 
-    Telegram 单条消息上限 4096 字符，超出自动分段发送。
+    Telegram 单条消息上限 4096 字符，超出自动分段发送，每段都过限流器。
     """
-    max_length = 4096
-    for i in range(0, len(text), max_length):
-        bot.send_message(chat_id, text[i:i + max_length])
+    for chunk in split_message(text):
+        _api(chat_id, "sent", bot.send_message, chat_id, chunk)
 
 
-def start_polling(on_message):
+class StreamingReply:
+    """
+    流式回复：先发一条占位消息，之后按固定间隔用 edit_message_text 刷新内容。
+
+    on_event 在 gateway 的事件循环线程上被调用，只更新缓冲区；
+    真正调 Telegram API 的 flush() / finish() 由 ticker 提交到发送线程池，不会阻塞事件循环。
+    生成的文字超过 4096 字符时，当前消息定稿为前一段，后面的内容接着写进一条新消息。
+    收到 text_reset（重试 / 升级模型，之前推送的一段文字作废）时截掉这段文字；
+    作废的部分已经定稿进之前的消息时，下次刷新把那些消息删掉，从保留的位置重新往后写。
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.message_id = None
+        self._text = ""        # 已生成的文字
+        self._status = ""      # 当前状态行（规划中 / 正在调用工具）
+        self._shown = ""       # 上次显示在 Telegram 上的内容
+        self._committed = 0    # _text 中已经定稿到之前消息里的长度
+        self._rolled: list[tuple[int, int, int]] = []   # 已定稿的消息：(message_id, 在 _text 中的起止位置)
+        self._rewind = None    # text_reset 后 _text 保留的长度，由发送线程处理
+        self._lock = Lock()
+        self.next_flush = time.monotonic() + TELEGRAM_EDIT_INTERVAL
+        self.flushing = False  # 已有一次 flush 在发送队列里
+        self.finished = False
+
+    def on_event(self, event: dict):
+        with self._lock:
+            t = event["type"]
+            if t == "text_delta":
+                self._text += event["text"]
+                self._status = ""
+            elif t == "text_reset":
+                keep = max(0, len(self._text) - event["chars"])
+                self._text = self._text[:keep]
+                self._rewind = keep if self._rewind is None else min(self._rewind, keep)
+            elif t == "plan":
+                self._status = "📋 已制定计划，执行中…"
+            elif t == "tool_start":
+                self._status = f"🔧 {event['name']}…"
+            elif t == "tool_end":
+                self._status = ""
+
+    def _show(self, text: str):
+        if not text.strip() or text == self._shown:
+            return
+        try:
+            if self.message_id is None:
+                self.message_id = _api(self.chat_id, "sent", bot.send_message, self.chat_id, text).message_id
+            else:
+                _api(self.chat_id, "edited", bot.edit_message_text, text, self.chat_id, self.message_id)
+            self._shown = text
+        except Exception as e:
+            # 编辑失败（限流、内容未变化等）不影响最终回复
+            logger.warning(f"[{self.chat_id}] 流式编辑失败：{e}")
+
+    def _roll_over(self):
+        """未定稿的文字超过单条上限：把前一段定稿到当前消息，后面的内容换新消息"""
+        while True:
+            with self._lock:
+                pending = self._text[self._committed:]
+            if len(pending) <= MAX_MESSAGE_LENGTH:
+                return
+            chunk = split_message(pending)[0]
+            self._show(chunk)
+            with self._lock:
+                if self.message_id is not None:
+                    self._rolled.append((self.message_id, self._committed, self._committed + len(chunk)))
+                self._committed += len(chunk)
+            self.message_id, self._shown = None, ""
+
+    def _apply_reset(self):
+        """text_reset 截掉的文字已经定稿进之前的消息：删掉这些消息和当前消息，从截断处之前重新写"""
+        with self._lock:
+            keep, self._rewind = self._rewind, None
+            if keep is None or keep >= self._committed:
+                return
+            stale = [message_id for message_id, _, end in self._rolled if end > keep]
+            self._rolled = [r for r in self._rolled if r[2] <= keep]
+            self._committed = self._rolled[-1][2] if self._rolled else 0
+        if self.message_id is not None:
+            stale.append(self.message_id)
+        self.message_id, self._shown = None, ""
+        for message_id in stale:
+            try:
+                _api(self.chat_id, "deleted", bot.delete_message, self.chat_id, message_id)
+            except Exception as e:
+                logger.warning(f"[{self.chat_id}] 删除作废的流式消息失败：{e}")
+
+    def flush(self):
+        """刷新一次预览（在发送线程里执行）"""
+        self.flushing = False
+        if self.finished:
+            return
+        self._apply_reset()
+        self._roll_over()
+        with self._lock:
+            text = "\n\n".join(part for part in (self._text[self._committed:], self._status) if part)
+        self._show(text[:MAX_MESSAGE_LENGTH])
+
+    def finish(self, reply: str):
+        """把最终回复写进占位消息，超长部分分段补发（在发送线程里执行）"""
+        self.finished = True
+        self._apply_reset()
+        committed = self._text[:self._committed]
+        # 已定稿的段落正好是回复的开头就接着往后发，否则整段回复另起消息
+        rest = reply[len(committed):] if committed and reply.startswith(committed) else reply
+        chunks = split_message(rest) or [rest]
+        if self.message_id is None and not committed:
+            send_reply(self.chat_id, rest)
+            return
+        self._show(chunks[0])
+        for chunk in chunks[1:]:
+            _api(self.chat_id, "sent", bot.send_message, self.chat_id, chunk)
+
+
+# ============================================================
+# ticker：typing 续期 + 流式刷新
+# ============================================================
+
+class _Ticker:
+    """一个后台线程管所有处理中的聊天：到点就往发送线程池提交 typing / 流式刷新"""
+
+    TICK = 0.25
+
+    def __init__(self):
+        self._typing: dict[int, list] = {}   # chat_id → [处理中的消息数, 下次发送时间]
+        self._replies: set[StreamingReply] = set()
+        self._lock = Lock()
+        self._wake = Event()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._loop, name="telegram-ticker", daemon=True)
+            self._thread.start()
+
+    def begin(self, chat_id: int, reply: StreamingReply | None):
+        with self._lock:
+            self._ensure_started()
+            entry = self._typing.setdefault(chat_id, [0, 0.0])
+            entry[0] += 1
+            if reply is not None:
+                self._replies.add(reply)
+        self._wake.set()
+
+    def end(self, chat_id: int, reply: StreamingReply | None):
+        with self._lock:
+            entry = self._typing.get(chat_id)
+            if entry is not None:
+                entry[0] -= 1
+                if entry[0] <= 0:
+                    del self._typing[chat_id]
+            self._replies.discard(reply)
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.TICK)
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                typing = [c for c, e in self._typing.items() if e[1] <= now]
+                for chat_id in typing:
+                    self._typing[chat_id][1] = now + TELEGRAM_TYPING_INTERVAL
+                due = [r for r in self._replies if not r.flushing and r.next_flush <= now]
+                for reply in due:
+                    reply.flushing = True
+                    reply.next_flush = now + TELEGRAM_EDIT_INTERVAL
+            for chat_id in typing:
+                sender.submit(chat_id, _send_typing, chat_id)
+            for reply in due:
+                sender.submit(reply.chat_id, reply.flush)
+
+
+def _send_typing(chat_id: int):
+    try:
+        _api(chat_id, "typing", bot.send_chat_action, chat_id, "typing", per_chat=False)
+    except Exception as e:
+        logger.debug(f"[{chat_id}] typing 发送失败：{e}")
+
+
+ticker = _Ticker()
+
+
+def _reply_text(future) -> str:
+    try:
+        return future.result()
+    except SessionQueueFull:
+        return QUEUE_FULL_REPLY
+    except Exception as e:
+        return f"[错误] {e}"
+
+
+def dispatch(chat_id: int, text: str, submit_message) -> Future:
+    """
+    分发一条消息：立即返回，回复发完时返回的 Future 完成。
+
+    submit_message(chat_id, text, on_event) 需要立即返回 Future（gateway / Supervisor 的 submit_message）。
+    """
+    streaming = StreamingReply(chat_id) if TELEGRAM_STREAMING else None
+    ticker.begin(chat_id, streaming)
+    sent = Future()
+
+    def replied(future):
+        # 可能在事件循环线程或 supervisor 读线程上回调：只提交，不在这里发
+        ticker.end(chat_id, streaming)
+        reply = _reply_text(future)
+        if reply == MERGED_REPLY:
+            # 并进了后面消息的那一轮，回复由那条消息发出
+            sent.set_result(True)
+            return
+        job = sender.submit(chat_id, streaming.finish if streaming else send_reply,
+                            *((reply,) if streaming else (chat_id, reply)))
+        job.add_done_callback(lambda f: sent.set_result(f.exception() is None))
+
+    try:
+        if streaming:
+            future = submit_message(chat_id, text, streaming.on_event)
+        else:
+            future = submit_message(chat_id, text)
+    except Exception as e:
+        # 提交本身失败（比如事件循环已经关闭）：照样走 replied，注销 ticker 登记并回一条错误
+        future = Future()
+        future.set_exception(e)
+    future.add_done_callback(replied)
+    return sent
+
+
+def start_polling(on_message, submit_message=None):
     """
     启动轮询，持续监听 Telegram 消息。
 
     on_message：回调函数，由 gateway.py 提供
-                签名：(chat_id: int, text: str) -> str
+                签名：(chat_id: int, text: str, on_event=None) -> str
                 负责把消息路由到 Agent，返回回复
+    submit_message：同签名但立即返回 Future 的版本；提供了且 TELEGRAM_CONCURRENT=1 时，
+                轮询线程只分发不等待（见模块说明），否则在 telebot 的 handler 线程里阻塞等回复
 
     对应 OpenClaw：Gateway 启动时注册各个 Channel 的监听器。
     OpenClaw 用 WebSocket 长连接，mini-claw 用轮询，效果一样。
     """
+    concurrent = TELEGRAM_CONCURRENT and submit_message is not None
+    if concurrent:
+        # handler 直接在轮询线程里执行（只分发，很快），保证同一聊天的消息按顺序入队
+        bot.threaded = False
+    else:
+        def submit_message(chat_id, text, on_event=None):
+            future = Future()
+            try:
+                future.set_result(on_message(chat_id, text, on_event=on_event))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
     @bot.message_handler(func=lambda m: True)
     def handle(message):
         # 拒绝未授权用户
         if not is_authorized(message):
-            bot.send_message(message.chat.id, "⛔ 未授权")
+            sender.submit(message.chat.id, send_reply, message.chat.id, "⛔ 未授权")
             return
 
-        text = message.text or ""
-
-        # 告诉用户 bot 正在处理（Agent 跑起来要几秒）
-        bot.send_chat_action(message.chat.id, "typing")
-
-        # 交给 gateway 路由到 Agent，拿回回复
-        response = on_message(message.chat.id, text)
-
-        # 发回 Telegram
-        send_reply(message.chat.id, response)
+        stats["updates"] += 1
+        sent = dispatch(message.chat.id, message.text or "", submit_message)
+        if not concurrent:
+            sent.result()   # 阻塞模式：等回复发完再处理下一条
 
-    print("📡 Telegram 监听已启动，等待消息...")
+    print(f"📡 Telegram 监听已启动（{'并发' if concurrent else '阻塞'}模式），等待消息...")
     bot.infinity_polling()
@@ -0,0 +1,49 @@
+import os
+import sys
+
+# 模块都在仓库根目录，测试直接按模块名导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 这些配置在模块导入时读取，必须在导入 agent / telegram_channel 之前设置
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:test")
+os.environ.setdefault("TELEGRAM_CHAT_RATE", "0")
+os.environ.setdefault("LLM_BACKOFF_BASE", "0.01")
+
+import pytest  # noqa: E402
+
+from telebot import apihelper  # noqa: E402
+
+from fake_anthropic import FakeAnthropicServer  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_api():
+    """整个测试过程共用一个假 Messages API（共享客户端按事件循环只建一次，base_url 不能中途换）"""
+    server = FakeAnthropicServer().start()
+    os.environ["ANTHROPIC_BASE_URL"] = server.url
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def api(fake_api, tmp_path, monkeypatch):
+    """每个测试在自己的临时目录里跑（会话文件、blob 都写在相对路径下），假 API 恢复默认行为"""
+    monkeypatch.chdir(tmp_path)
+    fake_api.latency = 0.0
+    fake_api.output_tokens = 0
+    fake_api.tool_rounds = 0
+    fake_api.reply_text = "ok"
+    yield fake_api
+
+
+@pytest.fixture
+def telegram():
+    """假 Bot API，telegram_channel 的调用都发到这里"""
+    server = FakeTelegramServer().start()
+    old = apihelper.API_URL
+    apihelper.API_URL = server.url + "/bot{0}/{1}"
+    yield server
+    apihelper.API_URL = old
+    server.stop()
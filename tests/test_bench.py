@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import subprocess
+import urllib.error
+import urllib.request
+
+import pytest
+
+from bench import BENCH_PATH
+from fake_anthropic import FakeAnthropicServer
+
+
+@pytest.fixture
+def server():
+    """单独的假 API，不影响其他测试共用的那个"""
+    server = FakeAnthropicServer(output_tokens=100, tool_rounds=1).start()
+    yield server
+    server.stop()
+
+
+def _post(server, path: str, body: dict):
+    request = urllib.request.Request(server.url + path, data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def test_fake_api_replies_tools_truncation_and_faults(server):
+    user = [{"role": "user", "content": "hi"}]
+    reply = _post(server, "/v1/messages", {"messages": user, "max_tokens": 1000})
+    assert reply["stop_reason"] == "end_turn" and len(reply["content"][0]["text"]) == 400
+
+    cut = _post(server, "/v1/messages", {"messages": user, "max_tokens": 10})
+    assert cut["stop_reason"] == "max_tokens" and len(cut["content"][0]["text"]) == 40
+
+    tool = _post(server, "/v1/messages", {"messages": user, "max_tokens": 1000, "tools": [{"name": "x"}]})
+    assert tool["stop_reason"] == "tool_use" and tool["content"][1]["name"] == "list_files"
+
+    assert _post(server, "/v1/messages/count_tokens", {"messages": user})["input_tokens"] > 0
+
+    server.retry_after = 2
+    server.script("rate_limit")
+    with pytest.raises(urllib.error.HTTPError) as e:
+        _post(server, "/v1/messages", {"messages": user})
+    assert e.value.code == 429 and e.value.headers["retry-after"] == "2"
+    assert server.stats["rate_limited"] == 1 and server.stats["tool_use"] == 1
+
+
+def test_load_scenario_runs_end_to_end(tmp_path):
+    env = {**os.environ, "TELEGRAM_CHAT_RATE": "1"}
+    result = subprocess.run(
+        [sys.executable, BENCH_PATH, "load", "--workloads", "chat", "--channels", "gateway",
+         "--sessions", "2", "--turns", "1", "--concurrency", "2", "--latency", "0.01"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    row = next(line.split() for line in result.stdout.splitlines() if line.split()[:2] == ["chat", "gateway"])
+    header = next(line.split() for line in result.stdout.splitlines() if line.split()[:1] == ["workload"])
+    assert int(row[header.index("messages")]) > 0 and row[header.index("errors")] == "0"
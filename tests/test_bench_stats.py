@@ -0,0 +1,9 @@
+from bench import percentile
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile([], 50) == 0.0
+    assert [percentile(values, p) for p in (1, 50, 95, 99, 100)] == [1, 50, 95, 99, 100]
+    assert percentile([5], 99) == 5
+    assert percentile([1, 2], 50) == 1
@@ -0,0 +1,40 @@
+import os
+
+import blob_store
+from agent import AsyncAgent
+
+
+def _blob_message(text: str) -> dict:
+    block = {"type": "tool_result", "tool_use_id": "toolu_1", "content": text}
+    return {"role": "user", "content": [blob_store.externalize(block, len(text) // 4)]}
+
+
+def test_reset_session_blobs_are_deleted(api, monkeypatch):
+    monkeypatch.setattr(blob_store, "BLOB_GC_INTERVAL", 0)
+    monkeypatch.setattr(blob_store, "BLOB_GC_GRACE", 0)
+    monkeypatch.setattr(blob_store, "_gc_timer", None)   # 别的测试安排的回收不影响这里
+    shared = "s" * blob_store.BLOB_MIN_BYTES
+    only_reset = "r" * blob_store.BLOB_MIN_BYTES
+
+    keep = AsyncAgent("keep")
+    keep._save_message(_blob_message(shared))
+    keep.store.flush(keep.session_id)
+    gone = AsyncAgent("gone")
+    gone._save_message(_blob_message(shared))
+    gone._save_message(_blob_message(only_reset))
+    gone.store.flush(gone.session_id)
+    shared_path = blob_store._path(blob_store.put(shared))
+    reset_path = blob_store._path(blob_store.put(only_reset))
+    assert os.path.exists(reset_path)
+
+    gone.reset()
+    blob_store._gc_timer.join()
+    assert not os.path.exists(reset_path)
+    assert os.path.exists(shared_path)           # 还有别的会话在引用
+    assert blob_store.get(blob_store.put(shared)) == shared
+
+
+def test_recent_blobs_survive_gc(api):
+    path = blob_store._path(blob_store.put("n" * blob_store.BLOB_MIN_BYTES))
+    assert blob_store.collect_garbage() == (0, 0)   # 引用可能还在写缓存里，宽限期内不删
+    assert os.path.exists(path)
@@ -0,0 +1,43 @@
+import threading
+
+import blob_store
+import tool_pool
+from agent import Agent
+from runtime import get_loop, run_sync
+
+BIG = "b" * (blob_store.BLOB_MIN_BYTES * 2)
+
+
+def _loop_thread() -> int:
+    return run_sync(_ident())
+
+
+async def _ident():
+    return threading.get_ident()
+
+
+def test_blob_io_runs_off_the_event_loop(api, monkeypatch):
+    get_loop()
+    threads = {"put": [], "get": []}
+    put, get = blob_store.put, blob_store.get
+
+    def recording_put(text):
+        threads["put"].append(threading.get_ident())
+        return put(text)
+
+    def recording_get(digest):
+        threads["get"].append(threading.get_ident())
+        return get(digest)
+    monkeypatch.setattr(blob_store, "put", recording_put)
+    monkeypatch.setattr(blob_store, "get", recording_get)
+
+    async def big_result(session_id, name, tool_input):
+        return BIG
+    monkeypatch.setattr(tool_pool.pool, "run", big_result)
+    api.tool_rounds = 1
+
+    agent = Agent("blob-offloop")
+    assert agent.run("看看目录") == "ok"
+    loop = _loop_thread()
+    assert threads["put"] and loop not in threads["put"]
+    assert threads["get"] and loop not in threads["get"]
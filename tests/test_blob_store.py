@@ -0,0 +1,24 @@
+import os
+
+import blob_store
+
+
+def test_put_is_content_addressed_and_deduplicated(api):
+    text = "x" * 10000
+    digest = blob_store.put(text)
+    assert blob_store.put(text) == digest
+    assert os.listdir(os.path.join(blob_store.BLOB_DIR, digest[:2])) == [digest]
+    blob_store._cache.clear()
+    assert blob_store.get(digest) == text
+    assert blob_store.head(digest, 5) == "xxxxx"
+
+
+def test_large_tool_results_are_stored_out_of_line(api):
+    small = {"type": "tool_result", "tool_use_id": "a", "content": "短"}
+    large = {"type": "tool_result", "tool_use_id": "b", "content": "内容" * 5000}
+    assert blob_store.externalize(small, 1) is small
+
+    ref = blob_store.externalize(large, 2500)
+    assert "content" not in ref and ref["chars"] == 10000 and ref["tokens"] == 2500
+    messages = [{"role": "user", "content": [small, ref]}]
+    assert blob_store.resolve_blobs(messages) == [{"role": "user", "content": [small, large]}]
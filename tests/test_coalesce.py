@@ -0,0 +1,14 @@
+import gateway
+import telegram_channel
+
+
+def test_burst_to_one_chat_sends_one_reply(api, telegram, monkeypatch):
+    monkeypatch.setattr(gateway, "SESSION_COALESCE", True)
+    monkeypatch.setattr(gateway, "SESSION_COALESCE_WINDOW", 0.3)
+    api.reply_text = "合并后的回复"
+    chat_id = 616161
+
+    sent = [telegram_channel.dispatch(chat_id, f"第 {i} 段", gateway.submit_message) for i in range(3)]
+    assert all(f.result(timeout=10) for f in sent)
+    assert telegram.visible(chat_id) == ["合并后的回复"]
+    assert len(telegram.sent(chat_id)) == 1
@@ -0,0 +1,55 @@
+import agent as agent_module
+from agent import Agent, SUMMARY_PREFIX, SUMMARY_ACK
+from runtime import run_sync
+
+
+async def _wait(task):
+    await task
+
+
+def _texts(history: list) -> list[str]:
+    """每条消息的文字：内存里 assistant 消息是 SDK 的 content block，从磁盘加载的是 dict"""
+    def text(content):
+        if isinstance(content, str):
+            return content
+        return "".join(b["text"] if isinstance(b, dict) else b.text for b in content)
+    return [text(m["content"]) for m in history]
+
+
+def test_compaction_runs_after_the_reply_and_applies_next_turn(api, monkeypatch):
+    monkeypatch.setattr(agent_module, "COMPACT_TOKEN_THRESHOLD", 1)
+    monkeypatch.setattr(agent_module, "KEEP_RECENT", 2)
+    agent = Agent("compact")
+    agent.mode = "chat"
+
+    api.reply_text = "ok"
+    agent.run("first")
+    agent.run("second")
+    assert agent._compaction_task is not None
+    api.reply_text = "摘要"
+    run_sync(_wait(agent._compaction_task))
+    # 摘要只暂存，本轮的历史不动
+    assert agent._pending_compaction == (2, "摘要")
+    assert len(agent.conversation_history) == 4
+
+    api.reply_text = "ok"
+    agent.run("third")
+    history = _texts(agent.conversation_history)
+    assert history == [SUMMARY_PREFIX + "摘要", SUMMARY_ACK, "second", "ok", "third", "ok"]
+
+    agent.close()
+    reloaded = Agent("compact")
+    assert _texts(reloaded.conversation_history) == history
+
+
+def test_reset_discards_stale_compaction(api, monkeypatch):
+    monkeypatch.setattr(agent_module, "COMPACT_TOKEN_THRESHOLD", 1)
+    monkeypatch.setattr(agent_module, "KEEP_RECENT", 2)
+    agent = Agent("compact-reset")
+    agent.mode = "chat"
+    agent.run("first")
+    agent.run("second")
+    agent.reset()
+    run_sync(_wait(agent._compaction_task))
+    assert agent._pending_compaction is None
+    assert agent.conversation_history == []
@@ -0,0 +1,26 @@
+import time
+
+import gateway
+from runtime import run_sync
+
+
+def test_chats_run_concurrently_and_each_chat_serially(api):
+    api.latency = 0.3
+    start = time.perf_counter()
+    futures = [gateway.submit_message(chat_id, "hi") for chat_id in range(717100, 717110)]
+    assert [f.result(timeout=10) for f in futures] == ["ok"] * 10
+    assert time.perf_counter() - start < 1.5   # 10 个会话在同一个事件循环里并发，不是排成一串
+
+    chat_id = 717200
+    start = time.perf_counter()
+    futures = [gateway.submit_message(chat_id, text) for text in ("first", "second")]
+    assert [f.result(timeout=10) for f in futures] == ["ok", "ok"]
+    assert time.perf_counter() - start >= 0.6  # 同一会话串行处理
+    agent = run_sync(gateway.get_or_create_session_async(chat_id))
+    assert [m["content"] for m in agent.conversation_history if m["role"] == "user"] == ["first", "second"]
+
+
+def test_session_worker_exits_when_queue_drains(api):
+    chat_id = 717300
+    assert gateway.handle_message(chat_id, "hi") == "ok"
+    assert chat_id not in gateway.task_queues and chat_id not in gateway.worker_tasks
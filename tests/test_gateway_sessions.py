@@ -0,0 +1,63 @@
+import asyncio
+import threading
+
+import gateway
+from agent import AsyncAgent
+from runtime import run_sync
+
+
+def test_session_history_is_loaded_off_the_event_loop(api, monkeypatch):
+    chat_id = 424242
+    seed = AsyncAgent(str(chat_id))
+    seed._save_message({"role": "user", "content": "hi"})
+    seed._save_message({"role": "assistant", "content": "ok"})
+    seed.close()
+
+    threads = []
+    load_history = AsyncAgent._load_history
+
+    def recording_load(self):
+        threads.append(threading.get_ident())
+        return load_history(self)
+    monkeypatch.setattr(AsyncAgent, "_load_history", recording_load)
+
+    async def load_twice():
+        first, second = await asyncio.gather(gateway.get_or_create_session_async(chat_id),
+                                             gateway.get_or_create_session_async(chat_id))
+        return first, second, threading.get_ident()
+
+    misses = gateway.sessions.misses
+    first, second, loop_thread = run_sync(load_twice())
+    assert first is second
+    assert len(first.conversation_history) == 2
+    assert len(threads) == 1 and threads[0] != loop_thread
+    assert gateway.sessions.misses - misses == 1
+    assert run_sync(gateway.get_or_create_session_async(chat_id)) is first
+
+
+def test_gateway_metrics_are_read_on_the_loop(api, monkeypatch):
+    loop_reads = []
+    snapshot = gateway._snapshot
+
+    async def recording_snapshot():
+        loop_reads.append(threading.get_ident())
+        return await snapshot()
+    monkeypatch.setattr(gateway, "_snapshot", recording_snapshot)
+
+    run_sync(gateway.get_or_create_session_async(515151))
+    families = {name: samples for name, _, _, samples in gateway._collect_metrics()}
+    assert families["mini_claw_sessions"][0][1] >= 1
+    assert loop_reads and loop_reads[0] != threading.get_ident()
+
+
+def test_evicted_modes_are_bounded(api, monkeypatch):
+    monkeypatch.setattr(gateway, "SESSION_EVICTED_MODES_MAX", 2)
+    monkeypatch.setattr(gateway, "_evicted_modes", gateway.OrderedDict())
+    for chat_id in (1, 2, 3):
+        agent = AsyncAgent(str(chat_id))
+        agent.mode = "chat"
+        gateway._on_session_evicted(chat_id, agent)
+    assert list(gateway._evicted_modes) == [2, 3]
+    assert gateway._create_session(1).mode == "code"
+    assert gateway._create_session(3).mode == "chat"
+    assert list(gateway._evicted_modes) == [2]
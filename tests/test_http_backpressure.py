@@ -0,0 +1,64 @@
+import time
+import threading
+
+import pytest
+
+import http_channel
+from session_pool import SessionQueueFull
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """假 on_message：release 置位前一直阻塞；text 为 full 时模拟会话排队已满"""
+    release = threading.Event()
+
+    def on_message(chat_id, text, on_event=None):
+        if text == "full":
+            raise SessionQueueFull("8 条在排队")
+        release.wait(5)
+        return f"re: {text}"
+
+    monkeypatch.setattr(http_channel, "_on_message", on_message)
+    yield http_channel.app.test_client(), release
+    release.set()
+
+
+def _wait_job(client, job_id: str) -> dict:
+    for _ in range(100):
+        body = client.get(f"/jobs/{job_id}").get_json()
+        if body["status"] != "pending":
+            return body
+        time.sleep(0.02)
+    raise AssertionError("job 没有完成")
+
+
+def test_in_flight_limit_returns_503(client, monkeypatch):
+    client, release = client
+    monkeypatch.setattr(http_channel, "HTTP_MAX_IN_FLIGHT", 1)
+    accepted = client.post("/message/async", json={"text": "first"})
+    assert accepted.status_code == 202
+
+    busy = client.post("/message", json={"text": "second"})
+    assert busy.status_code == 503 and busy.headers["Retry-After"] == "1"
+
+    release.set()
+    assert _wait_job(client, accepted.get_json()["job_id"]) == {
+        "job_id": accepted.get_json()["job_id"], "status": "done", "reply": "re: first"}
+
+
+def test_deadline_returns_504_and_job_keeps_running(client, monkeypatch):
+    client, release = client
+    monkeypatch.setattr(http_channel, "HTTP_REQUEST_TIMEOUT", 0.1)
+    response = client.post("/message", json={"text": "slow"})
+    assert response.status_code == 504
+    release.set()
+    assert _wait_job(client, response.get_json()["job_id"])["reply"] == "re: slow"
+
+
+def test_full_session_queue_returns_429(client):
+    client, _ = client
+    response = client.post("/message", json={"text": "full"})
+    assert response.status_code == 429 and response.headers["Retry-After"] == "5"
+    job_id = client.post("/message/async", json={"text": "full"}).get_json()["job_id"]
+    _wait_job(client, job_id)
+    assert client.get(f"/jobs/{job_id}").status_code == 429
@@ -0,0 +1,39 @@
+import json
+
+import gateway
+import http_channel
+import telegram_channel
+
+
+def _sse(body: str) -> list[tuple[str, dict]]:
+    events = []
+    for chunk in body.strip().split("\n\n"):
+        name, data = chunk.split("\n")
+        events.append((name.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+def test_sse_streams_deltas_then_done(api, monkeypatch):
+    monkeypatch.setattr(http_channel, "_on_message", gateway.handle_message)
+    api.output_tokens = 100
+    response = http_channel.app.test_client().post("/message/stream", json={"chat_id": 818181, "text": "hi"})
+    assert response.mimetype == "text/event-stream"
+    events = _sse(response.get_data(as_text=True))
+    assert events[-1][0] == "done"
+    reply = events[-1][1]["reply"]
+    assert len(reply) == 400
+    deltas = [data["text"] for name, data in events if name == "text_delta"]
+    assert len(deltas) > 1 and "".join(deltas) == reply
+
+
+def test_telegram_reply_is_streamed_by_editing_one_message(api, telegram, monkeypatch):
+    monkeypatch.setattr(telegram_channel, "TELEGRAM_EDIT_INTERVAL", 0.1)
+    monkeypatch.setattr(api, "tokens_per_sec", 100)   # 约 1 秒推完
+    api.output_tokens = 100
+    edited = telegram.stats["edited"]
+    sent = telegram_channel.dispatch(828282, "hi", gateway.submit_message)
+    assert sent.result(timeout=10)
+    visible = telegram.visible(828282)
+    assert len(visible) == 1 and len(visible[0]) == 400
+    assert [c["method"] for c in telegram.sent(828282)].count("sendMessage") == 1
+    assert telegram.stats["edited"] - edited >= 2
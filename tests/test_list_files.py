@@ -0,0 +1,41 @@
+import os
+import re
+
+import pytest
+
+import tools
+from tools import list_files
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(tools, "_WORKSPACE", os.path.realpath(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".gitignore").write_text("build/\n*.log\n")
+    for rel in ("a.py", "b.log", "src/c.py", "src/d.txt", "src/deep/e.py", "build/out.py"):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text("x")
+    return tmp_path
+
+
+def _entries(output: str) -> list[str]:
+    return re.findall(r"\] (\S+?)/?(?: \(|$)", output, re.M)
+
+
+def test_depth_pattern_and_gitignore(workspace):
+    assert _entries(list_files(".")) == [".gitignore", "a.py", "src"]
+    assert _entries(list_files(".", depth=0, pattern="*.py")) == ["a.py", "src/c.py", "src/deep/e.py"]
+    assert "build/out.py" in _entries(list_files(".", depth=0, include_ignored=True))
+
+
+def test_pages_resume_from_cursor(workspace):
+    seen, cursor = [], None
+    while True:
+        output = list_files(".", depth=0, page_size=2, cursor=cursor)
+        seen += _entries(output)
+        match = re.search(r'cursor="([^"]+)"', output)
+        if not match:
+            break
+        cursor = match.group(1)
+    assert seen == _entries(list_files(".", depth=0))
+    assert seen == [".gitignore", "a.py", "src", "src/c.py", "src/d.txt", "src/deep", "src/deep/e.py"]
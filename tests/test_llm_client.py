@@ -0,0 +1,19 @@
+import asyncio
+
+import llm_client
+
+
+def test_sequential_calls_reuse_one_connection(api):
+    async def two_calls():
+        client = llm_client.get_async_client()
+        assert llm_client.get_async_client() is client
+        for _ in range(2):
+            await client.messages.create(model="test", max_tokens=16,
+                                         messages=[{"role": "user", "content": "hi"}])
+        await client.close()
+
+    before = api.stats
+    asyncio.run(two_calls())   # 新事件循环 → 新客户端，连接池从空开始
+    after = api.stats
+    assert after["requests"] - before["requests"] == 2
+    assert after["connections"] - before["connections"] == 1
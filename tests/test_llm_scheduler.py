@@ -0,0 +1,89 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import anthropic
+import pytest
+
+from llm_scheduler import LLMScheduler
+
+
+def _result(tokens: int = 0):
+    return SimpleNamespace(usage=SimpleNamespace(input_tokens=tokens, output_tokens=0))
+
+
+def test_round_robin_across_sessions_and_compaction_last():
+    scheduler = LLMScheduler(max_concurrent=1)
+    order = []
+
+    async def main():
+        release = asyncio.Event()
+
+        def attempt(label):
+            async def run():
+                order.append(label)
+                if label == "a0":
+                    await release.wait()
+                return _result()
+            return run
+
+        first = asyncio.ensure_future(scheduler.call("a", "turn", 0, attempt("a0")))
+        await asyncio.sleep(0.01)
+        rest = [asyncio.ensure_future(scheduler.call(session, kind, 0, attempt(label)))
+                for session, kind, label in [("c", "compact", "c0"), ("a", "turn", "a1"),
+                                             ("a", "turn", "a2"), ("b", "plan", "b0")]]
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["queued"] == {"compact": 1, "turn": 2, "plan": 1}
+        release.set()
+        await asyncio.gather(first, *rest)
+
+    asyncio.run(main())
+    assert order == ["a0", "a1", "b0", "a2", "c0"]
+    assert scheduler.stats()["running"] == 0
+
+
+def test_token_budget_waits_and_refunds_from_usage():
+    scheduler = LLMScheduler(tpm=6000)   # 每秒补 100
+
+    async def main():
+        await scheduler.call("a", "turn", 6000, lambda: asyncio.sleep(0, _result(1000)))   # 退回 5000
+        start = time.monotonic()
+        await scheduler.call("a", "turn", 5000, lambda: asyncio.sleep(0, _result(5000)))
+        refunded = time.monotonic() - start
+        start = time.monotonic()
+        await scheduler.call("a", "turn", 50, lambda: asyncio.sleep(0, _result(50)))
+        return refunded, time.monotonic() - start
+
+    refunded, waited = asyncio.run(main())
+    assert refunded < 0.1
+    assert 0.3 < waited < 2
+
+
+def test_rate_limit_pauses_then_retries():
+    scheduler = LLMScheduler()
+    calls = []
+
+    async def attempt():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            response = httpx.Response(429, headers={"retry-after": "0.3"},
+                                      request=httpx.Request("POST", "http://fake/v1/messages"))
+            raise anthropic.RateLimitError("rate limited", response=response, body=None)
+        return _result()
+
+    asyncio.run(scheduler.call("a", "turn", 0, attempt))
+    assert calls[1] - calls[0] >= 0.3
+    counters = scheduler.stats()["counters"]
+    assert counters["rate_limited"] == 1 and counters["retries"] == 1
+
+
+def test_non_retryable_error_releases_slot():
+    scheduler = LLMScheduler(max_concurrent=1)
+
+    async def attempt():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.call("a", "turn", 0, attempt))
+    assert scheduler.stats()["running"] == 0 and "retries" not in scheduler.stats()["counters"]
@@ -0,0 +1,42 @@
+import httpx
+import anthropic
+
+import model_router
+from agent import Agent
+from model_router import MODEL_FAST, MODEL_STRONG, Route, escalate, parse_routes, route
+
+
+def test_default_routes():
+    assert route("plan", "code") == Route(MODEL_FAST, 512, "fast")
+    assert route("compact", "chat") == Route(MODEL_FAST, 1024, "fast")
+    assert route("turn", "chat") == Route(MODEL_FAST, 2048, "fast")
+    assert route("turn", "code") == Route(MODEL_STRONG, 4096, "strong")
+    assert parse_routes("plan=my-model, bad, turn=strong:100") == {
+        "plan": Route("my-model", 512, "custom"), "turn": Route(MODEL_STRONG, 100, "strong")}
+
+
+def test_escalation_rules():
+    fast = route("turn", "chat")
+    assert escalate("turn", fast) == Route(MODEL_STRONG, 4096, "strong")
+    assert escalate("plan", route("plan", "code")) == Route(MODEL_STRONG, 1024, "strong")
+    assert escalate("turn", route("turn", "code")) is None
+    request = httpx.Request("POST", "http://fake/v1/messages")
+    auth = anthropic.AuthenticationError("bad key", response=httpx.Response(401, request=request), body=None)
+    assert escalate("turn", fast, auth) is None
+    assert escalate("turn", fast, ValueError("not an API error")) is None
+    overloaded = anthropic.InternalServerError("overloaded", response=httpx.Response(529, request=request), body=None)
+    assert escalate("turn", fast, overloaded).model == MODEL_STRONG
+
+
+def test_truncated_fast_turn_is_redone_on_strong_model(api):
+    agent = Agent("router")
+    agent.mode = "chat"
+    api.output_tokens = 3000   # 超过 chat 档的 max_tokens=2048
+    events = []
+    reply = agent.run("写一篇长文", on_event=events.append)
+    assert len(reply) == 12000
+    assert any(e["type"] == "text_reset" for e in events)
+    stats = model_router.stats()
+    assert stats[f"turn/{MODEL_FAST}"]["max_tokens"] >= 1
+    assert stats[f"turn/{MODEL_FAST}"]["escalated"] >= 1
+    assert stats[f"turn/{MODEL_STRONG}"]["calls"] >= 1
@@ -0,0 +1,48 @@
+import agent as agent_module
+import metrics
+import planning
+from agent import Agent
+
+
+def test_planning_stats_in_metrics():
+    planning.policy.record_plan(120.0, 300)
+    planning.policy.record_saved("skipped")
+    text = metrics.render_prometheus()
+    assert 'mini_claw_planning_decisions_total{decision="skipped"}' in text
+    assert 'mini_claw_planning_decisions_total{decision="planned"}' in text
+    assert "mini_claw_planning_saved_ms_total" in text
+    assert 'mini_claw_planning_tokens_total{type="saved"}' in text
+    assert 'mini_claw_planning_tokens_total{type="wasted"}' in text
+
+
+def test_heuristic_and_cache_decisions():
+    assert planning.looks_simple("main.py 是做什么的？")
+    assert not planning.looks_simple("先读 a.py，然后对比 b.py")
+    assert not planning.looks_simple("x" * planning.PLAN_MIN_CHARS)
+    assert planning.normalize("  Refactor, THIS!  ") == "refactor this"
+
+    policy = planning.PlanningPolicy("heuristic", cache_size=1)
+    assert policy.decide("看一下 main.py") == "skip"
+    assert policy.decide("重构整个 gateway 模块") == "plan"
+    policy.remember("重构整个 gateway 模块", "1. 读代码")
+    assert policy.decide("重构整个 gateway 模块！") == "cached"
+    policy.remember("另一个任务", "1. 别的")
+    assert policy.lookup("重构整个 gateway 模块") is None   # 容量 1，被挤掉
+    assert planning.PlanningPolicy("bogus").mode == "heuristic"
+
+
+def test_speculative_turn_answers_directly_or_follows_plan(api, monkeypatch):
+    policy = planning.PlanningPolicy("speculative")
+    monkeypatch.setattr(agent_module, "planning_policy", policy)
+    agent = Agent("speculate")
+
+    assert agent.run("解释一下 main.py") == "ok"
+    assert [m["role"] for m in agent.conversation_history] == ["user", "assistant"]
+    assert policy.counts["speculative_direct"] == 1
+
+    api.tool_rounds = 1
+    assert agent.run("列出目录里的文件") == "ok"
+    assert policy.counts["speculative_planned"] == 1
+    assert policy.wasted_tokens > 0
+    assert any(isinstance(m["content"], str) and m["content"].startswith("我的执行计划")
+               for m in agent.conversation_history)
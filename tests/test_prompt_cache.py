@@ -0,0 +1,31 @@
+import agent as agent_module
+from agent import Agent, CACHE_CONTROL
+from tools import get_all_tools
+
+
+def test_breakpoints_on_tools_system_and_last_message(api):
+    agent = Agent("cache")
+    tools = agent._cached_tools()
+    assert tools[-1]["cache_control"] == CACHE_CONTROL
+    assert all("cache_control" not in t for t in tools[:-1] + get_all_tools())   # 不改注册表
+
+    blocks = agent._system_blocks("本轮附加说明")
+    assert blocks[0]["cache_control"] == CACHE_CONTROL
+    assert blocks[1] == {"type": "text", "text": "本轮附加说明"}
+    assert agent._system_blocks()[0]["text"] == blocks[0]["text"]   # 前缀字节不变才能命中缓存
+
+    history = [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"},
+               {"role": "user", "content": "c"}]
+    sent = agent._with_cache_breakpoint(history)
+    assert sent[:2] == history[:2]
+    assert sent[-1]["content"] == [{"type": "text", "text": "c", "cache_control": CACHE_CONTROL}]
+    assert history[-1] == {"role": "user", "content": "c"}
+
+
+def test_caching_disabled_sends_plain_prompt(api, monkeypatch):
+    monkeypatch.setattr(agent_module, "PROMPT_CACHING", False)
+    agent = Agent("nocache")
+    assert isinstance(agent._system_blocks(), str)
+    assert agent._cached_tools() == get_all_tools()
+    history = [{"role": "user", "content": "c"}]
+    assert agent._with_cache_breakpoint(history) is history
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+import tools
+from tools import read_file
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(tools, "_WORKSPACE", os.path.realpath(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.mark.parametrize("mmap_threshold", [1 << 20, 0])
+def test_reads_by_line_ranges_with_resume_cursor(workspace, monkeypatch, mmap_threshold):
+    monkeypatch.setattr(tools, "MMAP_THRESHOLD", mmap_threshold)
+    (workspace / "big.txt").write_text("".join(f"line {i}\n" for i in range(1, 101)))
+
+    first = read_file("big.txt", max_lines=10)
+    assert first.startswith("[big.txt | 792 bytes | 共 100 行 | 第 1-10 行]")
+    assert first.endswith("line 10\n\n\n[未读完，继续读取：start_line=11]")
+
+    last = read_file("big.txt", start_line=95)
+    assert "第 95-100 行" in last and last.endswith("line 100\n")
+    assert "超出文件范围" in read_file("big.txt", start_line=101)
+
+
+def test_long_line_falls_back_to_byte_ranges(workspace, monkeypatch):
+    monkeypatch.setattr(tools, "READ_CHUNK_BYTES", 10)
+    (workspace / "wide.txt").write_text("中文" * 10)   # 60 字节的单行
+
+    head = read_file("wide.txt")
+    assert head.endswith("中文中\n\n[该行过长，继续读取：byte_offset=9]")
+    # 起点落在汉字中间时对齐到下一个字符
+    assert "字节 12-21]\n\n中文中" in read_file("wide.txt", byte_offset=10)
+
+
+def test_binary_and_outside_paths_are_refused(workspace, tmp_path_factory):
+    (workspace / "blob.bin").write_bytes(b"\0\1\2" * 100)
+    assert "二进制文件" in read_file("blob.bin")
+    outside = tmp_path_factory.mktemp("outside") / "secret.txt"
+    outside.write_text("secret")
+    assert "超出允许的工作目录范围" in read_file(str(outside))
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+import session_log
+from session_log import SessionFile
+
+
+def test_fsync_runs_on_writer_thread_in_order(tmp_path, monkeypatch):
+    fsync_threads = []
+    real_fsync = session_log.os.fsync
+
+    def recording_fsync(fd):
+        fsync_threads.append(threading.get_ident())
+        real_fsync(fd)
+    monkeypatch.setattr(session_log.os, "fsync", recording_fsync)
+
+    log = SessionFile(tmp_path / "s.jsonl", durability="message")
+
+    async def turn():
+        log.append("1\n")
+        log.rewrite(["0\n"])
+        log.append("2\n")
+        await log.flush_async()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(turn())
+    assert (tmp_path / "s.jsonl").read_text() == "0\n2\n"
+    assert len(fsync_threads) == 3 and loop_thread not in fsync_threads
+    log.delete()
+    log.append("3\n")
+    log.flush()
+    assert list(log.lines()) == ["3\n"]
+
+
+def test_turn_is_buffered_into_one_write(tmp_path):
+    for durability, fsyncs in (("none", 0), ("turn", 1), ("message", 3)):
+        log = SessionFile(tmp_path / f"{durability}.jsonl", durability=durability)
+        for i in range(3):
+            log.append(f"{i}\n")
+        assert list(log.lines()) == ["0\n", "1\n", "2\n"]   # 读之前先写出缓存
+        expected_writes = 3 if durability == "message" else 1
+        assert (log.writes, log.fsyncs) == (expected_writes, fsyncs), durability
+        log.close()
+        log.wait()
+
+
+def test_open_handles_are_capped_lru(tmp_path, monkeypatch):
+    monkeypatch.setattr(session_log, "SESSION_MAX_OPEN_FILES", 2)
+    logs = [SessionFile(tmp_path / f"{i}.jsonl") for i in range(4)]
+    for i, log in enumerate(logs):
+        log.append(f"{i}\n")
+        log.flush()
+    assert sum(log._handle is not None for log in logs) <= 2
+    assert logs[-1]._handle is not None
+    logs[0].append("again\n")   # 句柄被关掉的文件下次写时重新打开
+    assert list(logs[0].lines()) == ["0\n", "again\n"]
+    for log in logs:
+        log.close()
+        log.wait()
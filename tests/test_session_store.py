@@ -0,0 +1,86 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+from session_store import JsonlStore, SessionStore, SqliteStore, migrate
+
+
+def test_migrate_cleans_sdk_fields(tmp_path):
+    src = tmp_path / "sessions"
+    src.mkdir()
+    message = {"role": "assistant", "content": [{"type": "text", "text": "hi", "citations": None}]}
+    (src / "42.jsonl").write_text(json.dumps(message) + "\n", encoding="utf-8")
+
+    db = str(tmp_path / "s.db")
+    assert migrate(str(src), db) == {"imported": 1, "skipped": 0, "messages": 1}
+    assert [json.loads(line) for line in SqliteStore(db).load("42")] == [
+        {"role": "assistant", "content": [{"type": "text", "text": "hi"}]}]
+
+
+def test_store_interface_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_sqlite_writes_run_on_writer_thread_in_order(tmp_path):
+    store = SqliteStore(str(tmp_path / "s.db"), durability="turn")
+    threads = []
+    for name in ("_commit", "_rewrite", "_delete"):
+        original = getattr(store, name)
+
+        def recording(*args, _original=original):
+            threads.append(threading.get_ident())
+            return _original(*args)
+        setattr(store, name, recording)
+
+    async def turn():
+        store.append("a", '{"role": "user", "content": "1"}\n')
+        store.rewrite("a", ['{"role": "user", "content": "0"}\n'])
+        store.append("a", '{"role": "assistant", "content": "2"}\n')
+        await store.flush_async("a")
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(turn())
+    assert [json.loads(line)["content"] for line in store.load("a")] == ["0", "2"]
+    store.delete("a")
+    assert store.load("a") == []
+    assert threads and loop_thread not in threads and threading.get_ident() not in threads
+
+
+def _line(role: str, content: str) -> str:
+    return json.dumps({"role": role, "content": content}, ensure_ascii=False) + "\n"
+
+
+@pytest.mark.parametrize("backend", ["jsonl", "sqlite"])
+def test_store_round_trip(tmp_path, backend):
+    store = JsonlStore(str(tmp_path / "sessions")) if backend == "jsonl" else SqliteStore(str(tmp_path / "s.db"))
+    store.append("a", _line("user", "你好"))
+    store.append("a", _line("assistant", "在"))
+    store.append("b", _line("user", "别的会话"))
+    store.flush("a")
+    assert store.load("a") == [_line("user", "你好"), _line("assistant", "在")]
+
+    store.rewrite("a", [_line("user", "摘要")])
+    store.append("a", _line("user", "继续"))
+    assert store.load("a") == [_line("user", "摘要"), _line("user", "继续")]
+    assert [(s["session_id"], s["messages"]) for s in store.sessions()] == [("a", 2), ("b", 1)]
+    assert [hit["session_id"] for hit in store.search("别的")] == ["b"]
+
+    store.delete("b")
+    assert store.load("b") == []
+
+
+def test_sqlite_keeps_archived_history_searchable_and_uses_index(tmp_path):
+    store = SqliteStore(str(tmp_path / "s.db"))
+    store.append("a", _line("user", "原始问题"))
+    store.flush("a")
+    store.rewrite("a", [_line("user", "摘要")])
+    assert store.search("原始问题") == []
+    assert [hit["content"] for hit in store.search("原始问题", include_archived=True)] == ["原始问题"]
+
+    plan = store._conn.execute(
+        "EXPLAIN QUERY PLAN SELECT body FROM messages WHERE session_id = ? AND archived = 0 ORDER BY seq",
+        ("a",)).fetchall()
+    assert any("messages_live" in row[-1] for row in plan)
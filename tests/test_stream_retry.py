@@ -0,0 +1,47 @@
+import uuid
+
+from agent import Agent
+
+
+def _run(text: str):
+    """chat 模式跑一轮，返回 (最终回复, 调用方按事件还原出的流式文字, 事件列表)"""
+    agent = Agent(f"t-{uuid.uuid4().hex[:8]}")
+    agent.mode = "chat"
+    events = []
+    reply = agent.run(text, on_event=events.append)
+    streamed = ""
+    for event in events:
+        if event["type"] == "text_delta":
+            streamed += event["text"]
+        elif event["type"] == "text_reset":
+            streamed = streamed[:len(streamed) - event["chars"]]
+    return reply, streamed, events
+
+
+def test_connection_cut_mid_stream_is_retried_and_reset(api):
+    api.output_tokens = 200
+    before = api.stats["requests"]
+    api.script("cut")
+    reply, streamed, events = _run("hi")
+    assert len(reply) == 800
+    assert streamed == reply
+    assert any(e["type"] == "text_reset" for e in events)
+    assert api.stats["requests"] - before == 2
+
+
+def test_overloaded_error_mid_stream_is_retried_and_reset(api):
+    api.output_tokens = 200
+    api.script("overloaded")
+    reply, streamed, events = _run("hi")
+    assert len(reply) == 800
+    assert streamed == reply
+    assert [e["chars"] for e in events if e["type"] == "text_reset"] == [400]
+
+
+def test_escalation_after_max_tokens_discards_draft(api):
+    # chat 模式默认走 fast:2048，3000 tokens 的回复被截断后升级到 strong:4096 重做
+    api.output_tokens = 3000
+    reply, streamed, events = _run("hi")
+    assert len(reply) == 12000
+    assert streamed == reply
+    assert [e["chars"] for e in events if e["type"] == "text_reset"] == [2048 * 4]
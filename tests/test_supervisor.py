@@ -0,0 +1,44 @@
+import hooks
+from supervisor import HashRing, Supervisor
+
+
+def _register_reply_log(path: str):
+    """worker 进程的 initializer：after_reply 时把回复追加到 path"""
+    def log_reply(data):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(f"{data['chat_id']}:{data['reply']}\n")
+    hooks.register("after_reply", log_reply)
+
+
+def test_initializer_hooks_fire_in_worker(api, tmp_path):
+    log = tmp_path / "replies.log"
+    supervisor = Supervisor(1, initializer=_register_reply_log, initargs=(str(log),)).start()
+    try:
+        assert supervisor.handle_message(7, "hi") == "ok"
+    finally:
+        supervisor.stop()
+    assert log.read_text(encoding="utf-8") == "7:ok\n"
+
+
+def test_hash_ring_is_sticky_and_moves_few_chats():
+    chats = range(2000)
+    three = HashRing([0, 1, 2])
+    assert [three.lookup(c) for c in chats] == [HashRing([0, 1, 2]).lookup(c) for c in chats]
+    counts = [sum(1 for c in chats if three.lookup(c) == n) for n in range(3)]
+    assert min(counts) > 400
+
+    four = HashRing([0, 1, 2, 3])
+    moved = [c for c in chats if three.lookup(c) != four.lookup(c)]
+    assert all(four.lookup(c) == 3 for c in moved)
+    assert len(moved) < 800
+
+
+def test_messages_for_a_chat_go_to_one_worker(api):
+    supervisor = Supervisor(2).start()
+    try:
+        for _ in range(3):
+            assert supervisor.handle_message(7, "hi") == "ok"
+        routed = supervisor.stats()["routed"]
+    finally:
+        supervisor.stop()
+    assert routed[supervisor.ring.lookup(7)] == 3 and sum(routed) == 3
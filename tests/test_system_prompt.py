@@ -0,0 +1,17 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_unknown_time_granularity_falls_back_to_day(tmp_path):
+    # 配置在导入时读取，换一个子进程导入
+    code = ("import agent; print(agent.PROMPT_TIME_GRANULARITY); "
+            "agent.AsyncAgent('granularity')._build_system_prompt()")
+    env = {**os.environ, "PROMPT_TIME_GRANULARITY": "days", "PYTHONPATH": ROOT}
+    result = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "day"
+    assert "PROMPT_TIME_GRANULARITY='days'" in result.stderr
@@ -0,0 +1,63 @@
+import time
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import telegram_channel
+from telegram_channel import ChatSender, TokenBucket
+
+
+def test_slow_chat_does_not_hold_up_others(telegram, monkeypatch):
+    monkeypatch.setattr(telegram_channel, "TELEGRAM_STREAMING", False)
+
+    def submit_message(chat_id, text, on_event=None):
+        future = Future()
+        delay = 1.0 if text == "slow" else 0.0
+        threading.Timer(delay, future.set_result, (f"re: {text}",)).start()
+        return future
+
+    start = time.monotonic()
+    slow = telegram_channel.dispatch(1001, "slow", submit_message)
+    fast = telegram_channel.dispatch(1002, "fast", submit_message)
+    assert time.monotonic() - start < 0.2   # 分发不等回复
+    assert fast.result(timeout=5) and not slow.done()
+    assert telegram.visible(1002) == ["re: fast"]
+    assert slow.result(timeout=5)
+    assert telegram.visible(1001) == ["re: slow"]
+
+
+def test_sender_keeps_order_per_chat_and_runs_chats_in_parallel():
+    sender = ChatSender(workers=4)
+    log, lock = [], threading.Lock()
+
+    def send(chat_id, i):
+        time.sleep(0.05)
+        with lock:
+            log.append((chat_id, i))
+
+    start = time.monotonic()
+    futures = [sender.submit(chat_id, send, chat_id, i) for i in range(4) for chat_id in (1, 2, 3)]
+    for f in futures:
+        f.result(timeout=5)
+    assert time.monotonic() - start < 0.5   # 三个聊天并行，每个聊天 4 × 50ms
+    for chat_id in (1, 2, 3):
+        assert [i for c, i in log if c == chat_id] == [0, 1, 2, 3]
+    assert sender.pending() == 0
+
+
+def test_token_bucket_allows_burst_then_paces():
+    bucket = TokenBucket(rate=10, burst=2)
+    now = bucket.updated
+    assert [bucket.reserve(now), bucket.reserve(now)] == [0.0, 0.0]
+    assert bucket.reserve(now) == pytest.approx(0.1)
+    assert TokenBucket(rate=0, burst=1).reserve(now) == 0.0
+
+
+def test_429_is_retried_after_retry_after(telegram):
+    telegram.chat_rate, telegram.chat_burst = 1, 1
+    limited = telegram_channel.stats["rate_limited"]
+    telegram_channel.send_reply(1003, "first")
+    telegram_channel.send_reply(1003, "second")
+    assert telegram.visible(1003) == ["first", "second"]
+    assert telegram_channel.stats["rate_limited"] - limited == 1
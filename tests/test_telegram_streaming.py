@@ -0,0 +1,41 @@
+import telegram_channel
+
+
+def test_text_reset_deletes_rolled_over_draft(telegram):
+    reply = telegram_channel.StreamingReply(42)
+    reply.on_event({"type": "text_delta", "text": "前言\n"})
+    draft = "作废的草稿\n" * 1500   # 超过单条上限，会定稿成两条消息
+    reply.on_event({"type": "text_delta", "text": draft})
+    reply.flush()
+    assert len(telegram.visible(42)) == 3
+
+    reply.on_event({"type": "text_reset", "chars": len(draft)})
+    reply.on_event({"type": "text_delta", "text": "正式回复"})
+    reply.flush()
+    assert telegram.visible(42) == ["前言\n正式回复"]
+
+    reply.finish("前言\n正式回复")
+    assert telegram.visible(42) == ["前言\n正式回复"]
+    assert telegram.stats["deleted"] >= 2
+
+
+def test_text_reset_within_current_message(telegram):
+    reply = telegram_channel.StreamingReply(43)
+    reply.on_event({"type": "text_delta", "text": "草稿"})
+    reply.flush()
+    reply.on_event({"type": "text_reset", "chars": 2})
+    reply.on_event({"type": "text_delta", "text": "答案"})
+    reply.finish("答案")
+    assert telegram.visible(43) == ["答案"]
+    assert telegram.stats["deleted"] == 0
+
+
+def test_failed_submit_does_not_leak_ticker_entry(telegram):
+    def broken_submit(chat_id, text, on_event=None):
+        raise RuntimeError("event loop is closed")
+
+    sent = telegram_channel.dispatch(44, "hi", broken_submit)
+    assert sent.result(timeout=5)
+    assert 44 not in telegram_channel.ticker._typing
+    assert not any(r.chat_id == 44 for r in telegram_channel.ticker._replies)
+    assert telegram.visible(44) == ["[错误] event loop is closed"]
@@ -0,0 +1,44 @@
+import pytest
+
+from tokens import TokenCounter, estimate_text, fit_to_budget, truncate_old_tool_results
+
+
+def _result(tool_use_id: str, text: str) -> dict:
+    return {"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_use_id, "content": text}]}
+
+
+def test_estimate_text_counts_cjk_per_char():
+    assert estimate_text("") == 0
+    assert estimate_text("a" * 400) == 101
+    assert estimate_text("中" * 100) == 101
+
+
+def test_counter_caches_and_calibrates():
+    counter = TokenCounter()
+    message = {"role": "user", "content": "a" * 400}
+    assert counter.total([message]) == 105
+    message["content"] = "b"            # 按对象缓存：同一个 dict 不会重新估算
+    assert counter.count(message) == 105
+    counter.calibrate(estimated=100, actual=200)
+    assert counter.ratio == pytest.approx(1.3)
+    counter.prune([])
+    assert counter.count(message) == 5
+
+
+def test_old_tool_results_are_truncated_recent_kept():
+    big = "x" * 40000
+    messages = [{"role": "user", "content": "read"}, _result("a", big), _result("b", big)]
+    out = truncate_old_tool_results(messages, keep_recent=1, max_tokens=100)
+    assert len(out[1]["content"][0]["content"]) < 300
+    assert out[2] is messages[2]
+    assert messages[1]["content"][0]["content"] == big   # 只改副本
+
+
+def test_fit_to_budget_drops_oldest_and_starts_with_user():
+    messages = [{"role": "user", "content": "a" * 4000},
+                {"role": "assistant", "content": "b" * 4000},
+                _result("c", "c" * 40),
+                {"role": "user", "content": "latest"}]
+    counter = TokenCounter()
+    assert fit_to_budget(messages, counter, 10_000) is messages
+    assert fit_to_budget(messages, counter, 1500) == messages[3:]
@@ -0,0 +1,47 @@
+import tool_cache
+from tool_cache import ToolResultCache, cached_call
+
+
+def test_cached_until_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(tool_cache, "cache", ToolResultCache())
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "a.py"
+    path.write_text("v1")
+    reads = []
+
+    def read_file(path):
+        reads.append(path)
+        with open(path) as f:
+            return f.read()
+
+    assert cached_call("read_file", {"path": "a.py"}, read_file) == "v1"
+    assert cached_call("read_file", {"path": str(path)}, read_file) == "v1"   # 相对 / 绝对路径同一个 key
+    assert len(reads) == 1
+
+    path.write_text("v2 longer")
+    assert cached_call("read_file", {"path": "a.py"}, read_file) == "v2 longer"
+    assert len(reads) == 2
+    assert cached_call("read_file", {"path": "missing.py"}, lambda path: "错误") == "错误"
+    assert tool_cache.cache.stats()["entries"] == 2   # v1 / v2 两个版本，不存在的路径不缓存
+
+
+def test_lru_evicts_by_bytes():
+    cache = ToolResultCache(max_bytes=10)
+    cache.put("a", "x" * 4)
+    cache.put("b", "y" * 4)
+    assert cache.get("a") == "x" * 4      # a 变成最近使用
+    cache.put("c", "z" * 4)
+    assert cache.get("b") is None and cache.get("a") and cache.get("c")
+    cache.put("huge", "w" * 11)           # 超过总预算的结果不缓存
+    assert cache.get("huge") is None
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["bytes"] == 8
+
+
+def test_disabled_cache_always_calls(monkeypatch, tmp_path):
+    monkeypatch.setattr(tool_cache, "TOOL_CACHE_ENABLED", False)
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    for _ in range(2):
+        cached_call("list_files", {"path": "."}, lambda path: calls.append(path) or "listing")
+    assert calls == [".", "."]
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import metrics
+import tool_cache
+from agent import AsyncAgent
+
+RESULT = "x" * (tool_cache.DEDUP_MIN_CHARS + 50)
+
+
+def _round(agent, tool_use_id):
+    agent._tool_round += 1
+    block = SimpleNamespace(name="read_file", input={"path": "a.py"}, id=tool_use_id)
+    content = agent._dedup_result(block, RESULT)
+    return [{"role": "assistant", "content": "读一下"},
+            {"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_use_id, "content": content}]}]
+
+
+def test_compaction_reinlines_references_to_dropped_results(api):
+    agent = AsyncAgent("dedup")
+    first, second = _round(agent, "toolu_1"), _round(agent, "toolu_2")
+    assert tool_cache.referenced_ids(second[1]["content"][0]["content"]) == ["toolu_1"]
+    agent.conversation_history = [{"role": "user", "content": "hi"}] + first + second
+
+    agent._replace_history(3, "摘要")
+    inlined = agent.conversation_history[-1]["content"][0]
+    assert inlined == {"type": "tool_result", "tool_use_id": "toolu_2", "content": RESULT}
+    assert agent._seen_results == {}
+
+    # 原文重新进了 history，之后相同的结果不能再引用已经不存在的 toolu_1
+    third = _round(agent, "toolu_3")
+    assert third[1]["content"][0]["content"] == RESULT
+
+
+def test_budget_drop_reinlines_references(api):
+    agent = AsyncAgent("dedup-budget")
+    first, second = _round(agent, "toolu_1"), _round(agent, "toolu_2")
+    messages = [{"role": "user", "content": "hi"}] + first + [{"role": "user", "content": "again"}] + second
+    kept = agent._fit_to_budget(messages, agent.tokens.total(messages[3:]))
+    assert kept[0] == {"role": "user", "content": "again"}
+    assert kept[-1]["content"][0]["content"] == RESULT
+    assert messages[-1]["content"][0]["content"] != RESULT   # history 本身不改
+
+
+def test_tool_cache_stats_in_metrics():
+    text = metrics.render_prometheus()
+    assert "mini_claw_tool_cache_hit_rate" in text
+    assert "mini_claw_tool_result_dedup_total" in text
@@ -0,0 +1,79 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+import tools
+from tool_pool import ToolPool
+
+
+@pytest.fixture
+def fake_tools(monkeypatch):
+    """工具按名字决定行为：sleep:<秒> 睡一会儿，fail 抛异常；执行顺序记在 order 里"""
+    options = {"slow": {"timeout": 0.1}, "search": {"max_concurrency": 1}}
+    order, running, peak = [], {"search": 0}, {"search": 0}
+    lock = threading.Lock()
+
+    def execute_tool(name, tool_input):
+        with lock:
+            order.append(tool_input.get("tag"))
+            if name == "search":
+                running["search"] += 1
+                peak["search"] = max(peak["search"], running["search"])
+        try:
+            if name == "fail":
+                raise ValueError("boom")
+            time.sleep(tool_input.get("sleep", 0.02))
+            return f"done {tool_input.get('tag')}"
+        finally:
+            if name == "search":
+                with lock:
+                    running["search"] -= 1
+
+    monkeypatch.setattr(tools, "execute_tool", execute_tool)
+    monkeypatch.setattr(tools, "tool_option", lambda name, key: options.get(name, {}).get(key, 0))
+    return order, peak
+
+
+def test_sessions_take_turns(fake_tools):
+    order, _ = fake_tools
+    pool = ToolPool(workers=1)
+
+    async def main():
+        busy = [pool.run("a", "read", {"tag": f"a{i}"}) for i in range(4)]
+        tasks = [asyncio.ensure_future(c) for c in busy]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(pool.run("b", "read", {"tag": "b0"})))
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(main())[-1] == "done b0"
+    assert order.index("b0") <= 2   # 不用等 a 的四个调用全部跑完
+
+
+def test_timeout_keeps_slot_until_thread_finishes(fake_tools):
+    pool = ToolPool(workers=1)
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run("a", "slow", {"tag": "slow", "sleep": 0.5})
+        start = time.monotonic()
+        await pool.run("b", "read", {"tag": "next"})
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) >= 0.3
+    assert pool.stats()["timeouts"] == {"slow": 1}
+
+
+def test_per_tool_concurrency_limit_and_errors(fake_tools):
+    _, peak = fake_tools
+    pool = ToolPool(workers=4)
+
+    async def main():
+        searches = [pool.run(f"s{i}", "search", {"tag": i, "sleep": 0.05}) for i in range(3)]
+        return await asyncio.gather(*searches, pool.run("x", "fail", {}))
+
+    results = asyncio.run(main())
+    assert results[-1] == "工具执行失败：boom"
+    assert peak["search"] == 1
+    assert pool.stats()["running"] == 0
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import gateway
+import http_channel
+import tracing
+
+
+def test_spans_nest_across_tasks_and_record_errors():
+    async def child(i):
+        with tracing.span("child", i=i):
+            await asyncio.sleep(0)
+
+    async def main():
+        with tracing.trace("unit-trace") as root:
+            await asyncio.gather(child(0), child(1))
+            with pytest.raises(ValueError):
+                with tracing.span("broken"):
+                    raise ValueError("boom")
+            root.set(done=True)
+
+    asyncio.run(main())
+    trace = tracing.recent(limit=1, name="unit-trace")[0]
+    spans = {s["name"]: s for s in trace["spans"]}
+    root_id = spans["unit-trace"]["span_id"]
+    assert [s["parent_id"] for s in trace["spans"] if s["name"] == "child"] == [root_id, root_id]
+    assert spans["broken"]["error"] == "ValueError: boom"
+    assert trace["attrs"] == {"done": True}
+    assert tracing.recent(name="unit-trace", min_ms=60_000) == []
+
+
+def test_message_trace_covers_each_stage(api, monkeypatch):
+    monkeypatch.setattr(http_channel, "_on_message", gateway.handle_message)
+    api.tool_rounds = 1
+    chat_id = 919191
+    assert gateway.handle_message(chat_id, "看看目录") == "ok"
+
+    traces = http_channel.app.test_client().get("/debug/traces?name=message&limit=5").get_json()["traces"]
+    trace = next(t for t in traces if t["attrs"]["chat_id"] == chat_id)
+    by_id = {s["span_id"]: s for s in trace["spans"]}
+    parents = {s["name"]: by_id[s["parent_id"]]["name"] if s["parent_id"] else None for s in trace["spans"]}
+    assert parents["queue_wait"] == "message"
+    assert parents["agent.run"] == "message"
+    assert parents["llm"] == "agent.run" and parents["tool"] == "agent.run"
+    assert parents["persist"] == "agent.run"
+    llm = next(s for s in trace["spans"] if s["name"] == "llm")
+    assert "first_token" in [e["name"] for e in llm["events"]]
+
+    exposition = http_channel.app.test_client().get("/metrics").get_data(as_text=True)
+    assert 'mini_claw_stage_latency_ms_count{stage="tool"}' in exposition
@@ -0,0 +1,43 @@
+from workspace_index import WorkspaceIndex
+
+
+def _index(tmp_path):
+    ws = tmp_path / "ws"
+    ws.mkdir()
+    (ws / "gateway.py").write_text("def handle_message(chat_id, text):\n    return text\n")
+    (ws / "other.py").write_text("def handle(x):\n    return x\n")
+    return WorkspaceIndex(str(ws), index_dir=str(tmp_path / "index"))
+
+
+def test_edge_token_matches_longer_identifiers(tmp_path):
+    # "handle" 本身也是索引词，但仍要匹配只含 handle_message 的文件
+    paths = {rel for rel, _, _ in _index(tmp_path).search("handle")}
+    assert paths == {"gateway.py", "other.py"}
+
+
+def test_query_ending_in_partial_identifier(tmp_path):
+    results = _index(tmp_path).search("def handle")
+    assert {rel for rel, _, _ in results} == {"gateway.py", "other.py"}
+    assert ("gateway.py", 1, "def handle_message(chat_id, text):") in results
+
+
+def test_interior_token_is_exact(tmp_path):
+    results = _index(tmp_path).search("def handle(x)")
+    assert [rel for rel, _, _ in results] == ["other.py"]
+
+
+def test_prefix_and_infix_tokens(tmp_path):
+    index = _index(tmp_path)
+    # 左侧被空格隔开：前缀匹配；两侧都接着标识符字符：子串匹配
+    assert {rel for rel, _, _ in index.search("def handle_m")} == {"gateway.py"}
+    assert {rel for rel, _, _ in index.search("andle_mess")} == {"gateway.py"}
+    assert index.search("def andle") == []
+
+
+def test_vocab_follows_new_files(tmp_path):
+    index = _index(tmp_path)
+    index.refresh(force=True)
+    (tmp_path / "ws" / "late.py").write_text("handle_late = 1\n")
+    index.refresh(force=True)
+    assert index._vocab == sorted(index.postings)
+    assert {rel for rel, _, _ in index.search("dle_lat")} == {"late.py"}
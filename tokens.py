@@ -0,0 +1,200 @@
+"""
+Token 计量
+
+MAX_HISTORY / KEEP_RECENT 数的是消息条数，但一条 read_file 的 tool_result 可能有几百 KB，
+同样的条数上下文大小能差几个数量级。这里按 token 估算上下文大小：
+
+  - estimate_text()：本地快速估算（ASCII 约 4 字符 / token，CJK 约 1 字 / token）
+  - TokenCounter：按消息缓存估算值，并用响应里的真实 usage 校准估算比例
+  - truncate_old_tool_results() / fit_to_budget()：请求前裁剪，保证不超过输入预算
+
+需要精确值时（估算值接近预算），由 Agent 调用 count_tokens 接口确认。
+"""
+
+import json
+import logging
+
+import blob_store
+from tool_cache import referenced_ids
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_OVERHEAD = 4       # 每条消息的角色/分隔符开销
+IMAGE_TOKENS = 1600        # 图片按固定值估算
+
+
+def estimate_text(text: str) -> int:
+    """
+    本地估算一段文本的 token 数。
+
+    不逐字遍历：用 UTF-8 字节数和字符数之差推算非 ASCII 字符个数
+    （CJK 字符 3 字节），全部在 C 层完成，几百 KB 的文本也只要微秒级。
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    non_ascii = (len(text.encode("utf-8", "surrogatepass")) - chars) // 2
+    ascii_chars = max(0, chars - non_ascii)
+    return ascii_chars // 4 + non_ascii + 1
+
+
+def _block_text(block) -> str:
+    """把 content block 还原成用于估算的文本"""
+    if isinstance(block, str):
+        return block
+    if not isinstance(block, dict):
+        block = {"type": getattr(block, "type", None), "text": getattr(block, "text", ""),
+                 "name": getattr(block, "name", ""), "input": getattr(block, "input", {})}
+    t = block.get("type")
+    if t == "text":
+        return block.get("text", "")
+    if t == "tool_use":
+        return block.get("name", "") + json.dumps(block.get("input", {}), ensure_ascii=False)
+    if t == "tool_result":
+        content = block.get("content", "")
+        if isinstance(content, list):
+            return "".join(_block_text(b) for b in content)
+        return str(content)
+    return json.dumps(block, ensure_ascii=False, default=str)
+
+
+def estimate_message(message: dict) -> int:
+    """估算单条消息的 token 数"""
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return estimate_text(content) + MESSAGE_OVERHEAD
+    total = MESSAGE_OVERHEAD
+    for block in content:
+        if isinstance(block, dict) and block.get("type") == "image":
+            total += IMAGE_TOKENS
+        elif blob_store.is_ref(block):
+            total += block["tokens"]   # 正文在 blob_store 里，存引用时已估算过
+        else:
+            total += estimate_text(_block_text(block))
+    return total
+
+
+class TokenCounter:
+    """
+    每个会话一个：缓存每条消息的估算值，并用真实 usage 校准。
+
+    缓存以消息对象的 id 为 key，同时持有消息引用（保证 id 不被复用）；
+    history 被整体替换（压缩 / 重置）后调用 prune() 清掉失效条目。
+    """
+
+    def __init__(self):
+        self._cache: dict[int, tuple[dict, int]] = {}
+        self.ratio = 1.0   # 真实值 / 估算值，指数移动平均
+
+    def count(self, message: dict) -> int:
+        """单条消息校准前的估算值（带缓存）"""
+        entry = self._cache.get(id(message))
+        if entry is not None and entry[0] is message:
+            return entry[1]
+        n = estimate_message(message)
+        self._cache[id(message)] = (message, n)
+        return n
+
+    def raw_total(self, messages: list) -> int:
+        return sum(self.count(m) for m in messages)
+
+    def total(self, messages: list) -> int:
+        """一组消息校准后的估算 token 数"""
+        return int(self.raw_total(messages) * self.ratio)
+
+    def calibrate(self, estimated: int, actual: int) -> None:
+        """用一次请求的真实输入 token 数修正估算比例"""
+        if estimated <= 0 or actual <= 0:
+            return
+        self.ratio = 0.7 * self.ratio + 0.3 * (actual / estimated)
+
+    def prune(self, messages: list) -> None:
+        """只保留仍在 messages 里的缓存条目"""
+        alive = {id(m) for m in messages}
+        self._cache = {k: v for k, v in self._cache.items() if k in alive}
+
+
+# ============================================================
+# 请求前裁剪（只改发给 API 的副本，不改 history 和 session 文件）
+# ============================================================
+
+def _truncate_result(block: dict, max_tokens: int) -> dict:
+    """把一个 tool_result 截到大约 max_tokens，保留开头并注明原始大小"""
+    if blob_store.is_ref(block):
+        # 存在 blob_store 里的大结果：只读开头一段，不整体载入
+        original = block["tokens"]
+        if original <= max_tokens:
+            return block
+        keep = blob_store.head(block["blob"], max_tokens * 2)
+        note = f"\n\n……[内容已截断：原文约 {original} tokens，如需后续内容请重新读取]"
+        return blob_store.resolve(block, keep + note)
+    text = _block_text(block)
+    original = estimate_text(text)
+    if original <= max_tokens:
+        return block
+    # 按 ASCII 的 4 字符/token 粗截，宁可少留
+    keep = text[:max_tokens * 2]
+    note = f"\n\n……[内容已截断：原文约 {original} tokens，如需后续内容请重新读取]"
+    return {**block, "content": keep + note}
+
+
+def _has_tool_result(message: dict) -> bool:
+    content = message.get("content")
+    return isinstance(content, list) and any(
+        isinstance(b, dict) and b.get("type") == "tool_result" for b in content
+    )
+
+
+def truncate_old_tool_results(messages: list, keep_recent: int, max_tokens: int) -> list:
+    """
+    截断较早的大 tool_result。
+
+    最近 keep_recent 条含 tool_result 的消息保持原样（Agent 可能正在用），
+    更早的、超过 max_tokens 的结果只保留开头。
+    被后面的去重引用（tool_cache.reference）指向的结果也保持原样，否则引用就落空了。
+    只截大结果：截断点随轮次后移会让 Prompt Caching 的前缀在那里失配，
+    大结果省下的 token 远多于这次缓存未命中的代价。
+    """
+    result_positions = [i for i, m in enumerate(messages) if _has_tool_result(m)]
+    old = set(result_positions[:-keep_recent] if keep_recent else result_positions)
+    if not old:
+        return messages
+    protected = set()
+    for i in result_positions:
+        for b in messages[i]["content"]:
+            if isinstance(b, dict) and b.get("type") == "tool_result" and isinstance(b.get("content"), str):
+                protected.update(referenced_ids(b["content"]))
+    out = []
+    for i, m in enumerate(messages):
+        if i in old:
+            content = [
+                _truncate_result(b, max_tokens)
+                if isinstance(b, dict) and b.get("type") == "tool_result" and b.get("tool_use_id") not in protected
+                else b
+                for b in m["content"]
+            ]
+            m = {**m, "content": content}
+        out.append(m)
+    return out
+
+
+def fit_to_budget(messages: list, counter: TokenCounter, budget: int) -> list:
+    """
+    硬预算：估算超出 budget 时，从最早的消息开始丢弃。
+
+    丢弃后保证第一条是普通 user 消息（不能以 assistant 或孤立的 tool_result 开头），
+    至少保留最后一条消息。
+    """
+    total = counter.total(messages)
+    if total <= budget:
+        return messages
+    start = 0
+    while start < len(messages) - 1 and total > budget:
+        total -= int(counter.count(messages[start]) * counter.ratio)
+        start += 1
+    while start < len(messages) - 1 and (
+        messages[start].get("role") != "user" or _has_tool_result(messages[start])
+    ):
+        start += 1
+    logger.warning(f"上下文超出预算 {budget} tokens，丢弃最早的 {start} 条消息")
+    return messages[start:]
@@ -0,0 +1,212 @@
+"""
+工具结果缓存
+
+同样的 read_file / list_files 调用反复出现：同一次 run() 的不同轮次里，
+以及指向同一个 WORKSPACE_PATH 的不同会话之间。每次都重新读盘。
+
+这里做两件事：
+  1. 进程共享的 LRU 缓存，挡在 execute_tool 前面。
+     key = (工具名, 规范化参数, 文件 mtime/size/inode)，文件一变 key 就变，不会读到旧内容；
+     目录的 mtime 反映不了子文件大小变化，所以目录结果额外按 TOOL_CACHE_DIR_TTL 秒分桶过期。
+     总大小受 TOOL_CACHE_MAX_BYTES 限制。
+  2. 历史去重的辅助函数：同一会话里重复出现的相同结果，
+     在 history 里换成一句「与第 N 轮结果相同」的引用，不再塞一份全文。
+     引用指向的原始结果被压缩或按预算丢弃后，inline_references() 把原文换回引用处。
+
+缓存命中率和去重次数见 /metrics。
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+from collections import Counter, OrderedDict
+from threading import Lock
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TOOL_CACHE_ENABLED = os.environ.get("TOOL_CACHE", "1") == "1"
+TOOL_CACHE_MAX_BYTES = int(os.environ.get("TOOL_CACHE_MAX_BYTES", str(64 << 20)))
+TOOL_CACHE_DIR_TTL = float(os.environ.get("TOOL_CACHE_DIR_TTL", "5"))
+
+# 结果短于这个长度就不做历史去重（引用本身也要几十个字符）
+DEDUP_MIN_CHARS = 200
+
+
+def _stamp(path: str):
+    """文件版本戳；目录再加上时间分桶。路径不存在时返回 None（不缓存）"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if os.path.isdir(path):
+        stamp += (int(time.time() // TOOL_CACHE_DIR_TTL),)
+    return stamp
+
+
+def make_key(tool_name: str, tool_input: dict):
+    """缓存 key；参数里没有 path 或 path 不存在时返回 None"""
+    args = dict(tool_input)
+    path = args.get("path", ".")
+    real = os.path.realpath(path)
+    stamp = _stamp(real)
+    if stamp is None:
+        return None
+    args["path"] = real
+    return tool_name, json.dumps(args, sort_keys=True, ensure_ascii=False), stamp
+
+
+class ToolResultCache:
+    """按字节预算淘汰的 LRU 缓存（线程安全，工具在线程池里并发执行）"""
+
+    def __init__(self, max_bytes: int = TOOL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value: str):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+cache = ToolResultCache()
+
+
+def cached_call(tool_name: str, tool_input: dict, func):
+    """带缓存地执行一次工具调用"""
+    if not TOOL_CACHE_ENABLED:
+        return func(**tool_input)
+    key = make_key(tool_name, tool_input)
+    if key is None:
+        return func(**tool_input)
+    result = cache.get(key)
+    if result is None:
+        result = func(**tool_input)
+        cache.put(key, result)
+    return result
+
+
+# ============================================================
+# 历史去重
+# ============================================================
+
+_REF_TEMPLATE = "[结果与第 {round} 轮工具调用（tool_use_id={tool_use_id}）完全相同，内容未变化，请直接参考那次的结果]"
+_REF_RE = re.compile(r"tool_use_id=(\S+?)）完全相同，内容未变化")
+
+
+def result_digest(tool_name: str, tool_input: dict, result: str) -> str:
+    data = json.dumps([tool_name, tool_input, result], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def reference(round_no: int, tool_use_id: str) -> str:
+    """重复结果在 history 里的替代文本"""
+    return _REF_TEMPLATE.format(round=round_no, tool_use_id=tool_use_id)
+
+
+def referenced_ids(text: str) -> list[str]:
+    """从一段 tool_result 文本里找出它引用的原始 tool_use_id"""
+    if len(text) > 300:
+        return []
+    return _REF_RE.findall(text)
+
+
+dedup_stats: Counter = Counter()   # references（写成引用的结果数）/ saved_chars / reinlined（原文已丢、换回原文的引用数）
+
+
+def _reference_target(block, originals: dict):
+    """block 是指向 originals 里某个结果的引用时，返回那个原始结果"""
+    if not (isinstance(block, dict) and block.get("type") == "tool_result" and isinstance(block.get("content"), str)):
+        return None
+    return next((originals[i] for i in referenced_ids(block["content"]) if i in originals), None)
+
+
+def inline_references(messages: list, dropped: list) -> list:
+    """
+    messages 里指向 dropped（被压缩或按预算丢掉的消息）中原始结果的引用，换回原始结果。
+    原始结果存在 blob_store 里的，换回的也是 blob 引用。只复制被改动的消息，其余原样返回。
+    """
+    originals = {}
+    for m in dropped:
+        content = m.get("content")
+        if isinstance(content, list):
+            for b in content:
+                if isinstance(b, dict) and b.get("type") == "tool_result" \
+                        and not (isinstance(b.get("content"), str) and referenced_ids(b["content"])):
+                    originals[b["tool_use_id"]] = b
+    if not originals:
+        return messages
+    out = []
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list) and any(_reference_target(b, originals) is not None for b in content):
+            inlined = []
+            for b in content:
+                original = _reference_target(b, originals)
+                if original is not None:
+                    b = {**original, "tool_use_id": b["tool_use_id"]}
+                    dedup_stats["reinlined"] += 1
+                inlined.append(b)
+            m = {**m, "content": inlined}
+        out.append(m)
+    return out
+
+
+def _collect_metrics():
+    stats = cache.stats()
+    return [
+        ("mini_claw_tool_cache_entries", "gauge", "工具结果缓存条目数", [({}, stats["entries"])]),
+        ("mini_claw_tool_cache_bytes", "gauge", "工具结果缓存占用字节数", [({}, stats["bytes"])]),
+        ("mini_claw_tool_cache_hit_rate", "gauge", "工具结果缓存命中率", [({}, stats["hit_rate"])]),
+        ("mini_claw_tool_cache_events_total", "counter", "工具结果缓存命中 / 未命中 / 淘汰次数",
+         [({"event": e}, stats[e]) for e in ("hits", "misses", "evictions")]),
+        ("mini_claw_tool_result_dedup_total", "counter",
+         "history 去重：写成引用的结果数、省下的字符数、原文已丢弃后换回原文的引用数",
+         [({"type": k}, dedup_stats[k]) for k in ("references", "saved_chars", "reinlined")]),
+    ]
+
+
+metrics.register(_collect_metrics)
@@ -0,0 +1,197 @@
+"""
+工具执行池
+
+原来每轮工具调用都 asyncio.to_thread 一下：没有超时，没有全局上限，
+一个会话一次发十个 search_code 就能把默认线程池占满，其他会话的 read_file 只能排队。
+
+这里换成进程共享的有界执行池：
+  - 全局最多 TOOL_POOL_WORKERS 个工具同时执行
+  - 按会话轮转调度：每个会话各排各的队，空出一个槽位就轮到下一个会话，
+    单个会话发再多调用也只能占到自己那一份
+  - @tool(max_concurrency=N) 限制单个工具的并发（比如会扫整个工作区的 search_code）
+  - @tool(timeout=秒) 或 TOOL_TIMEOUT：执行超时后调用方立即拿到超时错误；
+    线程没法强行终止，槽位等线程真正结束才释放，不会因为超时而超卖
+  - @tool(cpu_bound=True) 的工具在 TOOL_PROCESS_WORKERS > 0 时放进进程池，不占 GIL
+  - 排队等待时间、执行时间直方图见 stats()
+"""
+
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from collections import OrderedDict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
+
+import tools
+import metrics
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+TOOL_POOL_WORKERS = int(os.environ.get("TOOL_POOL_WORKERS", "8"))
+TOOL_PROCESS_WORKERS = int(os.environ.get("TOOL_PROCESS_WORKERS", "0"))
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "30"))
+
+
+class _Job:
+    __slots__ = ("name", "tool_input", "loop", "started", "done", "enqueued_at", "cancelled")
+
+    def __init__(self, name: str, tool_input: dict, loop: asyncio.AbstractEventLoop):
+        self.name = name
+        self.tool_input = tool_input
+        self.loop = loop
+        self.started = loop.create_future()   # 开始执行时置位
+        self.done = loop.create_future()      # 结果
+        self.enqueued_at = time.monotonic()
+        self.cancelled = False
+
+
+def _set_result(future: asyncio.Future, result=None, error: BaseException | None = None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class ToolPool:
+    """
+    调度状态由一把锁保护：工具在线程池 / 进程池里执行完的回调发生在工作线程，
+    提交发生在事件循环线程，结果通过 call_soon_threadsafe 交回调用方所在的循环。
+    """
+
+    def __init__(self, workers: int = TOOL_POOL_WORKERS, process_workers: int = TOOL_PROCESS_WORKERS):
+        self.workers = max(1, workers)
+        self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tool")
+        self._process_workers = process_workers
+        self._processes = None
+        self._lock = Lock()
+        self._queues: OrderedDict[str, deque] = OrderedDict()   # 会话 → 排队中的调用，按轮转顺序
+        self._running = 0
+        self._running_by_tool: Counter = Counter()
+
+        self.queue_wait = Histogram()
+        self.exec_time: dict[str, Histogram] = {}
+        self.timeouts: Counter = Counter()
+
+    async def run(self, session: str, name: str, tool_input: dict) -> str:
+        """排队执行一个工具，返回结果字符串；执行超时抛 asyncio.TimeoutError"""
+        job = _Job(name, tool_input, asyncio.get_running_loop())
+        with self._lock:
+            self._queues.setdefault(session, deque()).append(job)
+        self._dispatch()
+        try:
+            await job.started
+            timeout = tools.tool_option(name, "timeout") or TOOL_TIMEOUT
+            return await asyncio.wait_for(asyncio.shield(job.done), timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            self.timeouts[name] += 1
+            logger.warning(f"工具 {name} 执行超时，调用方已放弃等待（线程结束后才释放槽位）")
+            raise
+        finally:
+            job.cancelled = True   # 还在排队时被取消（会话重置等），调度时跳过
+
+    def _take(self):
+        """按会话轮转取下一个能执行的调用；必须持有锁"""
+        for session in list(self._queues):
+            q = self._queues[session]
+            for job in list(q):
+                if job.cancelled:
+                    q.remove(job)
+                    continue
+                limit = tools.tool_option(job.name, "max_concurrency")
+                if limit and self._running_by_tool[job.name] >= limit:
+                    continue
+                q.remove(job)
+                if q:
+                    self._queues.move_to_end(session)   # 这个会话排到最后，下次先轮别人
+                else:
+                    del self._queues[session]
+                return job
+            if not q:
+                del self._queues[session]
+        return None
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self._running >= self.workers:
+                    return
+                job = self._take()
+                if job is None:
+                    return
+                self._running += 1
+                self._running_by_tool[job.name] += 1
+            self._start(job)
+
+    def _start(self, job: _Job):
+        self.queue_wait.observe((time.monotonic() - job.enqueued_at) * 1000)
+        job.loop.call_soon_threadsafe(_set_result, job.started)
+        started_at = time.monotonic()
+        if tools.tool_option(job.name, "cpu_bound") and self._process_workers > 0:
+            future = self._process_pool().submit(tools.execute_tool, job.name, job.tool_input)
+        else:
+            future = self._threads.submit(tools.execute_tool, job.name, job.tool_input)
+
+        def finished(f):
+            elapsed = (time.monotonic() - started_at) * 1000
+            self.exec_time.setdefault(job.name, Histogram()).observe(elapsed)
+            with self._lock:
+                self._running -= 1
+                self._running_by_tool[job.name] -= 1
+            error = f.exception()
+            if error is not None:
+                logger.error(f"工具 {job.name} 执行异常：{error}")
+                result, error = f"工具执行失败：{error}", None
+            else:
+                result = f.result()
+            job.loop.call_soon_threadsafe(_set_result, job.done, result, error)
+            self._dispatch()
+
+        future.add_done_callback(finished)
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._processes is None:
+                # spawn：fork 一个已经有多个线程的进程不安全
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self._process_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._processes
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued = sum(len(q) for q in self._queues.values())
+            sessions = len(self._queues)
+            running = self._running
+        return {
+            "workers": self.workers,
+            "running": running,
+            "queued": queued,
+            "queued_sessions": sessions,
+            "timeouts": dict(self.timeouts),
+            "queue_wait": self.queue_wait.stats(),
+            "exec_time": {name: h.stats() for name, h in self.exec_time.items()},
+        }
+
+
+pool = ToolPool()
+
+
+def _collect_metrics():
+    stats = pool.stats()
+    return [
+        ("mini_claw_tool_pool_running", "gauge", "正在执行的工具调用数", [({}, stats["running"])]),
+        ("mini_claw_tool_pool_queued", "gauge", "在工具执行池排队的调用数", [({}, stats["queued"])]),
+        ("mini_claw_tool_queue_wait_ms", "histogram", "工具调用在执行池里的排队时间（毫秒）",
+         [({}, pool.queue_wait)]),
+        ("mini_claw_tool_exec_ms", "histogram", "工具执行耗时（毫秒）",
+         [({"tool": name}, h) for name, h in sorted(pool.exec_time.items())]),
+        ("mini_claw_tool_timeouts_total", "counter", "工具执行超时次数",
+         [({"tool": name}, n) for name, n in sorted(pool.timeouts.items())]),
+    ]
+
+
+metrics.register(_collect_metrics)
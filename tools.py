@@ -8,15 +8,32 @@
 
 mini-claw 版本：只保留只读工具（safe by default）
    - read_file：读文件
-   - list_files：列目录
+   - list_files：列目录（可递归、按通配符过滤、跳过 .gitignore，分页）
+   - search_code / find_symbol：基于工作区索引的搜索（workspace_index.py）
    危险工具（execute_code、write_file）暂不开放
 """
 
 import os
+import re
+import mmap
+import heapq
+import fnmatch
 from dotenv import load_dotenv
+import gitignore
+from workspace_index import get_index
+import tool_cache
 
 load_dotenv()
 
+# read_file 单次最多返回多少行 / 多少字节，超出部分给出续读游标
+READ_CHUNK_LINES = int(os.environ.get("READ_CHUNK_LINES", "2000"))
+READ_CHUNK_BYTES = int(os.environ.get("READ_CHUNK_BYTES", "100000"))
+MMAP_THRESHOLD = 1 << 20      # 超过 1MB 的文件用 mmap 按需读取，不整体载入内存
+BINARY_SAMPLE_BYTES = 8192    # 判断二进制文件时只采样开头这么多字节
+
+# list_files 每页默认条目数（超出部分给出续页游标）
+LIST_PAGE_SIZE = int(os.environ.get("LIST_PAGE_SIZE", "500"))
+
 # ============================================================
 # 安全边界
 # ============================================================
@@ -45,10 +62,17 @@ def _is_safe_path(path: str) -> bool:
 _tool_registry = {}
 
 
-def tool(name: str, description: str, params: dict):
+def tool(name: str, description: str, params: dict, cache: bool = False,
+         timeout: float = 0, max_concurrency: int = 0, cpu_bound: bool = False):
     """
     工具注册装饰器
 
+    cache=True：结果只取决于 path 指向的文件/目录内容，可以进 tool_cache.py 的共享缓存
+    以下给 tool_pool.py 的执行池用：
+      timeout：执行超时秒数，0 表示用全局 TOOL_TIMEOUT
+      max_concurrency：全进程同时执行的上限，0 表示不单独限制
+      cpu_bound=True：开启进程池时放进进程池执行
+
     用法：
         @tool(
             name="read_file",
@@ -75,7 +99,11 @@ def tool(name: str, description: str, params: dict):
         }
         _tool_registry[name] = {
             "schema": schema,
-            "function": func
+            "function": func,
+            "cache": cache,
+            "timeout": timeout,
+            "max_concurrency": max_concurrency,
+            "cpu_bound": cpu_bound
         }
         return func
     return decorator
@@ -85,17 +113,152 @@ def tool(name: str, description: str, params: dict):
 # 工具定义
 # ============================================================
 
+# ============================================================
+# 文件分块读取
+#
+# 大文件不再 f.read() 整体读进来：
+#   - 超过 MMAP_THRESHOLD 的文件用 mmap，只有被访问的页才进内存
+#   - 按行或按字节范围取一块，块大小有上限，末尾给出续读游标
+#   - 行号定位按 1MB 分块用 bytes.count 数换行，C 层完成
+# ============================================================
+
+_SCAN_CHUNK = 1 << 20
+_line_counts: dict[tuple, int] = {}   # (path, mtime_ns, size) → 总行数，大文件避免重复数
+
+
+def _looks_binary(sample: bytes) -> bool:
+    """采样判断：含 NUL 字节，或控制字符占比过高"""
+    if not sample:
+        return False
+    if b"\0" in sample:
+        return True
+    control = sum(1 for b in sample if b < 32 and b not in (9, 10, 12, 13, 27))
+    return control / len(sample) > 0.3
+
+
+def _count_lines(buf, key: tuple) -> int:
+    if key in _line_counts:
+        return _line_counts[key]
+    n = 0
+    for pos in range(0, len(buf), _SCAN_CHUNK):
+        n += buf[pos:pos + _SCAN_CHUNK].count(b"\n")
+    if len(buf) and buf[len(buf) - 1:] != b"\n":
+        n += 1   # 最后一行没有换行符
+    if len(_line_counts) > 256:
+        _line_counts.clear()
+    _line_counts[key] = n
+    return n
+
+
+def _line_offset(buf, line_no: int) -> int | None:
+    """第 line_no 行（1 起）开头的字节偏移，超出文件返回 None"""
+    need = line_no - 1
+    if need == 0:
+        return 0
+    for pos in range(0, len(buf), _SCAN_CHUNK):
+        chunk = buf[pos:pos + _SCAN_CHUNK]
+        count = chunk.count(b"\n")
+        if count >= need:
+            idx = -1
+            for _ in range(need):
+                idx = chunk.find(b"\n", idx + 1)
+            offset = pos + idx + 1
+            return offset if offset < len(buf) else None
+        need -= count
+    return None
+
+
+def _utf8_boundary(buf, end: int) -> int:
+    """把切分点往前挪到 UTF-8 字符边界，避免把一个汉字切成两半"""
+    start = max(0, end - 3)
+    while end > start and end < len(buf) and (buf[end] & 0xC0) == 0x80:
+        end -= 1
+    return end
+
+
+def _read_lines(path: str, buf, size: int, key: tuple, start_line: int, max_lines: int, max_bytes: int) -> str:
+    total = _count_lines(buf, key)
+    begin = _line_offset(buf, start_line)
+    if begin is None:
+        return f"[{path} | {size} bytes | 共 {total} 行]\n\n错误：start_line={start_line} 超出文件范围"
+
+    limit = min(len(buf), begin + max_bytes)
+    end, lines = begin, 0
+    while lines < max_lines and end < len(buf):
+        nl = buf.find(b"\n", end, limit)
+        if nl == -1:
+            if limit >= len(buf):
+                end, lines = len(buf), lines + 1   # 最后一行，没有换行符
+            break
+        end, lines = nl + 1, lines + 1
+
+    header = f"[{path} | {size} bytes | 共 {total} 行"
+    if end == begin:
+        # 单行就超过 max_bytes，只能按字节截取
+        end = _utf8_boundary(buf, limit)
+        text = bytes(buf[begin:end]).decode("utf-8", errors="replace")
+        return (f"{header} | 第 {start_line} 行的前 {end - begin} 字节]\n\n{text}\n\n"
+                f"[该行过长，继续读取：byte_offset={end}]")
+
+    last = start_line + lines - 1
+    text = bytes(buf[begin:end]).decode("utf-8", errors="replace")
+    whole = begin == 0 and end >= len(buf)
+    result = f"{header}]\n\n{text}" if whole else f"{header} | 第 {start_line}-{last} 行]\n\n{text}"
+    if end < len(buf):
+        result += f"\n\n[未读完，继续读取：start_line={last + 1}]"
+    return result
+
+
+def _read_bytes(path: str, buf, size: int, byte_offset: int, max_bytes: int) -> str:
+    if byte_offset >= size:
+        return f"[{path} | {size} bytes]\n\n错误：byte_offset={byte_offset} 超出文件范围"
+    while byte_offset < size and (buf[byte_offset] & 0xC0) == 0x80:
+        byte_offset += 1   # 起点落在多字节字符中间时，对齐到下一个字符
+    end = _utf8_boundary(buf, min(size, byte_offset + max_bytes))
+    text = bytes(buf[byte_offset:end]).decode("utf-8", errors="replace")
+    result = f"[{path} | {size} bytes | 字节 {byte_offset}-{end}]\n\n{text}"
+    if end < size:
+        result += f"\n\n[未读完，继续读取：byte_offset={end}]"
+    return result
+
+
 @tool(
     name="read_file",
-    description="读取指定路径的文件内容。当你需要查看文件代码或内容时使用此工具。",
+    description=(
+        "读取指定路径的文件内容。当你需要查看文件代码或内容时使用此工具。"
+        f"每次最多返回 {READ_CHUNK_LINES} 行 / {READ_CHUNK_BYTES} 字节，开头一行是文件大小和总行数，"
+        "没读完时末尾会给出续读参数（start_line 或 byte_offset）。"
+    ),
     params={
         "path": {
             "type": "string",
             "description": "要读取的文件路径"
+        },
+        "start_line": {
+            "type": "integer",
+            "description": "从第几行开始读（1 起），默认 1",
+            "optional": True
+        },
+        "max_lines": {
+            "type": "integer",
+            "description": f"最多读多少行，默认且最多 {READ_CHUNK_LINES}",
+            "optional": True
+        },
+        "byte_offset": {
+            "type": "integer",
+            "description": "按字节位置读取的起点（用于超长单行或续读），指定后忽略 start_line",
+            "optional": True
+        },
+        "max_bytes": {
+            "type": "integer",
+            "description": f"最多读多少字节，默认且最多 {READ_CHUNK_BYTES}",
+            "optional": True
         }
-    }
+    },
+    cache=True
 )
-def read_file(path: str) -> str:
+def read_file(path: str, start_line: int = 1, max_lines: int = None,
+              byte_offset: int = None, max_bytes: int = None) -> str:
     try:
         if not _is_safe_path(path):
             return f"错误：路径超出允许的工作目录范围 - {path}"
@@ -103,24 +266,127 @@ def read_file(path: str) -> str:
             return f"错误：文件不存在 - {path}"
         if not os.path.isfile(path):
             return f"错误：路径不是文件 - {path}"
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read()
+
+        max_lines = min(max_lines or READ_CHUNK_LINES, READ_CHUNK_LINES)
+        max_bytes = min(max_bytes or READ_CHUNK_BYTES, READ_CHUNK_BYTES)
+        start_line = max(1, start_line or 1)
+
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            if _looks_binary(f.read(BINARY_SAMPLE_BYTES)):
+                return f"错误：{path} 看起来是二进制文件（{size} bytes），无法按文本读取"
+            if size == 0:
+                return f"[{path} | 0 bytes | 共 0 行]\n\n"
+
+            if size > MMAP_THRESHOLD:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                f.seek(0)
+                buf = f.read()
+            try:
+                if byte_offset is not None:
+                    return _read_bytes(path, buf, size, max(0, byte_offset), max_bytes)
+                key = (os.path.realpath(path), st.st_mtime_ns, size)
+                return _read_lines(path, buf, size, key, start_line, max_lines, max_bytes)
+            finally:
+                if isinstance(buf, mmap.mmap):
+                    buf.close()
     except Exception as e:
         return f"读取文件失败：{str(e)}"
 
 
+# ============================================================
+# 目录遍历
+#
+# os.scandir 一次拿到名字和类型（d_type），不再对每个条目 isdir + getsize；
+# 只有真正输出的文件才 stat 一次（DirEntry 会缓存结果）。
+# 每层按名字顺序深度优先，输出顺序等于路径分段的字典序，
+# 续页游标就是上一页最后一条的相对路径：比游标小的子树整棵跳过，不用从头再走一遍。
+# ============================================================
+
+def _walk(root: str, depth: int, rules, include_ignored: bool, cursor: tuple, match=None):
+    """
+    按输出顺序产出 (相对路径分段, DirEntry)；depth <= 0 表示不限深度。
+    match 是编译好的通配符：不匹配的文件在入堆前就丢掉（目录照常进入）。
+    """
+    def visit(directory: str, parts: tuple, rules):
+        try:
+            with os.scandir(directory) as it:
+                heap = [(e.name, e) for e in it]
+        except OSError:
+            return
+        if parts and not include_ignored and any(name == ".gitignore" for name, _ in heap):
+            rules = rules.child(directory)
+        level = len(parts)
+        if level < len(cursor) and cursor[:level] == parts:
+            # 游标落在这个目录里：游标之前的条目（及其子树）都在上一页
+            heap = [item for item in heap if item[0] >= cursor[level]]
+        if match:
+            prefix = "/".join(parts + ("",))
+            heap = [item for item in heap
+                    if item[1].is_dir() or match(item[0]) or match(prefix + item[0])]
+        # 堆代替整体排序：一页通常只用到大目录开头的一小部分
+        heapq.heapify(heap)
+        while heap:
+            entry = heapq.heappop(heap)[1]
+            rel = parts + (entry.name,)
+            is_dir = entry.is_dir()
+            if not include_ignored and rules.ignored(entry.path, entry.name, is_dir):
+                continue
+            if rel > cursor:
+                yield rel, entry
+            # 符号链接的目录不进入，避免绕出工作区或成环
+            if is_dir and not entry.is_symlink() and (depth <= 0 or len(rel) < depth):
+                yield from visit(entry.path, rel, rules)
+
+    yield from visit(root, (), rules)
+
+
 @tool(
     name="list_files",
-    description="列出指定目录下的文件和子目录。当你需要了解项目结构时使用此工具。",
+    description=(
+        "列出指定目录下的文件和子目录。当你需要了解项目结构时使用此工具。"
+        "默认只列一层；depth 可以递归展开，pattern 按文件名通配符过滤，默认跳过 .gitignore 忽略的内容。"
+        "结果分页，末尾会给出下一页的 cursor。"
+    ),
     params={
         "path": {
             "type": "string",
             "description": "要列出内容的目录路径，默认为当前目录",
             "optional": True
+        },
+        "depth": {
+            "type": "integer",
+            "description": "递归深度，1 表示只列当前目录（默认），0 表示不限",
+            "optional": True
+        },
+        "pattern": {
+            "type": "string",
+            "description": "通配符过滤，如 *.py；匹配文件名或相对路径，目录仍会进入",
+            "optional": True
+        },
+        "include_ignored": {
+            "type": "boolean",
+            "description": "是否包含 .gitignore 忽略的文件，默认 false",
+            "optional": True
+        },
+        "page_size": {
+            "type": "integer",
+            "description": f"每页最多返回的条目数，默认 {LIST_PAGE_SIZE}",
+            "optional": True
+        },
+        "cursor": {
+            "type": "string",
+            "description": "上一页末尾给出的续页游标",
+            "optional": True
         }
-    }
+    },
+    cache=True
 )
-def list_files(path: str = ".") -> str:
+def list_files(path: str = ".", depth: int = 1, pattern: str | None = None,
+               include_ignored: bool = False, page_size: int | None = None,
+               cursor: str | None = None) -> str:
     try:
         if not _is_safe_path(path):
             return f"错误：路径超出允许的工作目录范围 - {path}"
@@ -128,20 +394,99 @@ def list_files(path: str = ".") -> str:
             return f"错误：目录不存在 - {path}"
         if not os.path.isdir(path):
             return f"错误：路径不是目录 - {path}"
-        entries = os.listdir(path)
+        page_size = max(1, min(page_size or LIST_PAGE_SIZE, LIST_PAGE_SIZE * 10))
+        rules = gitignore.GitIgnore() if include_ignored else gitignore.for_directory(_WORKSPACE, path)
+        after = tuple(cursor.split("/")) if cursor else ()
+        match = re.compile(fnmatch.translate(pattern)).match if pattern else None
+
         result = []
-        for entry in sorted(entries):
-            full_path = os.path.join(path, entry)
-            if os.path.isdir(full_path):
-                result.append(f"  [目录] {entry}/")
+        last = None
+        for rel, entry in _walk(os.path.realpath(path), depth, rules, include_ignored, after, match):
+            rel_path = "/".join(rel)
+            if match and not (match(entry.name) or match(rel_path)):
+                continue
+            if len(result) >= page_size:
+                result.append(f"\n……本页已列出 {page_size} 条，还有更多。继续列出请传 cursor=\"{last}\"")
+                break
+            if entry.is_dir():
+                result.append(f"  [目录] {rel_path}/")
             else:
-                size = os.path.getsize(full_path)
-                result.append(f"  [文件] {entry} ({size} bytes)")
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    size = "?"
+                result.append(f"  [文件] {rel_path} ({size} bytes)")
+            last = rel_path
+        if not result:
+            return f"目录 {path} 下没有匹配的条目"
         return f"目录 {path} 的内容：\n" + "\n".join(result)
     except Exception as e:
         return f"列出目录失败：{str(e)}"
 
 
+@tool(
+    name="search_code",
+    description=(
+        "在整个工作目录里搜索代码文本（不区分大小写的子串匹配），返回 文件:行号: 行内容。"
+        "找某个函数、变量、报错信息在哪里用到时，优先用它，而不是逐个目录 list_files / read_file。"
+    ),
+    params={
+        "query": {
+            "type": "string",
+            "description": "要搜索的文本，例如函数名、字符串片段"
+        },
+        "glob": {
+            "type": "string",
+            "description": "只搜索匹配的文件，例如 *.py 或 src/*.ts",
+            "optional": True
+        },
+        "max_results": {
+            "type": "integer",
+            "description": "最多返回多少条，默认 50",
+            "optional": True
+        }
+    },
+    max_concurrency=2   # 索引刷新要扫整个工作区，多个会话同时搜没有意义
+)
+def search_code(query: str, glob: str = None, max_results: int = 50) -> str:
+    try:
+        if not _WORKSPACE:
+            return "错误：未配置 WORKSPACE_PATH"
+        if not query.strip():
+            return "错误：query 不能为空"
+        hits = get_index(_WORKSPACE).search(query, glob=glob, max_results=min(max_results or 50, 200))
+        if not hits:
+            return f"没有找到包含 {query!r} 的代码"
+        lines = [f"{os.path.join(_WORKSPACE, rel)}:{lineno}: {text[:200]}" for rel, lineno, text in hits]
+        return f"找到 {len(hits)} 处：\n" + "\n".join(lines)
+    except Exception as e:
+        return f"搜索失败：{str(e)}"
+
+
+@tool(
+    name="find_symbol",
+    description="查找 Python 顶层函数、类、模块级变量的定义位置。精确匹配优先，找不到时按前缀匹配。",
+    params={
+        "name": {
+            "type": "string",
+            "description": "符号名，例如 Agent 或 handle_message"
+        }
+    },
+    max_concurrency=2
+)
+def find_symbol(name: str) -> str:
+    try:
+        if not _WORKSPACE:
+            return "错误：未配置 WORKSPACE_PATH"
+        hits = get_index(_WORKSPACE).find_symbol(name.strip())
+        if not hits:
+            return f"没有找到符号 {name!r} 的定义"
+        lines = [f"{os.path.join(_WORKSPACE, rel)}:{lineno}  {kind} {sym}" for rel, lineno, kind, sym in hits]
+        return f"找到 {len(hits)} 个定义：\n" + "\n".join(lines)
+    except Exception as e:
+        return f"查找符号失败：{str(e)}"
+
+
 # ============================================================
 # 对外接口
 # ============================================================
@@ -151,9 +496,17 @@ def get_all_tools() -> list:
     return [entry["schema"] for entry in _tool_registry.values()]
 
 
+def tool_option(tool_name: str, key: str):
+    """工具在 @tool 里声明的执行选项（timeout / max_concurrency / cpu_bound），未知工具返回 None"""
+    entry = _tool_registry.get(tool_name)
+    return entry[key] if entry else None
+
+
 def execute_tool(tool_name: str, tool_input: dict) -> str:
     """执行指定工具"""
     if tool_name not in _tool_registry:
         return f"错误：未知工具 - {tool_name}"
-    func = _tool_registry[tool_name]["function"]
-    return func(**tool_input)
+    entry = _tool_registry[tool_name]
+    if entry["cache"]:
+        return tool_cache.cached_call(tool_name, tool_input, entry["function"])
+    return entry["function"](**tool_input)
@@ -0,0 +1,283 @@
+"""
+请求链路追踪
+
+一条消息从入队到回复经过的每个阶段记成一个 span：
+
+    message                     gateway worker 取出消息到回复完成（起点是入队时间）
+      queue_wait                在会话队列里排队
+      coalesce                  连发合并窗口（SESSION_COALESCE=1 时）
+      agent.run
+        plan                    规划调用（tokens 记在 span 属性里）
+          llm_queue             在 llm_scheduler 的准入队列里等待（plan / llm / compaction 下都有）
+        llm                     一轮执行调用，first_token 事件 = TTFT
+          prepare               上下文预算：截断 / 裁剪 / blob 还原
+          retry_sleep           限流 / 连接错误 / 过载后的退避等待
+        tool                    一次工具调用（含在 tool_pool 里排队的时间）
+        persist                 本轮消息写入会话存储
+    compaction                  后台压缩单独成一条 trace
+
+span 的父子关系靠 contextvars 传递，asyncio 创建 Task 时会复制上下文，
+所以 gather 出去的工具调用自动挂在当前 llm / agent.run 下面。
+
+不需要任何外部依赖：结束的 trace 放在进程内的环形缓冲区（TRACE_BUFFER 条，/debug/traces），
+每种 span 的耗时进直方图（/metrics）。装了 opentelemetry-api 且 TRACE_OTEL=1 时，
+每个 span 同时镜像成一个 OpenTelemetry span，导出到哪里由应用自己配置的 SDK 决定。
+
+用法：
+    with tracing.span("tool", tool=name) as s:
+        ...
+        s.set(result_chars=len(result))
+"""
+
+import os
+import time
+import uuid
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+import metrics
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+TRACING = os.environ.get("TRACING", "1") == "1"
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", "200"))
+TRACE_OTEL = os.environ.get("TRACE_OTEL", "0") == "1"
+
+_otel_tracer = None
+if TRACE_OTEL:
+    try:
+        from opentelemetry import trace as otel_trace
+        _otel_tracer = otel_trace.get_tracer("mini-claw")
+    except ImportError:
+        logger.warning("TRACE_OTEL=1 但未安装 opentelemetry-api，只使用内置追踪")
+
+_current: contextvars.ContextVar = contextvars.ContextVar("mini_claw_span", default=None)
+
+_recent: deque = deque(maxlen=TRACE_BUFFER)
+_recent_lock = Lock()
+
+# 各阶段耗时（毫秒），按 span 名分
+stage_latency: dict[str, Histogram] = {}
+# token 用量累计：(调用类型, token 类型) → 数量
+token_usage: dict[tuple[str, str], int] = {}
+_usage_lock = Lock()
+
+
+class Trace:
+    __slots__ = ("trace_id", "name", "start", "wall_start", "spans", "root")
+
+    def __init__(self, name: str, start: float):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.start = start                                      # perf_counter
+        self.wall_start = time.time() - (time.perf_counter() - start)
+        self.spans: list[Span] = []
+        self.root: Span | None = None   # 根 span 结束时设置
+
+    def to_dict(self) -> dict:
+        spans = list(self.spans)
+        root = self.root
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start": round(self.wall_start, 3),
+            "duration_ms": root.duration_ms if root else None,
+            "attrs": dict(root.attrs) if root else {},
+            "spans": [s.to_dict(self.start) for s in sorted(spans, key=lambda s: s.start)],
+        }
+
+
+class Span:
+    __slots__ = ("name", "trace", "parent", "span_id", "start", "end", "attrs", "events", "error", "_otel")
+
+    def __init__(self, name: str, trace: Trace, parent, start: float, attrs: dict):
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start = start
+        self.end = None
+        self.attrs = attrs
+        self.events: list[tuple[str, float, dict]] = []
+        self.error = None
+        self._otel = None
+
+    @property
+    def duration_ms(self) -> float | None:
+        return None if self.end is None else round((self.end - self.start) * 1000, 2)
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def event(self, name: str, **attrs) -> None:
+        """记一个时间点（如 first_token）"""
+        self.events.append((name, time.perf_counter(), attrs))
+        if self._otel is not None:
+            self._otel.add_event(name, attributes=_otel_attrs(attrs))
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "start_ms": round((self.start - origin) * 1000, 2),
+            "duration_ms": self.duration_ms,
+            "attrs": dict(self.attrs),
+            "events": [{"name": n, "at_ms": round((t - origin) * 1000, 2), **a} for n, t, a in self.events],
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """TRACING=0 时使用，所有操作都是空的"""
+    attrs: dict = {}
+    error = None
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def event(self, name: str, **attrs) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def _otel_attrs(attrs: dict) -> dict:
+    return {k: v if isinstance(v, (str, bool, int, float)) else str(v) for k, v in attrs.items()}
+
+
+def _begin(name: str, parent: Span | None, start: float, attrs: dict) -> Span:
+    trace = parent.trace if parent is not None else Trace(name, start)
+    s = Span(name, trace, parent, start, attrs)
+    if _otel_tracer is not None:
+        context = otel_trace.set_span_in_context(parent._otel) if parent is not None and parent._otel else None
+        s._otel = _otel_tracer.start_span(
+            name, context=context, attributes=_otel_attrs(attrs),
+            start_time=int(trace.wall_start * 1e9 + (start - trace.start) * 1e9),
+        )
+    return s
+
+
+def _finish(s: Span, end: float) -> None:
+    s.end = end
+    s.trace.spans.append(s)
+    hist = stage_latency.get(s.name)
+    if hist is None:
+        hist = stage_latency.setdefault(s.name, Histogram())
+    hist.observe((end - s.start) * 1000)
+    if s._otel is not None:
+        s._otel.set_attributes(_otel_attrs(s.attrs))
+        if s.error:
+            s._otel.set_attribute("error", s.error)
+        s._otel.end(end_time=int(s.trace.wall_start * 1e9 + (end - s.trace.start) * 1e9))
+    if s.parent is None:
+        s.trace.root = s
+        with _recent_lock:
+            _recent.append(s.trace)
+
+
+@contextmanager
+def span(name: str, start: float | None = None, **attrs):
+    """
+    记录一个阶段。当前上下文里有 span 时作为它的子 span，否则开一条新 trace。
+    start 是 time.perf_counter() 时间，不给就是现在（比如消息的 trace 从入队时间算起）。
+    """
+    if not TRACING:
+        yield _NOOP
+        return
+    s = _begin(name, _current.get(), time.perf_counter() if start is None else start, attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        _finish(s, time.perf_counter())
+
+
+@contextmanager
+def trace(name: str, start: float | None = None, **attrs):
+    """开一条新 trace（不挂在当前 span 下），例如后台压缩"""
+    token = _current.set(None)
+    try:
+        with span(name, start, **attrs) as s:
+            yield s
+    finally:
+        _current.reset(token)
+
+
+def record(name: str, start: float, end: float | None = None, **attrs) -> None:
+    """补记一个已经发生的阶段（start / end 是 perf_counter 时间），例如排队等待"""
+    if not TRACING:
+        return
+    s = _begin(name, _current.get(), start, attrs)
+    _finish(s, time.perf_counter() if end is None else end)
+
+
+def current():
+    """当前 span（没有时返回空实现，可以放心调用 set / event）"""
+    return _current.get() or _NOOP
+
+
+def observe(name: str, value_ms: float) -> None:
+    """记一个不对应 span 的耗时，例如 TTFT"""
+    if not TRACING:
+        return
+    hist = stage_latency.get(name)
+    if hist is None:
+        hist = stage_latency.setdefault(name, Histogram())
+    hist.observe(value_ms)
+
+
+def record_usage(kind: str, usage) -> None:
+    """累计 response.usage，并写进当前 span 的属性"""
+    if usage is None:
+        return
+    values = {
+        "input": usage.input_tokens or 0,
+        "output": usage.output_tokens or 0,
+        "cache_read": getattr(usage, "cache_read_input_tokens", None) or 0,
+        "cache_write": getattr(usage, "cache_creation_input_tokens", None) or 0,
+    }
+    with _usage_lock:
+        for token_type, n in values.items():
+            token_usage[(kind, token_type)] = token_usage.get((kind, token_type), 0) + n
+    current().set(**{f"tokens_{k}": v for k, v in values.items()})
+
+
+def recent(limit: int = 50, name: str | None = None, min_ms: float = 0) -> list[dict]:
+    """最近结束的 trace，新的在前"""
+    with _recent_lock:
+        traces = list(_recent)
+    out = []
+    for t in reversed(traces):
+        if name and t.name != name:
+            continue
+        d = t.to_dict()
+        if (d["duration_ms"] or 0) < min_ms:
+            continue
+        out.append(d)
+        if len(out) >= limit:
+            break
+    return out
+
+
+def _collect():
+    with _usage_lock:
+        usage = sorted(token_usage.items())
+    return [
+        ("mini_claw_stage_latency_ms", "histogram", "各处理阶段耗时（毫秒）",
+         [({"stage": name}, hist) for name, hist in sorted(stage_latency.items())]),
+        ("mini_claw_llm_tokens_total", "counter", "LLM token 用量（来自 response.usage）",
+         [({"call": kind, "type": token_type}, n) for (kind, token_type), n in usage]),
+    ]
+
+
+metrics.register(_collect)
@@ -0,0 +1,326 @@
+"""
+工作区索引
+
+Agent 原来只能靠 list_files + read_file 一层层翻目录找代码，
+在大仓库里找一个符号要几十轮 LLM 往返。这里给工作区建一份持久化索引：
+
+  - 文件表：相对路径 → (大小, mtime)
+  - 倒排索引：标识符（小写）→ 包含它的文件
+  - Python 顶层符号：函数 / 类 / 模块级变量 → (文件, 行号)
+
+增量维护：查询前按 mtime 扫一遍目录（有最小间隔），只重建变化的文件。
+旧文件的倒排条目不逐个删除，而是把文件 id 标记作废，查询时过滤；
+作废比例过高时整体重建一次倒排表。
+
+查询里的词可能只是某个标识符的一部分，为此另外维护一份词表：
+排序后的索引词（前缀用 bisect 找区间）和 三元组 → 索引词（子串查找）。
+词表只在出现新词时整体替换、从不原地修改，查询在锁外读它。
+
+索引用 pickle 存在 INDEX_DIR 下，进程重启后直接加载，只做增量扫描。
+对外提供 search_code / find_symbol，由 tools.py 注册成工具。
+"""
+
+import os
+import re
+import ast
+import time
+import pickle
+import hashlib
+from bisect import bisect_left
+import fnmatch
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = os.environ.get("INDEX_DIR", ".index")
+INDEX_REFRESH_INTERVAL = float(os.environ.get("INDEX_REFRESH_INTERVAL", "10"))
+INDEX_MAX_FILE_BYTES = int(os.environ.get("INDEX_MAX_FILE_BYTES", str(1 << 20)))
+
+# 不进索引的目录
+SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv",
+             ".mypy_cache", ".pytest_cache", ".tox", "dist", "build", ".idea", ".vscode", INDEX_DIR}
+
+_TOKEN_RE = re.compile(rb"[A-Za-z_][A-Za-z0-9_]{2,}")
+_IDENT_BYTE = re.compile(rb"[A-Za-z0-9_]")
+_INDEX_VERSION = 1
+
+
+def tokenize(data: bytes) -> set[str]:
+    """提取标识符（≥3 字符，小写）"""
+    return {t.decode("ascii").lower() for t in _TOKEN_RE.findall(data)}
+
+
+def python_symbols(source: bytes) -> list[tuple[str, int, str]]:
+    """Python 文件的顶层符号：(名字, 行号, 类型)"""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+    symbols = []
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            symbols.append((node.name, node.lineno, "class"))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            symbols.append((node.name, node.lineno, "def"))
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for t in targets:
+                if isinstance(t, ast.Name):
+                    symbols.append((t.id, node.lineno, "var"))
+    return symbols
+
+
+class WorkspaceIndex:
+    def __init__(self, root: str, index_dir: str = INDEX_DIR):
+        self.root = os.path.realpath(root)
+        digest = hashlib.sha1(self.root.encode()).hexdigest()[:12]
+        self.index_file = os.path.join(index_dir, f"{digest}.pickle")
+        self._lock = Lock()
+        self._last_refresh = 0.0
+
+        self.files: dict[str, tuple[int, int, int]] = {}    # 相对路径 → (size, mtime_ns, file_id)
+        self.paths: dict[int, str] = {}                      # 有效 file_id → 相对路径
+        self.postings: dict[str, set[int]] = {}              # token → file_id 集合（可能含作废 id）
+        self.symbols: dict[str, list[tuple[int, int, str]]] = {}   # 符号名 → [(file_id, 行号, 类型)]
+        self._next_id = 0
+        self._dead = 0
+
+        self._vocab: list[str] = []                          # 排序后的索引词
+        self._grams: dict[str, list[str]] = {}               # 三元组 → 包含它的索引词
+        self._vocab_dirty = False
+
+        self._load()
+        self._rebuild_vocab()
+
+    # ---------------- 持久化 ----------------
+
+    def _load(self):
+        try:
+            with open(self.index_file, "rb") as f:
+                data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+        if data.get("version") != _INDEX_VERSION or data.get("root") != self.root:
+            return
+        self.files, self.paths = data["files"], data["paths"]
+        self.postings, self.symbols = data["postings"], data["symbols"]
+        self._next_id, self._dead = data["next_id"], data["dead"]
+        logger.info(f"加载工作区索引：{len(self.files)} 个文件")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        tmp = f"{self.index_file}.{os.getpid()}.tmp"   # 多进程模式下各 worker 可能同时保存
+        with open(tmp, "wb") as f:
+            pickle.dump({
+                "version": _INDEX_VERSION, "root": self.root,
+                "files": self.files, "paths": self.paths,
+                "postings": self.postings, "symbols": self.symbols,
+                "next_id": self._next_id, "dead": self._dead,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.index_file)
+
+    # ---------------- 增量维护 ----------------
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        """遍历工作区，返回 相对路径 → (size, mtime_ns)"""
+        found = {}
+        stack = [self.root]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in SKIP_DIRS and not entry.name.startswith("."):
+                                stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            rel = os.path.relpath(entry.path, self.root)
+                            found[rel] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                continue
+        return found
+
+    def _drop(self, rel: str):
+        _, _, file_id = self.files.pop(rel)
+        self.paths.pop(file_id, None)
+        self._dead += 1
+
+    def _add(self, rel: str, size: int, mtime_ns: int):
+        file_id = self._next_id
+        self._next_id += 1
+        self.files[rel] = (size, mtime_ns, file_id)
+        self.paths[file_id] = rel
+        if size > INDEX_MAX_FILE_BYTES:
+            return   # 只记录文件表，不建内容索引
+        try:
+            with open(os.path.join(self.root, rel), "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        if b"\0" in data[:8192]:
+            return   # 二进制文件
+        for token in tokenize(data):
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = set()
+                self._vocab_dirty = True
+            ids.add(file_id)
+        if rel.endswith(".py"):
+            for name, lineno, kind in python_symbols(data):
+                self.symbols.setdefault(name, []).append((file_id, lineno, kind))
+
+    def _compact(self):
+        """作废 id 过多时清理倒排表和符号表"""
+        live = self.paths
+        self.postings = {t: ids & live.keys() for t, ids in self.postings.items()}
+        self.postings = {t: ids for t, ids in self.postings.items() if ids}
+        self.symbols = {n: [s for s in defs if s[0] in live] for n, defs in self.symbols.items()}
+        self.symbols = {n: defs for n, defs in self.symbols.items() if defs}
+        self._dead = 0
+        self._vocab_dirty = True
+
+    def _rebuild_vocab(self):
+        """重建词表；新对象整体替换旧的，已经拿到旧词表的查询不受影响"""
+        vocab = sorted(self.postings)
+        grams: dict[str, list[str]] = {}
+        for token in vocab:
+            for gram in {token[i:i + 3] for i in range(len(token) - 2)}:
+                grams.setdefault(gram, []).append(token)
+        self._vocab, self._grams = vocab, grams
+        self._vocab_dirty = False
+
+    def refresh(self, force: bool = False) -> int:
+        """按 mtime 增量更新索引，返回变化的文件数；两次扫描至少间隔 INDEX_REFRESH_INTERVAL 秒"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_refresh and now - self._last_refresh < INDEX_REFRESH_INTERVAL:
+                return 0
+            self._last_refresh = now
+
+            found = self._scan()
+            changed = 0
+            for rel in [r for r in self.files if r not in found]:
+                self._drop(rel)
+                changed += 1
+            for rel, (size, mtime_ns) in found.items():
+                old = self.files.get(rel)
+                if old is not None and old[0] == size and old[1] == mtime_ns:
+                    continue
+                if old is not None:
+                    self._drop(rel)
+                self._add(rel, size, mtime_ns)
+                changed += 1
+
+            if self._dead > max(1000, len(self.paths) // 3):
+                self._compact()
+            if self._vocab_dirty:
+                self._rebuild_vocab()
+            if changed:
+                self._save()
+                logger.info(f"工作区索引更新：{changed} 个文件变化，共 {len(self.files)} 个")
+            return changed
+
+    # ---------------- 查询 ----------------
+
+    @staticmethod
+    def _expand(token: str, prefix: bool, vocab: list[str], grams: dict[str, list[str]]) -> list[str]:
+        """在词表里找以 token 开头（prefix）或包含 token 的索引词"""
+        if prefix:
+            # 索引词只含 [a-z0-9_]，都小于 "\x7f"
+            return vocab[bisect_left(vocab, token):bisect_left(vocab, token + "\x7f")]
+        # 包含 token 的词一定包含它的每个三元组，取最短的那个列表逐个核对
+        shortest = min((grams.get(token[i:i + 3], []) for i in range(len(token) - 2)), key=len)
+        return [t for t in shortest if token in t]
+
+    def _candidates(self, query: str) -> set[int] | None:
+        """
+        用倒排索引缩小范围；查询里没有可索引的标识符时返回 None（需要全量扫描）。
+
+        子串搜索时，查询两端的词可能只是文件里某个标识符的一部分
+        （"handle" / "def handle" 要匹配 "handle_message"）：左侧被隔开的只需前缀匹配，
+        左侧也可能接着标识符字符的要子串匹配，都取匹配到的索引词的并集；
+        只有两侧都被非标识符字符隔开的中间词，才一定是完整标识符，可以精确查找。
+        """
+        data = query.encode("utf-8", "ignore")
+        matches = list(_TOKEN_RE.finditer(data))
+        if not matches:
+            return None
+
+        with self._lock:
+            vocab, grams = self._vocab, self._grams
+        terms = []
+        for m in matches:
+            token = m.group().decode("ascii").lower()
+            left_open = m.start() == 0 or _IDENT_BYTE.match(data, m.start() - 1)
+            right_open = m.end() == len(data) or _IDENT_BYTE.match(data, m.end())
+            if left_open or right_open:
+                terms.append(self._expand(token, not left_open, vocab, grams))
+            else:
+                terms.append([token])
+
+        with self._lock:
+            result = None
+            for tokens in terms:
+                ids = set()
+                for token in tokens:
+                    ids |= self.postings.get(token, set())
+                result = ids if result is None else result & ids
+                if not result:
+                    return set()
+            return result & self.paths.keys()
+
+    def search(self, query: str, glob: str | None = None, max_results: int = 50) -> list[tuple[str, int, str]]:
+        """子串搜索（不区分大小写），返回 [(相对路径, 行号, 行内容)]"""
+        self.refresh()
+        ids = self._candidates(query)
+        with self._lock:
+            # 两次加锁之间可能有 refresh 作废了部分 id
+            paths = (sorted(self.paths[i] for i in ids if i in self.paths) if ids is not None
+                     else sorted(self.paths.values()))
+        if glob:
+            paths = [p for p in paths if fnmatch.fnmatch(p, glob) or fnmatch.fnmatch(os.path.basename(p), glob)]
+
+        needle = query.lower()
+        results = []
+        for rel in paths:
+            size = self.files.get(rel, (0,))[0]
+            if size > INDEX_MAX_FILE_BYTES:
+                continue
+            try:
+                with open(os.path.join(self.root, rel), "r", encoding="utf-8", errors="replace") as f:
+                    for lineno, line in enumerate(f, 1):
+                        if needle in line.lower():
+                            results.append((rel, lineno, line.rstrip("\n")))
+                            if len(results) >= max_results:
+                                return results
+            except OSError:
+                continue
+        return results
+
+    def find_symbol(self, name: str, max_results: int = 50) -> list[tuple[str, int, str, str]]:
+        """查找 Python 顶层符号定义：精确匹配优先，其次不区分大小写的前缀匹配"""
+        self.refresh()
+        with self._lock:
+            matches = [(name, d) for d in self.symbols.get(name, [])]
+            if not matches:
+                lowered = name.lower()
+                matches = [(n, d) for n, defs in self.symbols.items()
+                           if n.lower().startswith(lowered) for d in defs]
+            results = [(self.paths[fid], lineno, kind, n)
+                       for n, (fid, lineno, kind) in matches if fid in self.paths]
+        return sorted(results)[:max_results]
+
+
+_indexes: dict[str, WorkspaceIndex] = {}
+_indexes_lock = Lock()
+
+
+def get_index(root: str) -> WorkspaceIndex:
+    """每个工作区一个索引实例（进程共享）"""
+    root = os.path.realpath(root)
+    with _indexes_lock:
+        if root not in _indexes:
+            _indexes[root] = WorkspaceIndex(root)
+        return _indexes[root]